@@ -0,0 +1,170 @@
+import threading
+from collections import defaultdict
+
+from sqlalchemy import event
+
+from otree.database import db, dbq, DBSession
+from otree.models_concrete import WaitPageArrivals
+
+# when this many or fewer players are still missing, we query the DB anyway,
+# to show who they are in the Monitor tab.
+# this also checks the count against the DB before the page completes.
+MAX_UNVISITED_FOR_SCAN = 3
+# per session. a page that never completes (e.g. participants dropped out)
+# would otherwise stay here until the server restarts.
+MAX_TALLIES_PER_SESSION = 10_000
+
+
+class _Tally:
+    __slots__ = ['total', 'arrived']
+
+    def __init__(self, total, arrived):
+        self.total = total
+        self.arrived = arrived
+
+    @property
+    def num_unvisited(self):
+        return self.total - self.arrived
+
+
+class ArrivalCounters:
+    """
+    Counts how many participants have arrived at each wait page, so that
+    a player arriving at a wait page doesn't need to load every participant
+    in the group/subsession to find out if they are the last one.
+
+    A tally is keyed by (page_index, 'g' or 's', group_id or subsession_id)
+    within the session. It's kept in memory, and in a WaitPageArrivals row
+    that is updated in the same transaction as the arrival, so:
+    - a transaction that gets rolled back undoes the arrival in both places
+      (the in-memory change is undone in _after_rollback).
+    - after a restart, the tally is read back from its row.
+    - if there is no row yet (e.g. the first arrival at a page), it's seeded
+      by querying the participants, like before.
+
+    An arrival is registered exactly once per participant and page:
+    when _index_in_pages moves onto the wait page, whether or not the
+    participant ever loads it
+    (see FormPageOrInGameWaitPage._increment_index_in_pages
+    and Participant._register_wait_page_arrival).
+    That's why a count is enough, and nothing is registered when the page loads.
+
+    All requests for a session are handled by 1 process (see otree.dispatcher),
+    so the in-memory copy doesn't miss arrivals from other processes.
+    """
+
+    def __init__(self):
+        self._tallies = defaultdict(dict)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.scans = 0
+        self.loads = 0
+        self.invalidations = 0
+
+    def get(self, session_id, key):
+        tally = self._tallies.get(session_id, {}).get(key)
+        if tally is None:
+            row = WaitPageArrivals.objects_first(
+                session_id=session_id, **_key_columns(key)
+            )
+            if row is not None:
+                self.loads += 1
+                tally = self._store(
+                    session_id, key, _Tally(row.num_participants, row.num_arrived)
+                )
+        return tally
+
+    def seed(self, session_id, key, participants, page_index):
+        """from the DB query, which also corrects the tally if it drifted"""
+        tally = _Tally(
+            total=len(participants),
+            arrived=sum(1 for p in participants if p._index_in_pages >= page_index),
+        )
+        self.scans += 1
+        columns = dict(num_participants=tally.total, num_arrived=tally.arrived)
+        if not _rows(session_id, key).update(columns, synchronize_session=False):
+            WaitPageArrivals.objects_create(
+                session_id=session_id, **_key_columns(key), **columns
+            )
+        return self._store(session_id, key, tally)
+
+    def _store(self, session_id, key, tally):
+        with self._lock:
+            tallies = self._tallies[session_id]
+            if len(tallies) >= MAX_TALLIES_PER_SESSION:
+                tallies.clear()
+            tallies[key] = tally
+        # it includes changes that aren't committed yet
+        _log_undo(tallies.pop, key, None)
+        return tally
+
+    def arrive(self, session_id, key):
+        tally = self.get(session_id, key)
+        # otherwise, the query counts them when the tally is seeded
+        if tally is not None:
+            tally.arrived += 1
+            _rows(session_id, key).update(
+                {WaitPageArrivals.num_arrived: WaitPageArrivals.num_arrived + 1},
+                synchronize_session=False,
+            )
+            _log_undo(_unarrive, tally)
+
+    def discard(self, session_id, key):
+        """when the wait page is completed, nobody needs it anymore"""
+        self._tallies.get(session_id, {}).pop(key, None)
+        _rows(session_id, key).delete(synchronize_session=False)
+
+    def invalidate_session(self, session_id):
+        """e.g. when the session is deleted"""
+        with self._lock:
+            if self._tallies.pop(session_id, None) is not None:
+                self.invalidations += 1
+
+    def reset_session(self, session_id):
+        """when players are regrouped, so the group tallies are wrong"""
+        self.invalidate_session(session_id)
+        WaitPageArrivals.objects_filter(session_id=session_id).delete(
+            synchronize_session=False
+        )
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            scans=self.scans,
+            loads=self.loads,
+            invalidations=self.invalidations,
+            size=sum(len(tallies) for tallies in list(self._tallies.values())),
+        )
+
+
+arrival_counters = ArrivalCounters()
+
+
+def _key_columns(key):
+    page_index, kind, target_id = key
+    if kind == 's':
+        return dict(page_index=page_index, group_id=None, subsession_id=target_id)
+    return dict(page_index=page_index, group_id=target_id, subsession_id=None)
+
+
+def _rows(session_id, key):
+    return dbq(WaitPageArrivals).filter_by(session_id=session_id, **_key_columns(key))
+
+
+def _unarrive(tally):
+    tally.arrived -= 1
+
+
+def _log_undo(func, *args):
+    db.info.setdefault('otree_arrivals_undo', []).append((func, args))
+
+
+@event.listens_for(DBSession, 'after_commit')
+def _after_commit(session):
+    session.info.pop('otree_arrivals_undo', None)
+
+
+@event.listens_for(DBSession, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+    for func, args in reversed(session.info.pop('otree_arrivals_undo', [])):
+        func(*args)
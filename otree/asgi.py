@@ -4,7 +4,9 @@ from starlette.responses import HTMLResponse
 from starlette.routing import NoMatchFound
 
 from otree import errorpage
-from otree.database import save_sqlite_db
+from otree.channels.utils import start_channel_layer
+from otree.database import save_sqlite_db, start_sqlite_snapshots
+from otree.tasks import start_task_scheduler
 from . import middleware
 from . import settings
 from .errorpage import OTreeServerErrorMiddleware
@@ -53,6 +55,7 @@ app = OTreeStarlette(
     debug=settings.DEBUG,
     routes=routes,
     exception_handlers={ERR_500: server_error},
+    on_startup=[start_sqlite_snapshots, start_channel_layer, start_task_scheduler],
     on_shutdown=[save_sqlite_db],
 )
 
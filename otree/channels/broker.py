@@ -0,0 +1,103 @@
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from typing import DefaultDict, Set
+
+logger = logging.getLogger(__name__)
+
+# messages can be big, e.g. the session monitor table
+MAX_LINE_LENGTH = 2 ** 26
+# a worker whose unsent data passes this is disconnected, so that 1 stalled worker
+# can't make the broker's memory grow without bound.
+# it reconnects and resubscribes by itself (see BrokerChannelLayer).
+MAX_WORKER_BUFFER = 2 * MAX_LINE_LENGTH
+
+'''
+Protocol: 1 line per message.
+the group name is JSON-encoded, so it can't contain a tab or newline.
+the text is already JSON, which has no raw newlines.
+
+worker -> broker:
+    S <group>           (a socket on this worker joined the group)
+    U <group>           (the last socket on this worker left the group)
+    P <group>\t<text>   (broadcast)
+
+broker -> worker:
+    <group>\t<text>
+'''
+
+
+class ChannelBroker:
+    """
+    Relays broadcasts between server processes over a Unix domain socket.
+    Each worker tells the broker which groups it has sockets for,
+    so a message only goes to the workers that need it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._subscribers: DefaultDict[str, Set[asyncio.StreamWriter]] = defaultdict(
+            set
+        )
+        self.num_dropped = 0
+
+    async def serve(self):
+        server = await asyncio.start_unix_server(
+            self._handle_worker, path=self.path, limit=MAX_LINE_LENGTH
+        )
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_worker(self, reader, writer):
+        groups = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                op, rest = line[:1], line[2:]
+                if op == b'P':
+                    group_json, _, _ = rest.partition(b'\t')
+                    group = json.loads(group_json)
+                    for other in list(self._subscribers.get(group, ())):
+                        if other is not writer:
+                            self._write(other, rest)
+                elif op == b'S':
+                    group = json.loads(rest)
+                    groups.add(group)
+                    self._subscribers[group].add(writer)
+                elif op == b'U':
+                    group = json.loads(rest)
+                    groups.discard(group)
+                    self._unsubscribe(group, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as exc:
+            logger.warning(f'channel broker: lost connection to worker: {exc!r}')
+        finally:
+            for group in groups:
+                self._unsubscribe(group, writer)
+            writer.close()
+
+    def _write(self, writer, data):
+        # we don't await drain(), because that would make every other worker
+        # wait for the slowest one.
+        transport = writer.transport
+        if transport.is_closing():
+            return
+        writer.write(data)
+        if transport.get_write_buffer_size() > MAX_WORKER_BUFFER:
+            logger.warning('channel broker: dropping worker that is not keeping up')
+            self.num_dropped += 1
+            # its _handle_worker() then gets EOF and unsubscribes it
+            transport.abort()
+
+    def _unsubscribe(self, group, writer):
+        writers = self._subscribers.get(group)
+        if writers is not None:
+            writers.discard(writer)
+            if not writers:
+                del self._subscribers[group]
+
+
+def encode_group(group) -> bytes:
+    return json.dumps(group).encode('utf-8')
@@ -1,6 +1,4 @@
-import datetime
-import datetime
-import io
+import asyncio
 import logging
 import traceback
 import urllib.parse
@@ -13,13 +11,21 @@ import otree.bots.browser
 import otree.channels.utils as channel_utils
 import otree.session
 from otree import settings
+from otree.arrivals import arrival_counters
 from otree.channels.utils import get_chat_group, channel_layer
 from otree.common import get_main_module, GlobalState, signer_unsign, AUTH_COOKIE_NAME, AUTH_COOKIE_VALUE
+from otree.completions import completions
 from otree.currency import json_dumps
-from otree.database import NoResultFound, session_scope, dbq
-from otree.export import export_wide, export_app, custom_export_app, BOM
-from otree.live import live_payload_function
-from otree.middleware import lock2
+from otree.database import NoResultFound, session_scope, db, dbq
+from otree.live import (
+    live_queue_key,
+    live_queues,
+    LiveContext,
+    LIVE_QUEUE_SIZE,
+    TokenBucket,
+)
+from otree.lookup import get_page_lookup, session_pages
+from otree.middleware import session_locks
 from otree.models import Participant, Session
 from otree.models_concrete import (
     CompletedGroupWaitPage,
@@ -28,10 +34,10 @@ from otree.models_concrete import (
     ChatMessage,
 )
 from otree.room import ROOM_DICT, LabelRoom, NoLabelRoom
+from otree.row_cache import row_cache
 from otree.session import SESSION_CONFIGS_DICT
 from otree.views.admin import CreateSessionForm
-
-# lock2 = asyncio.Lock()
+from otree.views.export import download_tokens
 
 logger = logging.getLogger(__name__)
 
@@ -74,6 +80,17 @@ class _OTreeAsyncJsonWebsocketConsumer(WebSocketEndpoint):
     def _is_unauthorized(self):
         return
 
+    def session_code_for_lock(self, **kwargs):
+        '''
+        subclasses whose events only touch a single session should override this,
+        so they don't have to wait for other sessions.
+        None means the global lock.
+        '''
+        return None
+
+    def _session_code_for_lock(self):
+        return self.session_code_for_lock(**self.cleaned_kwargs)
+
     async def on_connect(self, websocket: WebSocket) -> None:
         # patch the instance
         websocket.send = channel_utils.wrap_websocket_send(websocket.send)
@@ -92,7 +109,7 @@ class _OTreeAsyncJsonWebsocketConsumer(WebSocketEndpoint):
             return
 
         self.websocket = websocket
-        async with lock2:
+        async with session_locks.acquire(self._session_code_for_lock()):
             with session_scope():
                 await self.post_connect(**self.cleaned_kwargs)
         for group in self.groups:
@@ -102,7 +119,7 @@ class _OTreeAsyncJsonWebsocketConsumer(WebSocketEndpoint):
         pass
 
     async def on_disconnect(self, websocket: WebSocket, close_code: int):
-        async with lock2:
+        async with session_locks.acquire(self._session_code_for_lock()):
             with session_scope():
                 await self.pre_disconnect(**self.cleaned_kwargs)
         for group in self.groups:
@@ -112,7 +129,7 @@ class _OTreeAsyncJsonWebsocketConsumer(WebSocketEndpoint):
         pass
 
     async def on_receive(self, websocket: WebSocket, data):
-        async with lock2:
+        async with session_locks.acquire(self._session_code_for_lock()):
             with session_scope():
                 await self.post_receive_json(data, **self.cleaned_kwargs)
 
@@ -133,6 +150,9 @@ class BaseWaitPage(_OTreeAsyncJsonWebsocketConsumer):
             kwargs[k] = int(d[k])
         return kwargs
 
+    def session_code_for_lock(self, session_pk, **kwargs):
+        return session_locks.session_code_for_pk(session_pk)
+
 
 class WSSubsessionWaitPage(BaseWaitPage):
 
@@ -141,8 +161,8 @@ class WSSubsessionWaitPage(BaseWaitPage):
     def group_name(self, session_pk, page_index, participant_id):
         return channel_utils.subsession_wait_page_name(session_pk, page_index)
 
-    def completion_exists(self, **kwargs):
-        return CompletedSubsessionWaitPage.objects_exists(**kwargs)
+    def completion_exists(self, session_id, **kwargs):
+        return completions.exists(CompletedSubsessionWaitPage, session_id, **kwargs)
 
     async def post_connect(self, session_pk, page_index, participant_id):
         if self.completion_exists(page_index=page_index, session_id=session_pk):
@@ -156,8 +176,8 @@ class WSGroupWaitPage(BaseWaitPage):
     def group_name(self, session_pk, page_index, group_id, participant_id):
         return channel_utils.group_wait_page_name(session_pk, page_index, group_id)
 
-    def completion_exists(self, **kwargs):
-        return CompletedGroupWaitPage.objects_exists(**kwargs)
+    def completion_exists(self, session_id, **kwargs):
+        return completions.exists(CompletedGroupWaitPage, session_id, **kwargs)
 
     async def post_connect(self, session_pk, page_index, group_id, participant_id):
         if self.completion_exists(
@@ -167,24 +187,129 @@ class WSGroupWaitPage(BaseWaitPage):
 
 
 class LiveConsumer(_OTreeAsyncJsonWebsocketConsumer):
+    window_timer = None
+    coalesce_key = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # set by post_connect. if that fails, messages are ignored.
+        self.live_context = None
+        # on a page with live_coalesce_ms, the latest message of the current
+        # window for each key, in the order they were sent.
+        self.held = {}
+
     def group_name(self, session_code, page_index, participant_code, **kwargs):
         return channel_utils.live_group(session_code, page_index, participant_code)
 
     def clean_kwargs(self):
         return parse_querystring(self.scope['query_string'])
 
-    def browser_bot_exists(self, participant_code):
+    def session_code_for_lock(self, participant_code, **kwargs):
+        # don't trust the session_code param, since the participant is what gets loaded
+        return session_locks.session_code_for_participant(participant_code)
+
+    async def post_connect(self, participant_code, **kwargs):
+        self.live_context = context = LiveContext()
+        self.queue_key = live_queue_key(participant_code, context)
         # for browser bots, block liveSend calls that get triggered on page load.
         # instead, everything must happen through call_live_method in a controlled way.
-        return Participant.objects_exists(code=participant_code, is_browser_bot=True)
+        # it doesn't change, so only check it once per connection.
+        context.is_browser_bot = Participant.objects_exists(
+            code=participant_code, is_browser_bot=True
+        )
+        self.coalesce_seconds = 0
+        if context.index_in_pages is not None:
+            PageClass = get_page_lookup(
+                context.session_code, context.index_in_pages
+            ).page_class
+            coalesce_ms = getattr(PageClass, 'live_coalesce_ms', None) or 0
+            self.coalesce_seconds = coalesce_ms / 1000
+            self.coalesce_key = getattr(PageClass, 'live_coalesce_key', None)
+        self.rate_limit = TokenBucket()
+        self.warned_rate_limit = False
 
-    async def post_receive_json(self, content, participant_code, page_name, **kwargs):
-        if self.browser_bot_exists(participant_code):
+    async def on_receive(self, websocket: WebSocket, data):
+        # the live_method runs in a worker thread, in its own transaction.
+        # see LiveQueues.
+        if self.live_context is None or self.live_context.is_browser_bot:
             return
-        await live_payload_function(
-            participant_code=participant_code, page_name=page_name, payload=content
+        if self.coalesce_seconds:
+            if self.window_timer:
+                self.hold(data)
+            else:
+                self.submit_and_start_window([data])
+            return
+        if not self.rate_limit.take():
+            self.on_rate_limited()
+            return
+        done = self.submit(data)
+        if live_queues.depth(self.queue_key) > LIVE_QUEUE_SIZE:
+            await done
+
+    def submit(self, data):
+        return live_queues.submit(
+            self.queue_key,
+            self._session_code_for_lock(),
+            participant_code=self.cleaned_kwargs['participant_code'],
+            page_name=self.cleaned_kwargs['page_name'],
+            payload=data,
+            context=self.live_context,
         )
 
+    def hold(self, data):
+        key = None
+        if isinstance(data, dict) and self.coalesce_key:
+            key = data.get(self.coalesce_key)
+            # JSON lists and objects can't be dict keys
+            if isinstance(key, (list, dict)):
+                key = None
+        if key in self.held:
+            live_queues.num_coalesced += 1
+            # so that it's sent in the order of its latest message
+            del self.held[key]
+        self.held[key] = data
+
+    def submit_and_start_window(self, messages):
+        # the first message of a window goes out right away,
+        # so a single change isn't delayed.
+        for data in messages:
+            if self.rate_limit.take():
+                self.submit(data)
+            else:
+                # hold it until the bucket has room
+                self.on_rate_limited()
+                self.hold(data)
+        delay = self.coalesce_seconds
+        if self.held:
+            delay = max(delay, self.rate_limit.seconds_until_available())
+        self.window_timer = asyncio.get_event_loop().call_later(delay, self.end_window)
+
+    def end_window(self):
+        self.window_timer = None
+        if self.held:
+            messages = list(self.held.values())
+            self.held = {}
+            self.submit_and_start_window(messages)
+
+    def on_rate_limited(self):
+        live_queues.num_rate_limited += 1
+        if not self.warned_rate_limit:
+            self.warned_rate_limit = True
+            logger.warning(
+                f"Participant {self.cleaned_kwargs['participant_code']} is sending "
+                "liveSend messages faster than OTREE_LIVE_MAX_RATE allows"
+            )
+
+    async def pre_disconnect(self, **kwargs):
+        if self.window_timer:
+            self.window_timer.cancel()
+            self.window_timer = None
+        # so that the last values the participant sent aren't lost
+        messages = list(self.held.values())
+        self.held = {}
+        for data in messages:
+            self.submit(data)
+
     @classmethod
     async def encode_json(cls, content):
         return json_dumps(content)
@@ -209,6 +334,9 @@ class WSGroupByArrivalTime(_OTreeAsyncJsonWebsocketConsumer):
         gn = channel_utils.gbat_group_name(session_pk, page_index)
         return gn
 
+    def session_code_for_lock(self, session_pk, **kwargs):
+        return session_locks.session_code_for_pk(session_pk)
+
     def is_ready(self, *, app_name, player_id, page_index, session_pk):
         models_module = get_main_module(app_name)
         Player = models_module.Player
@@ -222,10 +350,11 @@ class WSGroupByArrivalTime(_OTreeAsyncJsonWebsocketConsumer):
             .one()
         )
 
-        return CompletedGBATWaitPage.objects_exists(
+        return completions.exists(
+            CompletedGBATWaitPage,
+            session_pk,
             page_index=page_index,
             id_in_subsession=group_id_in_subsession,
-            session_id=session_pk,
         )
 
     def mark_gbat_is_connected(self, is_connected):
@@ -280,6 +409,9 @@ class DetectAutoAdvance(_OTreeAsyncJsonWebsocketConsumer):
     def group_name(self, page_index, participant_code):
         return channel_utils.auto_advance_group(participant_code)
 
+    def session_code_for_lock(self, participant_code, **kwargs):
+        return session_locks.session_code_for_participant(participant_code)
+
     def page_should_be_on(self, participant_code):
         try:
             [res] = (
@@ -461,6 +593,9 @@ class WSSessionMonitor(_OTreeAsyncJsonWebsocketConsumer):
     def group_name(self, code):
         return channel_utils.session_monitor_group_name(code)
 
+    def session_code_for_lock(self, code):
+        return code
+
     def get_initial_data(self, code):
         participants = Participant.objects_filter(_session_code=code, visited=True)
         return otree.export.get_rows_for_monitor(participants)
@@ -590,10 +725,34 @@ class WSChat(_OTreeAsyncJsonWebsocketConsumer):
         ChatMessage.objects_create(**kwargs)
 
 
+def forget_deleted_sessions(sessions):
+    """
+    sessions is a list of [session_id, session_code].
+    runs in every server process, since each one has its own caches.
+    """
+    for session_id, session_code in sessions:
+        session_pages.discard(session_code)
+        session_locks.forget_session(session_code)
+        # IDs can be reused after deleting
+        arrival_counters.invalidate_session(session_id)
+        completions.invalidate_session(session_id)
+        row_cache.invalidate_session(session_id)
+
+
+channel_layer.listen(channel_utils.SESSIONS_DELETED_GROUP, forget_deleted_sessions)
+
+
 class WSDeleteSessions(_OTreeAsyncJsonWebsocketConsumer):
     async def post_receive_json(self, content):
-        Session.objects_filter(Session.code.in_(content)).delete(
-            synchronize_session=False
+        sessions = Session.objects_filter(Session.code.in_(content))
+        rows = sessions.with_entities(Session.id, Session.code)
+        deleted = [[session_id, session_code] for session_id, session_code in rows]
+        sessions.delete(synchronize_session=False)
+        # commit first, so that another process can't fill its caches
+        # from the deleted rows after it forgets them.
+        db.commit()
+        await channel_utils.group_send(
+            group=channel_utils.SESSIONS_DELETED_GROUP, data=deleted
         )
         await self.send_json('ok')
 
@@ -604,9 +763,9 @@ class WSDeleteSessions(_OTreeAsyncJsonWebsocketConsumer):
 class WSExportData(_OTreeAsyncJsonWebsocketConsumer):
 
     '''
-    I load tested this locally with sqlite and:
-    - large files up to 22MB (by putting long text in LongStringFields)
-    - thousands of participants/rounds, 111000 rows and 20 cols in excel file.
+    Replies with a one-time link to ExportData, which streams the file.
+    (The file used to be sent in the websocket message itself,
+    which meant building the whole file in memory, on the event loop.)
     '''
 
     async def post_receive_json(self, content: dict):
@@ -616,37 +775,14 @@ class WSExportData(_OTreeAsyncJsonWebsocketConsumer):
         don't need time_spent or chat yet, they are quick enough
         '''
 
-        app_name = content.get('app_name')
-        is_custom = content.get('is_custom')
-
-        iso_date = datetime.date.today().isoformat()
-        try:
-            with io.StringIO() as fp:
-                # Excel requires BOM; otherwise non-english characters are garbled
-                if content.get('for_excel'):
-                    fp.write(BOM)
-                if app_name:
-                    if is_custom:
-                        fxn = custom_export_app
-                    else:
-                        fxn = export_app
-                    fxn(app_name, fp)
-                    file_name_prefix = app_name
-                else:
-                    export_wide(fp)
-                    file_name_prefix = 'all_apps_wide'
-                data = fp.getvalue()
-        except Exception:
-            content.update(
-                error="Error exporting data. Check the server logs for details."
-            )
-            await self.send_json(content)
-            raise
-        else:
-            file_name = f'{file_name_prefix}_{iso_date}.csv'
-            content.update(file_name=file_name, data=data, mime_type='text/csv')
-            # note, this doesn't go through channel layer currently
-            await self.send_json(content)
+        token = download_tokens.create(
+            app_name=content.get('app_name'),
+            is_custom=bool(content.get('is_custom')),
+            for_excel=bool(content.get('for_excel')),
+        )
+        content.update(url=f'/ExportData?token={token}')
+        # note, this doesn't go through channel layer currently
+        await self.send_json(content)
 
     def group_name(self, **kwargs):
         return None
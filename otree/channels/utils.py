@@ -1,14 +1,35 @@
-from otree.common import signer_sign
 import asyncio
-from collections import defaultdict
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque, OrderedDict
+from importlib import import_module
 from typing import DefaultDict, Dict
 from urllib.parse import urlencode
 import websockets.exceptions
 from starlette.websockets import WebSocket
 
+from otree.channels.broker import MAX_LINE_LENGTH, encode_group
 from otree.common import signer_sign
 from otree.currency import json_dumps
 
+logger = logging.getLogger(__name__)
+
+# max number of messages from sync_group_send that can be waiting to be sent.
+# if it's reached, the sending thread blocks until there is room.
+SYNC_SEND_QUEUE_SIZE = 10_000
+
+# a broadcast waits at most this long for each socket before moving on.
+# the send keeps going in the background.
+WS_SEND_TIMEOUT = float(os.getenv('OTREE_WS_SEND_TIMEOUT') or 5)
+# a socket with this many unfinished sends is dropped.
+# the browser will reconnect and get the current state then.
+WS_MAX_BACKLOG = int(os.getenv('OTREE_WS_MAX_BACKLOG') or 10)
+# number of groups (most recently used) that we keep fan-out stats for
+FANOUT_STATS_SIZE = 100
+
 
 def wrap_websocket_send(original_send):
     async def send(message):
@@ -23,14 +44,40 @@ def wrap_websocket_send(original_send):
 
 
 class ChannelLayer:
-    _subs: DefaultDict[str, Dict[int, WebSocket]]
+    """
+    Keeps track of which websockets are in which group, and broadcasts to them.
+    This one only knows about the sockets in the current process.
+    To use a different implementation, set OTREE_CHANNEL_LAYER to its import path.
+    It needs to provide start(), add(), discard(), listen(), send(), send_text(),
+    and sync_send().
+    """
 
-    def _get_sockets(self, group):
-        for socket in self._subs[group].values():
-            yield socket
+    _subs: DefaultDict[str, Dict[int, WebSocket]]
 
     def __init__(self):
         self._subs = defaultdict(dict)
+        # group -> functions to call in this process, rather than sockets
+        self._listeners: Dict[str, list] = {}
+        self._loop = None
+        self._loop_thread_id = None
+        # messages from sync_send, per group, drained in order by 1 task per group.
+        self._pending: Dict[str, deque] = {}
+        self._slots = threading.BoundedSemaphore(SYNC_SEND_QUEUE_SIZE)
+        self.num_queued = 0
+        self.num_sent = 0
+        self.max_depth = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+        # unfinished sends per socket
+        self._backlog: Dict[int, int] = {}
+        # group -> [broadcasts, sockets in last broadcast, total latency, max latency]
+        self._fanout_stats = OrderedDict()
+        self.num_timeouts = 0
+        self.num_dropped = 0
+
+    def start(self):
+        self._loop = asyncio.get_event_loop()
+        self._loop_thread_id = threading.get_ident()
 
     def add(self, group: str, websocket: WebSocket):
         self._subs[group][id(websocket)] = websocket
@@ -42,25 +89,311 @@ class ChannelLayer:
         if not group_dict:
             del self._subs[group]
 
+    def listen(self, group, callback):
+        """
+        callback(data) is called in every server process that listens to the group,
+        whichever process sent the message.
+        For keeping per-process state in sync, e.g. when a session is deleted.
+        """
+        self._listeners.setdefault(group, []).append(callback)
+
+    def _has_recipients(self, group):
+        return group in self._subs or group in self._listeners
+
     async def send(self, group, data):
-        for socket in self._get_sockets(group):
-            await socket.send_text(json_dumps(data))
+        if self._has_recipients(group):
+            await self._deliver(group, json_dumps(data))
+
+    async def send_text(self, groups, text):
+        """
+        sends an already-encoded message to several groups at once,
+        so that a broadcast is only serialized once.
+        """
+        await asyncio.gather(
+            *[
+                self._deliver(group, text)
+                for group in groups
+                if self._has_recipients(group)
+            ]
+        )
+
+    async def _deliver(self, group, text):
+        """sends to the listeners and sockets in this process"""
+        for callback in self._listeners.get(group, ()):
+            try:
+                callback(json.loads(text))
+            except Exception as exc:
+                # shouldn't affect the sockets
+                logger.exception(repr(exc))
+        sockets = list(self._subs.get(group, {}).values())
+        if not sockets:
+            return
+        start = time.monotonic()
+        tasks = []
+        for socket in sockets:
+            if self._backlog.get(id(socket), 0) >= WS_MAX_BACKLOG:
+                self._drop(socket)
+            else:
+                tasks.append(asyncio.ensure_future(self._send_text(socket, text)))
+        if tasks:
+            # the sends are started in order, and each one writes its frame
+            # before it yields, so a socket still gets messages in order
+            # even if an earlier send is still in progress.
+            _, pending = await asyncio.wait(tasks, timeout=WS_SEND_TIMEOUT)
+            self.num_timeouts += len(pending)
+        self._record_fanout(group, len(sockets), time.monotonic() - start)
+
+    async def _send_text(self, socket, text):
+        key = id(socket)
+        self._backlog[key] = self._backlog.get(key, 0) + 1
+        try:
+            await socket.send_text(text)
+        except Exception as exc:
+            # e.g. the socket was closed in the meantime.
+            # shouldn't affect the other recipients.
+            logger.debug(f'websocket send failed: {exc!r}')
+        finally:
+            self._backlog[key] -= 1
+            if not self._backlog[key]:
+                del self._backlog[key]
+
+    def _drop(self, socket):
+        logger.warning('Dropping websocket connection that is not keeping up')
+        self.num_dropped += 1
+        key = id(socket)
+        for group in [g for g, group_dict in self._subs.items() if key in group_dict]:
+            self.discard(group, socket)
+        asyncio.ensure_future(self._close(socket))
+
+    async def _close(self, socket):
+        try:
+            # 1013 = try again later
+            await socket.close(code=1013)
+        except Exception:
+            pass
+
+    def _record_fanout(self, group, num_sockets, latency):
+        stats = self._fanout_stats.pop(group, None) or [0, 0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] = num_sockets
+        stats[2] += latency
+        stats[3] = max(stats[3], latency)
+        self._fanout_stats[group] = stats
+        if len(self._fanout_stats) > FANOUT_STATS_SIZE:
+            self._fanout_stats.popitem(last=False)
 
     def sync_send(self, group, data):
-        asyncio.run(self.send(group, data))
+        """
+        For code running in a worker thread (e.g. a page's post()).
+        The websockets belong to the server's event loop,
+        so rather than sending from this thread, we hand the message to the loop
+        and return immediately.
+        """
+        if self._loop is None:
+            # not running inside the server (e.g. 'otree test'),
+            # so nobody can be subscribed.
+            return
+        if threading.get_ident() != self._loop_thread_id:
+            self._slots.acquire()
+        elif not self._slots.acquire(blocking=False):
+            # blocking the loop would deadlock, so just go over the limit.
+            logger.warning('channel layer send queue is full')
+        self._loop.call_soon_threadsafe(
+            self._enqueue, group, data, time.monotonic()
+        )
+
+    def _enqueue(self, group, data, queued_at):
+        self.num_queued += 1
+        queue = self._pending.get(group)
+        if queue is None:
+            queue = self._pending[group] = deque()
+            self._loop.create_task(self._drain(group, queue))
+        queue.append((data, queued_at))
+        self.max_depth = max(self.max_depth, self.num_queued - self.num_sent)
+
+    async def _drain(self, group, queue):
+        """sends a group's messages one at a time, so they arrive in order"""
+        try:
+            while queue:
+                data, queued_at = queue[0]
+                try:
+                    await self.send(group, data)
+                except Exception as exc:
+                    logger.exception(repr(exc))
+                queue.popleft()
+                self.num_sent += 1
+                delay = time.monotonic() - queued_at
+                self.total_delay += delay
+                self.max_delay = max(self.max_delay, delay)
+                try:
+                    self._slots.release()
+                except ValueError:
+                    # was sent over the limit from the loop thread
+                    pass
+        finally:
+            del self._pending[group]
+
+    def stats(self):
+        return dict(
+            queued=self.num_queued,
+            pending=self.num_queued - self.num_sent,
+            max_pending=self.max_depth,
+            mean_delay_ms=round(
+                1000 * self.total_delay / self.num_sent if self.num_sent else 0, 1
+            ),
+            max_delay_ms=round(1000 * self.max_delay, 1),
+            timeouts=self.num_timeouts,
+            dropped=self.num_dropped,
+        )
+
+    def fanout_stats(self, limit=10):
+        """the groups with the slowest broadcasts"""
+        rows = [
+            dict(
+                group=group,
+                broadcasts=num,
+                sockets=num_sockets,
+                mean_ms=round(1000 * total / num, 1),
+                max_ms=round(1000 * max_latency, 1),
+            )
+            for group, (num, num_sockets, total, max_latency) in self._fanout_stats.items()
+        ]
+        rows.sort(key=lambda row: row['max_ms'], reverse=True)
+        return rows[:limit]
+
+
+class BrokerChannelLayer(ChannelLayer):
+    """
+    Channel layer for running several server processes.
+    A broadcast is delivered to this process's sockets directly,
+    and to other processes' sockets through the ChannelBroker.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._writer = None
+        self.num_published = 0
+        self.num_received = 0
+
+    def start(self):
+        super().start()
+        self._loop.create_task(self._connect_forever())
+
+    async def _connect_forever(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(
+                    self.path, limit=MAX_LINE_LENGTH
+                )
+            except OSError as exc:
+                logger.warning(f'Cannot connect to channel broker: {exc!r}')
+                await asyncio.sleep(1)
+                continue
+            # we may have reconnected, so the broker doesn't know our groups
+            for group in {*self._subs, *self._listeners}:
+                writer.write(b'S ' + encode_group(group) + b'\n')
+            self._writer = writer
+            try:
+                await self._read(reader)
+            finally:
+                self._writer = None
+                writer.close()
+            logger.warning('Lost connection to channel broker; reconnecting')
+            await asyncio.sleep(1)
+
+    async def _read(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                group_json, _, text = line.rstrip(b'\n').partition(b'\t')
+                self.num_received += 1
+                # _deliver() starts its sends before it yields,
+                # so messages still go out in the order they arrived.
+                self._loop.create_task(
+                    self._deliver(json.loads(group_json), text.decode('utf-8'))
+                )
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as exc:
+            logger.warning(f'channel broker connection error: {exc!r}')
+
+    def _write(self, line: bytes):
+        if self._writer is not None:
+            self._writer.write(line)
+
+    def add(self, group: str, websocket):
+        is_new = not self._has_recipients(group)
+        super().add(group, websocket)
+        if is_new:
+            self._write(b'S ' + encode_group(group) + b'\n')
+
+    def discard(self, group, websocket):
+        existed = group in self._subs
+        super().discard(group, websocket)
+        if existed and not self._has_recipients(group):
+            self._write(b'U ' + encode_group(group) + b'\n')
 
+    def listen(self, group, callback):
+        is_new = not self._has_recipients(group)
+        super().listen(group, callback)
+        if is_new:
+            self._write(b'S ' + encode_group(group) + b'\n')
 
-channel_layer = ChannelLayer()
+    async def send(self, group, data):
+        text = json_dumps(data)
+        self.num_published += 1
+        self._write(
+            b'P ' + encode_group(group) + b'\t' + text.encode('utf-8') + b'\n'
+        )
+        await self._deliver(group, text)
+
+    async def send_text(self, groups, text):
+        line_end = b'\t' + text.encode('utf-8') + b'\n'
+        for group in groups:
+            self.num_published += 1
+            self._write(b'P ' + encode_group(group) + line_end)
+        await super().send_text(groups, text)
+
+    def stats(self):
+        return dict(
+            super().stats(),
+            broker_connected=self._writer is not None,
+            published=self.num_published,
+            received=self.num_received,
+        )
+
+
+def get_channel_layer() -> ChannelLayer:
+    import_path = os.getenv('OTREE_CHANNEL_LAYER')
+    if import_path:
+        module_name, class_name = import_path.rsplit('.', 1)
+        return getattr(import_module(module_name), class_name)()
+    broker_path = os.getenv('OTREE_CHANNEL_BROKER')
+    if broker_path:
+        return BrokerChannelLayer(broker_path)
+    return ChannelLayer()
+
+
+channel_layer = get_channel_layer()
 
 
 async def group_send(*, group: str, data: dict):
     await channel_layer.send(group, data)
 
 
+async def groups_send_text(*, groups, text: str):
+    await channel_layer.send_text(groups, text)
+
+
 def sync_group_send(*, group: str, data: dict):
     channel_layer.sync_send(group=group, data=data)
 
 
+def start_channel_layer():
+    channel_layer.start()
+
+
 def group_wait_page_name(session_id, page_index, group_id):
 
     return 'wait-page-{}-page{}-{}'.format(session_id, page_index, group_id)
@@ -87,6 +420,10 @@ def room_participant_path(**kwargs):
     return '/wait_for_session_in_room?' + urlencode(kwargs)
 
 
+# every server process listens to this, see forget_deleted_sessions()
+SESSIONS_DELETED_GROUP = 'otree-sessions-deleted'
+
+
 def session_monitor_group_name(session_code):
     return f'session-monitor-{session_code}'
 
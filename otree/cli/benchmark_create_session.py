@@ -0,0 +1,55 @@
+import logging
+import time
+
+from .base import BaseCommand
+
+from otree.common import get_main_module
+from otree.database import db, dbq
+from otree.models import Participant
+from otree.session import create_session
+
+
+logger = logging.getLogger('otree')
+
+
+class Command(BaseCommand):
+    help = "oTree: Measure how long it takes to create a session (in-memory DB)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('session_config_name', help="The session config name")
+        parser.add_argument(
+            'num_participants',
+            type=int,
+            help="Number of participants for each created session",
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=1,
+            help="Number of sessions to create",
+        )
+
+    def handle(self, session_config_name, num_participants, repeat, **kwargs):
+        for _ in range(repeat):
+            start = time.time()
+            session = create_session(
+                session_config_name=session_config_name,
+                num_participants=num_participants,
+            )
+            elapsed = time.time() - start
+
+            num_rows = 1 + dbq(Participant).filter_by(session=session).count()
+            for app_name in session.config['app_sequence']:
+                models_module = get_main_module(app_name)
+                for Model in [
+                    models_module.Subsession,
+                    models_module.Group,
+                    models_module.Player,
+                ]:
+                    num_rows += dbq(Model).filter_by(session=session).count()
+            logger.info(
+                f'{session.code}: {num_rows} rows in {elapsed:.2f}s '
+                f'({num_rows / elapsed:.0f} rows/second)'
+            )
+            # so that the next iteration starts with an empty identity map
+            db.close()
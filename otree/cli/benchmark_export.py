@@ -0,0 +1,46 @@
+import logging
+import time
+import tracemalloc
+
+from .base import BaseCommand
+
+from otree.database import db, session_scope
+from otree.export import iter_export_wide
+from otree.session import create_session
+
+
+logger = logging.getLogger('otree')
+
+
+class Command(BaseCommand):
+    help = (
+        "oTree: Measure how long the wide CSV export takes, "
+        "and how much memory it needs (in-memory DB)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('session_config_name', help="The session config name")
+        parser.add_argument('num_participants', type=int)
+
+    def handle(self, session_config_name, num_participants, **kwargs):
+        with session_scope():
+            session = create_session(
+                session_config_name=session_config_name,
+                num_participants=num_participants,
+            )
+            code = session.code
+        db.close()
+
+        tracemalloc.start()
+        start = time.time()
+        num_chars = 0
+        with session_scope():
+            for chunk in iter_export_wide(session_code=code):
+                num_chars += len(chunk)
+        elapsed = time.time() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        logger.info(
+            f'{num_chars / 1e6:.1f}M characters in {elapsed:.2f}s, '
+            f'peak memory {peak / 1e6:.1f}MB'
+        )
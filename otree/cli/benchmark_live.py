@@ -0,0 +1,116 @@
+import asyncio
+import json
+import logging
+import time
+
+from .base import BaseCommand
+
+from otree.database import db, session_scope
+from otree.live import (
+    live_payload_function,
+    live_queue_key,
+    live_queues,
+    live_send_stats,
+    LiveContext,
+)
+from otree.session import create_session
+
+
+logger = logging.getLogger('otree')
+
+
+class Command(BaseCommand):
+    help = (
+        "oTree: Measure how many liveSend messages per second "
+        "1 core can handle (in-memory DB)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'session_config_name',
+            help="The session config name. Its first page must have a live_method.",
+        )
+        parser.add_argument('num_participants', type=int)
+        parser.add_argument(
+            'payload', help="JSON of the message to send, e.g. '{\"bid\": 5}'",
+        )
+        parser.add_argument(
+            '--messages', type=int, default=2000, help="Number of messages to send",
+        )
+
+    def handle(self, session_config_name, num_participants, payload, messages, **kwargs):
+        # sets page_class.is_noself etc.
+        import otree.urls  # noqa
+
+        payload = json.loads(payload)
+        with session_scope():
+            session = create_session(
+                session_config_name=session_config_name,
+                num_participants=num_participants,
+            )
+            participants = session.get_participants()
+            for pp in participants:
+                pp.initialize(None)
+            page = participants[0]._get_page_instance()
+            if not page.live_method:
+                logger.error(f'{type(page).__name__} has no live_method')
+                return
+            page_name = type(page).__name__
+            codes = [pp.code for pp in participants]
+
+        for label, make_context in [
+            ('new context per message', lambda: None),
+            ('context kept per connection', LiveContext),
+        ]:
+            contexts = {code: make_context() for code in codes}
+            start = time.time()
+            asyncio.run(send_messages(codes, page_name, payload, messages, contexts))
+            elapsed = time.time() - start
+            logger.info(f'{label}: {messages / elapsed:.0f} messages/second')
+            db.close()
+
+        # like LiveConsumer: the live_method runs in a thread, 1 queue per group
+        contexts = {code: LiveContext() for code in codes}
+        with session_scope():
+            keys = {code: live_queue_key(code, contexts[code]) for code in codes}
+        start = time.time()
+        asyncio.run(
+            submit_messages(codes, page_name, payload, messages, contexts, keys)
+        )
+        elapsed = time.time() - start
+        logger.info(
+            f'through the per-group queues: {messages / elapsed:.0f} messages/second'
+        )
+        logger.info(f'queues: {live_queues.stats()}')
+        for page_key, d in live_send_stats.stats().items():
+            logger.info(f'{page_key}: {d}')
+
+
+async def send_messages(codes, page_name, payload, num_messages, contexts):
+    for i in range(num_messages):
+        code = codes[i % len(codes)]
+        # like LiveConsumer, a transaction per message
+        with session_scope():
+            await live_payload_function(
+                participant_code=code,
+                page_name=page_name,
+                payload=payload,
+                context=contexts[code],
+            )
+
+
+async def submit_messages(codes, page_name, payload, num_messages, contexts, keys):
+    futures = []
+    for i in range(num_messages):
+        code = codes[i % len(codes)]
+        futures.append(
+            live_queues.submit(
+                keys[code],
+                None,
+                participant_code=code,
+                page_name=page_name,
+                payload=payload,
+                context=contexts[code],
+            )
+        )
+    await asyncio.gather(*futures)
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import time
+
+from starlette.concurrency import run_in_threadpool
+
+from .base import BaseCommand
+
+from otree.middleware import SessionLocks
+
+
+logger = logging.getLogger('otree')
+
+
+class Command(BaseCommand):
+    help = (
+        "oTree: Compare request throughput under the global lock "
+        "and under per-session locks, for several numbers of concurrent sessions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sessions',
+            type=int,
+            nargs='+',
+            default=[1, 2, 4, 8],
+            help="Numbers of concurrent sessions to try",
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=40,
+            help="Number of requests per session",
+        )
+        parser.add_argument(
+            '--ms',
+            type=float,
+            default=20,
+            help="How long each request holds the lock, e.g. a slow before_next_page",
+        )
+        parser.add_argument(
+            '--global-every',
+            type=int,
+            default=20,
+            help="Every Nth request takes the global lock, like an admin page",
+        )
+
+    def handle(self, sessions, requests, ms, global_every, **kwargs):
+        for num_sessions in sessions:
+            for label, per_session in [('global lock', False), ('per-session', True)]:
+                elapsed, max_wait = asyncio.run(
+                    run_requests(
+                        num_sessions=num_sessions,
+                        num_requests=requests,
+                        seconds=ms / 1000,
+                        global_every=global_every,
+                        per_session=per_session,
+                    )
+                )
+                total = num_sessions * requests
+                logger.info(
+                    f'{num_sessions} sessions, {label}: '
+                    f'{total / elapsed:.1f} requests/second, '
+                    f'max wait {max_wait * 1000:.0f}ms'
+                )
+
+
+async def run_requests(*, num_sessions, num_requests, seconds, global_every, per_session):
+    locks = SessionLocks()
+    max_wait = 0.0
+
+    async def handle_request(session_code):
+        nonlocal max_wait
+        # acquire() only uses the per-session locks if the DB can run
+        # transactions side by side, so call the 2 modes directly.
+        if session_code and per_session:
+            acquire = locks._acquire_session(session_code)
+        else:
+            acquire = locks._acquire_global()
+        queued_at = time.monotonic()
+        async with acquire:
+            max_wait = max(max_wait, time.monotonic() - queued_at)
+            # the view runs in the threadpool, like a real request
+            await run_in_threadpool(time.sleep, seconds)
+
+    async def run_session(i):
+        for j in range(num_requests):
+            is_global = global_every and (i * num_requests + j) % global_every == 0
+            await handle_request(None if is_global else f'session{i}')
+
+    start = time.monotonic()
+    await asyncio.gather(*[run_session(i) for i in range(num_sessions)])
+    return time.monotonic() - start, max_wait
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+from http.cookiejar import CookieJar
+from urllib.parse import urlencode
+
+from .base import BaseCommand
+
+
+logger = logging.getLogger('otree')
+
+# how often a participant on a wait page reloads it
+# (a browser would get a websocket message instead)
+WAIT_PAGE_POLL_SECONDS = 0.1
+
+
+class Command(BaseCommand):
+    help = (
+        "oTree: Measure how many pages per second a running server handles, "
+        "for several numbers of sessions played at the same time. "
+        "To see how prodserver scales, run it against 'prodserver --workers N' "
+        "for several values of N."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'session_config_name',
+            help="The session config name. Its pages must accept the same form data.",
+        )
+        parser.add_argument(
+            '--url', default='http://127.0.0.1:8000', help="The server's base URL",
+        )
+        parser.add_argument(
+            '--sessions',
+            type=int,
+            nargs='+',
+            default=[1, 4, 8],
+            help="Numbers of concurrent sessions to try",
+        )
+        parser.add_argument(
+            '--participants', type=int, default=1, help="Participants per session",
+        )
+        parser.add_argument(
+            '--data',
+            default='{}',
+            help="JSON of the form data to submit on each page, e.g. '{\"number\": 1}'",
+        )
+
+    def handle(self, session_config_name, url, sessions, participants, data, **kwargs):
+        client = Client(url.rstrip('/'), json.loads(data))
+        for num_sessions in sessions:
+            join_urls = [
+                client.create_session(session_config_name, participants)
+                for _ in range(num_sessions)
+            ]
+            counts = []
+            errors = []
+            threads = [
+                threading.Thread(
+                    target=client.play, args=(join_url, counts, errors), daemon=True
+                )
+                for join_url in join_urls
+                for _ in range(participants)
+            ]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+            for exc in errors[:1]:
+                logger.error(f'{len(errors)} participants failed, e.g.: {exc!r}')
+            num_pages = sum(counts)
+            logger.info(
+                f'{num_sessions} sessions: {num_pages} pages in {elapsed:.1f}s '
+                f'({num_pages / elapsed:.1f} pages/second)'
+            )
+
+
+class Client:
+    def __init__(self, base_url, form_data):
+        self.base_url = base_url
+        self.form_data = urlencode(form_data).encode()
+
+    def create_session(self, session_config_name, num_participants) -> str:
+        """returns the session-wide link"""
+        request = urllib.request.Request(
+            self.base_url + '/api/sessions',
+            data=json.dumps(
+                dict(
+                    session_config_name=session_config_name,
+                    num_participants=num_participants,
+                )
+            ).encode(),
+            headers={'otree-rest-key': os.getenv('OTREE_REST_KEY') or ''},
+        )
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())['session_wide_url']
+
+    def play(self, join_url, counts, errors):
+        # the same cookies for every request, like a browser
+        opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(CookieJar())
+        )
+        num_pages = 0
+        try:
+            url, html = _open(opener, join_url)
+            while '/OutOfRangeNotification/' not in url:
+                if 'otree-wait-page' in html:
+                    time.sleep(WAIT_PAGE_POLL_SECONDS)
+                    url, html = _open(opener, url)
+                    continue
+                next_url, html = _open(opener, url, self.form_data)
+                if next_url == url and 'otree-wait-page' not in html:
+                    raise ValueError(f'The form on {url} was not accepted')
+                url = next_url
+                num_pages += 1
+        except Exception as exc:
+            errors.append(exc)
+        counts.append(num_pages)
+
+
+def _open(opener, url, data=None):
+    # follows the redirect after a page is submitted
+    with opener.open(url, data=data) as response:
+        return response.geturl(), response.read().decode('utf-8')
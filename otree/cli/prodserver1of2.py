@@ -1,6 +1,5 @@
 import logging
 import os
-import subprocess
 
 from .base import BaseCommand
 
@@ -9,28 +8,40 @@ logger = logging.getLogger(__name__)
 print_function = print
 
 
-def run_asgi_server(addr, port, *, is_devserver=False):
-    run_uvicorn(addr, port, is_devserver=is_devserver)
+def run_asgi_server(addr, port, *, is_devserver=False, workers=1):
+    run_uvicorn(addr, port, is_devserver=is_devserver, workers=workers)
 
 
-def run_uvicorn(addr, port, *, is_devserver):
+def run_uvicorn(addr, port, *, is_devserver, workers=1):
     from uvicorn.main import Config, Server
 
-    config = Config(
-        'otree.asgi:app',
-        host=addr,
-        port=int(port),
-        log_level='warning' if is_devserver else "info",
-        log_config=None,  # oTree has its own logger
+    def make_config(**kwargs):
+        return Config(
+            'otree.asgi:app',
+            log_level='warning' if is_devserver else "info",
+            log_config=None,  # oTree has its own logger
+            # websockets library handles disconnects & ping automatically,
+            # so we can simplify code and also avoid H15 errors on heroku.
+            ws='websockets',
+            # ws='wsproto',
+            **kwargs,
+        )
+
+    if workers > 1:
+        from otree.dispatcher import run_workers
+
+        if not os.getenv('DATABASE_URL'):
+            logger.warning(
+                'Running several workers with SQLite. '
+                'Writes from different workers will block each other; '
+                'Postgres is recommended.'
+            )
+        run_workers(addr, port, workers, make_config)
+    else:
         # i suspect it was defaulting to something else
-        workers=1,
-        # websockets library handles disconnects & ping automatically,
-        # so we can simplify code and also avoid H15 errors on heroku.
-        ws='websockets',
-        # ws='wsproto',
-    )
-    server = Server(config=config)
-    server.run()
+        config = make_config(host=addr, port=int(port), workers=1)
+        server = Server(config=config)
+        server.run()
 
 
 def get_addr_port(cli_addrport, is_devserver=False):
@@ -49,11 +60,18 @@ class Command(BaseCommand):
         parser.add_argument(
             'addrport', nargs='?', help='Optional port number, or ipaddr:port'
         )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help=(
+                'Number of server processes (default 1). '
+                'Each session is handled by one of them.'
+            ),
+        )
 
-    def handle(self, *args, addrport=None, verbosity=1, **kwargs):
+    def handle(self, *args, addrport=None, verbosity=1, workers=1, **kwargs):
         addr, port = get_addr_port(addrport)
-        subprocess.Popen(
-            ['otree', 'timeoutsubprocess', str(port)], env=os.environ.copy()
-        )
+        # page timeouts are handled inside the server process (see otree.tasks)
         print_function('Running prodserver')
-        run_asgi_server(addr, port)
+        run_asgi_server(addr, port, workers=workers)
@@ -1,12 +1,14 @@
-# run the worker to enforce page timeouts
-# even if the user closes their browser
+from time import sleep
 from .base import BaseCommand
-from otree.tasks import Worker
 
 
 class Command(BaseCommand):
+    '''legacy: doesn't do anything since page timeouts are handled
+    inside the server process'''
+
     def add_arguments(self, parser):
         parser.add_argument('port', type=int)
 
     def handle(self, *args, port, **options):
-        Worker(port).listen()
+        while True:
+            sleep(10)
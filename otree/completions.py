@@ -0,0 +1,93 @@
+import threading
+from collections import defaultdict
+
+from sqlalchemy import event
+
+from otree.database import db, DBSession
+
+
+class CompletionRegistry:
+    """
+    Remembers which wait pages have been completed
+    (CompletedGroupWaitPage, CompletedSubsessionWaitPage, CompletedGBATWaitPage),
+    because every visit to a wait page and every wait page websocket
+    checks for the completion row.
+    Those rows are never updated or deleted while the session exists,
+    so once we've seen one, we don't need to query it again.
+    A key that isn't in the registry is looked up in the DB.
+
+    Rows are only added after the transaction that created or read them commits,
+    so a completion that is rolled back doesn't get remembered.
+    """
+
+    def __init__(self):
+        # session_id -> set of keys. created on first use.
+        self._completed = defaultdict(set)
+        # session_id -> [DB queries saved, DB queries made]
+        self._counts = defaultdict(lambda: [0, 0])
+        self._lock = threading.Lock()
+
+    def exists(self, Model, session_id, **kwargs) -> bool:
+        key = _make_key(Model, kwargs)
+        counts = self._counts[session_id]
+        if key in self._completed.get(session_id, ()):
+            counts[0] += 1
+            return True
+        counts[1] += 1
+        if Model.objects_exists(session_id=session_id, **kwargs):
+            self._add_after_commit(session_id, key)
+            return True
+        return False
+
+    def add(self, Model, session_id, **kwargs):
+        """call this when creating the row"""
+        self._add_after_commit(session_id, _make_key(Model, kwargs))
+
+    def _add_after_commit(self, session_id, key):
+        db.info.setdefault('otree_pending_completions', []).append((session_id, key))
+
+    def _commit(self, pending):
+        with self._lock:
+            for session_id, key in pending:
+                self._completed[session_id].add(key)
+
+    def invalidate_session(self, session_id):
+        with self._lock:
+            self._completed.pop(session_id, None)
+            self._counts.pop(session_id, None)
+
+    def stats(self):
+        saved = queried = 0
+        for s, q in list(self._counts.values()):
+            saved += s
+            queried += q
+        return dict(
+            saved=saved,
+            queried=queried,
+            size=sum(len(keys) for keys in list(self._completed.values())),
+        )
+
+    def session_stats(self):
+        return {
+            session_id: dict(saved=saved, queried=queried)
+            for session_id, [saved, queried] in list(self._counts.items())
+        }
+
+
+completions = CompletionRegistry()
+
+
+def _make_key(Model, kwargs):
+    return (Model.__name__, *sorted(kwargs.items()))
+
+
+@event.listens_for(DBSession, 'after_commit')
+def _after_commit(session):
+    pending = session.info.pop('otree_pending_completions', None)
+    if pending:
+        completions._commit(pending)
+
+
+@event.listens_for(DBSession, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+    session.info.pop('otree_pending_completions', None)
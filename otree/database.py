@@ -1,11 +1,15 @@
+import asyncio
 import binascii
 import logging
 import os
 import pickle
 import sqlite3
 import sys
+import threading
+import time
 from collections import defaultdict
 from contextlib import contextmanager
+from contextvars import ContextVar
 from decimal import Decimal
 from pathlib import Path
 
@@ -17,12 +21,12 @@ from sqlalchemy import event
 from sqlalchemy import types
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.ext.mutable import Mutable
 from sqlalchemy.orm import (
     mapper,
     relationship,
 )
 from sqlalchemy.orm import sessionmaker, configure_mappers
+from sqlalchemy.orm.attributes import flag_modified, set_committed_value
 from sqlalchemy.orm.exc import NoResultFound  # noqa
 from sqlalchemy.sql import sqltypes as st
 from starlette.exceptions import HTTPException
@@ -35,6 +39,7 @@ from otree.currency import Currency, RealWorldCurrency
 
 logger = logging.getLogger(__name__)
 DB_FILE = 'db.sqlite3'
+SQLITE_BUSY_TIMEOUT_SECONDS = 10
 
 
 # DB_FILE_PATH = Path(DB_FILE)
@@ -44,6 +49,18 @@ def get_disk_conn():
     return sqlite3.connect(DB_FILE, check_same_thread=False)
 
 
+def get_pooled_disk_conn():
+    # IMMEDIATE so that a write transaction takes the lock up front (waiting up to
+    # the timeout). with DEFERRED, upgrading a read to a write in WAL mode can fail
+    # right away with "database is locked".
+    return sqlite3.connect(
+        DB_FILE,
+        check_same_thread=False,
+        isolation_level='IMMEDIATE',
+        timeout=SQLITE_BUSY_TIMEOUT_SECONDS,
+    )
+
+
 def get_mem_conn():
     return sqlite3.connect(':memory:', check_same_thread=False)
 
@@ -81,13 +98,13 @@ class OTreeColumn(sqlalchemy.Column):
     auto_submit_default = None
 
 
+LOAD_CHUNK_SIZE = 10_000
+
+
 def load_in_memory_db():
     old_schema = get_schema(sqlite_disk_conn)
     new_schema = get_schema(sqlite_mem_conn)
 
-    disk_cur = sqlite_disk_conn.cursor()
-    mem_cur = sqlite_mem_conn.cursor()
-
     prev_version = sqlite_disk_conn.execute("PRAGMA user_version").fetchone()[0]
 
     # They should start fresh so that:
@@ -96,25 +113,65 @@ def load_in_memory_db():
     if prev_version != version_for_pragma() and not os.getenv('OTREE_CORE_DEV'):
         sys.exit(f'oTree has been updated. Please delete your database ({DB_FILE})')
 
-    for tblname in new_schema:
-        if tblname in old_schema:
-            # need to quote it, because
-            common_cols = [
-                f'"{c}"' for c in old_schema[tblname] if c in new_schema[tblname]
-            ]
-            common_cols_joined = ', '.join(common_cols)
-            select_cmd = f'SELECT {common_cols_joined} FROM {tblname}'
-            question_marks = ', '.join('?' for _ in common_cols)
-            insert_cmd = (
-                f'INSERT INTO {tblname}({common_cols_joined}) VALUES ({question_marks})'
-            )
-            disk_cur.execute(select_cmd)
-            rows = disk_cur.fetchall()
-            try:
-                mem_cur.executemany(insert_cmd, rows)
-            except sqlite3.IntegrityError as exc:
-                sys.exit(f'An error occurred. Please delete your database ({DB_FILE}).')
-    sqlite_mem_conn.commit()
+    # copy directly inside SQLite, rather than loading every row into Python.
+    sqlite_mem_conn.execute("ATTACH DATABASE ? AS disk", [DB_FILE])
+    stats = []
+    start = time.time()
+    try:
+        for tblname in new_schema:
+            if tblname in old_schema:
+                # need to quote it, because
+                common_cols = [
+                    f'"{c}"' for c in old_schema[tblname] if c in new_schema[tblname]
+                ]
+                table_start = time.time()
+                try:
+                    num_rows = _copy_table(tblname, common_cols)
+                except sqlite3.IntegrityError as exc:
+                    sys.exit(f'An error occurred. Please delete your database ({DB_FILE}).')
+                stats.append((tblname, num_rows, time.time() - table_start))
+        sqlite_mem_conn.commit()
+    finally:
+        sqlite_mem_conn.execute("DETACH DATABASE disk")
+
+    for tblname, num_rows, elapsed in stats:
+        logger.debug(f'Loaded {tblname}: {num_rows} rows in {int(elapsed * 1000)}ms')
+    total_rows = sum(num_rows for _, num_rows, _ in stats)
+    logger.info(
+        f'Loaded {total_rows} rows from {DB_FILE} in {int((time.time() - start) * 1000)}ms'
+    )
+    return stats
+
+
+def _copy_table(tblname, common_cols) -> int:
+    common_cols_joined = ', '.join(common_cols)
+    select_cmd = f'SELECT {common_cols_joined} FROM disk."{tblname}"'
+    try:
+        cur = sqlite_mem_conn.execute(
+            f'INSERT INTO main."{tblname}"({common_cols_joined}) {select_cmd}'
+        )
+        return cur.rowcount
+    except sqlite3.IntegrityError:
+        raise
+    except sqlite3.DatabaseError:
+        # e.g. the column types changed in a way SQLite won't convert in one statement.
+        # fall back to copying through Python, a chunk at a time
+        # so we don't hold the whole table in memory.
+        pass
+    question_marks = ', '.join('?' for _ in common_cols)
+    insert_cmd = (
+        f'INSERT INTO main."{tblname}"({common_cols_joined}) VALUES ({question_marks})'
+    )
+    # separate connection, since we're inserting through sqlite_mem_conn
+    disk_cur = sqlite_disk_conn.cursor()
+    disk_cur.execute(f'SELECT {common_cols_joined} FROM "{tblname}"')
+    num_rows = 0
+    while True:
+        rows = disk_cur.fetchmany(LOAD_CHUNK_SIZE)
+        if not rows:
+            return num_rows
+        sqlite_mem_conn.executemany(insert_cmd, rows)
+        num_rows += len(rows)
 
 
 @contextmanager
@@ -138,22 +195,240 @@ def save_sqlite_db():
     global _dumped
     if _dumped:
         return
+    if snapshotter:
+        snapshotter.stop()
     sqlite_mem_conn.cursor().execute(f"PRAGMA user_version = {version_for_pragma()}")
     sqlite_mem_conn.backup(sqlite_disk_conn)
     _dumped = True
 
 
+# seconds between snapshots of the in-memory DB. 0 means only save on shutdown.
+SNAPSHOT_INTERVAL = float(os.getenv('OTREE_SNAPSHOT_INTERVAL') or 0)
+# ~1MB per step with the default page size; copying that takes well under 1ms,
+# and that's the longest a request needs to wait for the in-memory connection.
+SNAPSHOT_PAGES_PER_STEP = 256
+# pause between steps, so that requests can use the in-memory connection
+# (and the GIL) in the meantime.
+SNAPSHOT_STEP_SLEEP = 0.005
+
+
+class SQLiteSnapshotter:
+    """
+    Periodically copies the in-memory DB to disk, so that a crash
+    doesn't lose the whole session.
+    Runs in a background thread and copies a few pages at a time,
+    pausing after each step, so the event loop is never blocked by a large backup.
+    Each step holds the global request lock, so it runs between transactions.
+    """
+
+    def __init__(self, interval, acquire_lock=None):
+        self.interval = interval
+        # keeps requests out of the in-memory connection during a backup step,
+        # so a step never runs in the middle of a request's transaction.
+        # it returns a function that releases the lock,
+        # or None if we are stopping in the meantime.
+        self.acquire_lock = acquire_lock
+        self.num_snapshots = 0
+        self.num_failed = 0
+        self.last_duration = None
+        self.last_size_bytes = None
+        self.last_finished = None
+        self.max_step_duration = 0.0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='otree-db-snapshot', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            # if a snapshot is in progress, let it finish
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.take_snapshot()
+            except _SnapshotStopped:
+                pass
+            except Exception as exc:
+                # don't raise, because then the thread would die
+                self.num_failed += 1
+                logger.exception(repr(exc))
+
+    def take_snapshot(self):
+        start = time.time()
+        disk_conn = get_disk_conn()
+        try:
+            self._backup_to(disk_conn)
+            # set it on the copy, so we don't touch the live connection
+            disk_conn.execute(f"PRAGMA user_version = {version_for_pragma()}")
+            disk_conn.commit()
+            [page_count] = disk_conn.execute("PRAGMA page_count").fetchone()
+            [page_size] = disk_conn.execute("PRAGMA page_size").fetchone()
+        finally:
+            disk_conn.close()
+        self.num_snapshots += 1
+        self.last_finished = time.time()
+        self.last_duration = self.last_finished - start
+        self.last_size_bytes = page_count * page_size
+        logger.debug(
+            f'DB snapshot #{self.num_snapshots}: '
+            f'{self.last_size_bytes} bytes in {int(self.last_duration * 1000)}ms'
+        )
+
+    def _backup_to(self, disk_conn):
+        release = self._acquire_lock()
+        step_start = time.time()
+
+        def between_steps(status, remaining, total):
+            nonlocal release, step_start
+            self.max_step_duration = max(
+                self.max_step_duration, time.time() - step_start
+            )
+            if not remaining:
+                return
+            # backup()'s sleep argument is only used when a step is blocked
+            # (SQLITE_BUSY/LOCKED), so the steps would otherwise run back to back.
+            release()
+            release = None
+            time.sleep(SNAPSHOT_STEP_SLEEP)
+            release = self._acquire_lock()
+            step_start = time.time()
+
+        try:
+            # requests that commit between steps write through the same connection,
+            # so SQLite applies their changes to the copy too,
+            # and the snapshot is consistent as of the last step.
+            sqlite_mem_conn.backup(
+                disk_conn, pages=SNAPSHOT_PAGES_PER_STEP, progress=between_steps
+            )
+        finally:
+            if release:
+                release()
+
+    def _acquire_lock(self):
+        if self.acquire_lock is None:
+            return _no_lock
+        release = self.acquire_lock(self._stop_event)
+        if release is None:
+            # the partial copy is overwritten by save_sqlite_db()
+            raise _SnapshotStopped
+        return release
+
+    def stats(self):
+        return dict(
+            snapshots=self.num_snapshots,
+            failed=self.num_failed,
+            last_duration_ms=_ms_or_none(self.last_duration),
+            last_size_bytes=self.last_size_bytes,
+            seconds_since_last=(
+                int(time.time() - self.last_finished) if self.last_finished else None
+            ),
+            # the longest the DB was unavailable to requests because of a snapshot
+            max_step_ms=_ms_or_none(self.max_step_duration),
+        )
+
+
+class _SnapshotStopped(Exception):
+    pass
+
+
+def _no_lock():
+    pass
+
+
+def _ms_or_none(seconds):
+    return None if seconds is None else int(seconds * 1000)
+
+
+snapshotter: SQLiteSnapshotter = None
+
+
+def start_sqlite_snapshots():
+    global snapshotter
+    if IN_MEMORY and SNAPSHOT_INTERVAL and not os.getenv('OTREE_EPHEMERAL'):
+        from otree.middleware import session_locks
+
+        loop = asyncio.get_event_loop()
+        snapshotter = SQLiteSnapshotter(
+            SNAPSHOT_INTERVAL,
+            acquire_lock=lambda stop_event: session_locks.acquire_global_from_thread(
+                loop, stop_event
+            ),
+        )
+        snapshotter.start()
+
+
 DeclarativeBase = declarative_base()
 
 
+# only used when the engine has a real connection pool.
+# a ContextVar rather than a thread-local, because the middleware and the view
+# run in different threads (run_in_threadpool copies the context).
+_scoped_db: ContextVar = ContextVar('otree_db_session', default=None)
+
+
+BULK_INSERT_CHUNK_SIZE = 5000
+
+
+def _session_for_empty_context():
+    '''
+    With a connection pool, there's no session until something binds one.
+    A command line script (e.g. 'otree create_session') just uses the DB
+    from its main thread, so it gets one that lasts as long as the process,
+    like the shared session we use without a pool.
+    Anywhere else (a thread, an executor job, a task on the server's event loop),
+    nothing would close a session we created here, so it would keep
+    a pooled connection checked out indefinitely.
+    '''
+    if threading.current_thread() is not threading.main_thread() or _loop_is_running():
+        raise RuntimeError(
+            'No DB session in this context. Wrap the code in session_scope().'
+        )
+    session = create_session()
+    _scoped_db.set(session)
+    return session
+
+
+def _loop_is_running():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
 class DBWrapper:
     """
     1. this way we can defer definining the ._db attribute
     until all modules are imported
     2. we can add helper methods
+    3. with a connection pool, each request/websocket event gets its own
+    session, so requests for different oTree sessions don't share a transaction.
     """
 
-    _db: sqlalchemy.orm.Session = None
+    _shared_db: sqlalchemy.orm.Session = None
+
+    @property
+    def _db(self) -> sqlalchemy.orm.Session:
+        if supports_concurrent_sessions():
+            session = _scoped_db.get()
+            if session is None:
+                session = _session_for_empty_context()
+            return session
+        return self._shared_db
+
+    @_db.setter
+    def _db(self, value):
+        if supports_concurrent_sessions():
+            _scoped_db.set(value)
+        else:
+            self._shared_db = value
 
     def query(self, *args, **kwargs):
         return self._db.query(*args, **kwargs)
@@ -167,6 +442,23 @@ class DBWrapper:
     def delete(self, obj):
         return self._db.delete(obj)
 
+    def bulk_insert(self, Model, rows):
+        """
+        Insert dicts with executemany, in chunks,
+        without creating ORM objects or touching the identity map.
+        Python-side column defaults are still applied.
+        All rows must have the same keys.
+        """
+        insert = Model.__table__.insert()
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == BULK_INSERT_CHUNK_SIZE:
+                self._db.execute(insert, chunk)
+                chunk = []
+        if chunk:
+            self._db.execute(insert, chunk)
+
     def get_or_404(self, Model, msg='Not found', **kwargs):
         try:
             return self.query(Model).filter_by(**kwargs).one()
@@ -188,14 +480,33 @@ class DBWrapper:
         return self._db.close()
 
     def new_session(self):
-        if os.getenv('OTREE_EPHEMERAL'):
-            self._db = DBSession(bind=ephemeral_connection)
-        else:
-            self._db = DBSession()
+        self._db = create_session()
+
+    @contextmanager
+    def use_session(self, session):
+        """
+        makes db.query() etc. use this session inside the block.
+        for code that keeps its own session over several calls,
+        e.g. a download that is streamed after the request has finished.
+        """
+        prev = self._db
+        self._db = session
+        try:
+            yield
+        finally:
+            self._db = prev
 
     def expire_all(self):
         self._db.expire_all()
 
+    @property
+    def info(self) -> dict:
+        return self._db.info
+
+    def identity_map_get(self, Model, pk):
+        """returns the object if it's already loaded, without querying"""
+        return self._db.identity_map.get(sqlalchemy.orm.util.identity_key(Model, pk))
+
 
 db = DBWrapper()
 dbq = db.query
@@ -208,8 +519,17 @@ dbq = db.query
 
 IN_MEMORY = bool(os.getenv('OTREE_IN_MEMORY'))
 
+# by default there is a single shared connection.
+# set OTREE_DB_POOL_SIZE to use a connection pool instead
+# (e.g. Postgres in production), so that requests for different sessions
+# can run at the same time. it doesn't apply to the in-memory DB.
+DB_POOL_SIZE = int(os.getenv('OTREE_DB_POOL_SIZE') or 0)
+DB_POOL_MAX_OVERFLOW = int(os.getenv('OTREE_DB_POOL_MAX_OVERFLOW') or 0)
+DB_POOL_RECYCLE = int(os.getenv('OTREE_DB_POOL_RECYCLE') or 1800)
+
 
 def get_engine():
+    use_pool = DB_POOL_SIZE > 0 and not IN_MEMORY
     if IN_MEMORY:
         engine = create_engine(
             'sqlite://',
@@ -220,30 +540,57 @@ def get_engine():
     else:
         DATABASE_URL = os.getenv('DATABASE_URL', f'sqlite:///{DB_FILE}')
         kwargs = {}
-        if DATABASE_URL.startswith('sqlite'):
-            kwargs['creator'] = lambda: sqlite_disk_conn
-        engine = create_engine(
-            DATABASE_URL,
-            poolclass=sqlalchemy.pool.StaticPool,
-            **kwargs,
-        )
+        if use_pool:
+            kwargs.update(
+                poolclass=sqlalchemy.pool.QueuePool,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_POOL_MAX_OVERFLOW,
+                pool_recycle=DB_POOL_RECYCLE,
+                pool_pre_ping=True,
+            )
+            if DATABASE_URL.startswith('sqlite'):
+                kwargs['creator'] = get_pooled_disk_conn
+        else:
+            kwargs['poolclass'] = sqlalchemy.pool.StaticPool
+            if DATABASE_URL.startswith('sqlite'):
+                kwargs['creator'] = lambda: sqlite_disk_conn
+        engine = create_engine(DATABASE_URL, **kwargs)
     if engine.url.get_backend_name() == 'sqlite':
         # https://stackoverflow.com/questions/2614984/sqlite-sqlalchemy-how-to-enforce-foreign-keys
         from sqlalchemy import event
 
-        event.listen(
-            engine, 'connect', lambda c, _: c.execute('pragma foreign_keys=on')
-        )
+        def on_connect(conn, _):
+            conn.execute('pragma foreign_keys=on')
+            if use_pool:
+                # WAL lets readers proceed while another connection is writing.
+                conn.execute('pragma journal_mode=wal')
+
+        event.listen(engine, 'connect', on_connect)
     return engine
 
 
 engine = get_engine()
 
+
+def supports_concurrent_sessions():
+    '''
+    with a single shared connection, transactions can't overlap,
+    so requests for different sessions still need to be serialized.
+    '''
+    return not isinstance(engine.pool, sqlalchemy.pool.StaticPool)
+
+
 DBSession = sessionmaker(bind=engine)
 
 ephemeral_connection = None
 
 
+def create_session() -> sqlalchemy.orm.Session:
+    if os.getenv('OTREE_EPHEMERAL'):
+        return DBSession(bind=ephemeral_connection)
+    return DBSession()
+
+
 class VarsDescriptor:
     def __init__(self, attr):
         self.attr = attr
@@ -301,6 +648,7 @@ def init_orm():
     import otree.models_concrete  # noqa
 
     configure_mappers()
+    check_vars_column_type()
     AnyModel.metadata.create_all(engine)
 
     if (
@@ -311,7 +659,11 @@ def init_orm():
     ):
         load_in_memory_db()
 
-    db.new_session()
+    if not supports_concurrent_sessions():
+        db.new_session()
+    # otherwise, don't bind a session here, because every task and thread
+    # started from the main thread would inherit it and share it.
+    # (see _session_for_empty_context)
 
 
 class AnyModel(DeclarativeBase):
@@ -547,17 +899,112 @@ def make_get_display_dynamic(name):
     return get_FIELD_display
 
 
-class VarsDict(Mutable, dict):
-    @classmethod
-    def coerce(cls, key, value):
-        if not isinstance(value, VarsDict):
-            if isinstance(value, dict):
-                return VarsDict(value)
+# values of these types can't be mutated in place, so reading them is safe
+_IMMUTABLE_VARS_TYPES = (str, int, float, bytes, Decimal, type(None))
+
+
+def _is_mutable(value):
+    return not isinstance(value, _IMMUTABLE_VARS_TYPES)
+
 
-            # this call will raise ValueError
-            return Mutable.coerce(key, value)
+class VarsDict(dict):
+    """
+    Marks the owner's _vars column as modified only when the dict is changed,
+    so a request that just reads participant.vars doesn't trigger an UPDATE.
+
+    A mutable value (e.g. a list) can be changed in place without going through
+    the dict, e.g. participant.vars['history'].append(x), or through a copy
+    or dict(participant.vars). So if the dict holds any mutable values,
+    at commit we re-pickle it and compare to what was loaded,
+    and the row is written only if they differ.
+    """
+
+    # a strong reference, so that the owner (and the change flag) isn't lost
+    # if the caller only keeps the dict, e.g. Participant.objects_get(...).vars
+    _owner = None
+    # the encoded value this was loaded from
+    _raw = None
+    # holds a mutable value, but the owner wasn't in a DB session yet
+    _needs_watch = False
+
+    def _set_owner(self, owner, raw=None):
+        self._owner = owner
+        self._raw = raw
+        if any(_is_mutable(value) for value in super().values()):
+            self._watch()
+
+    def _changed(self):
+        if self._owner is not None:
+            flag_modified(self._owner, '_vars')
+
+    def _watch(self):
+        owner = self._owner
+        session = owner and sqlalchemy.orm.object_session(owner)
+        if session is None:
+            self._needs_watch = True
         else:
-            return value
+            self._needs_watch = False
+            session.info.setdefault('otree_vars_to_check', {})[id(self)] = self
+
+    def _changed_to(self, values):
+        self._changed()
+        if any(_is_mutable(value) for value in values):
+            # so that in-place changes after the next flush are still saved
+            self._watch()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            super().__setitem__(key, default)
+            self._changed_to([default])
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed_to([value])
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        super().update(other)
+        self._changed_to(other.values())
+
+    def pop(self, key, *args):
+        if key not in self:
+            # raises KeyError or returns the default
+            return super().pop(key, *args)
+        value = super().pop(key)
+        self._changed()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._changed()
+        return item
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+
+# before_commit runs before the commit's flush, so a change found here
+# is still written. we don't need to check at every autoflush.
+@event.listens_for(DBSession, 'before_commit')
+def _before_commit(session):
+    for vars_dict in session.info.pop('otree_vars_to_check', {}).values():
+        if encode_vars(vars_dict) != vars_dict._raw:
+            vars_dict._changed()
+
+
+@event.listens_for(DBSession, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('otree_vars_to_check', None)
 
 
 class _PickleField(types.TypeDecorator):
@@ -570,13 +1017,148 @@ class _PickleField(types.TypeDecorator):
         return pickle.loads(binascii.a2b_base64(value.encode('utf-8')))
 
 
+# 'OTV' + 1 version byte, then the pickle.
+# protocol 4 rather than HIGHEST_PROTOCOL so the DB file stays readable
+# if it's copied to a machine with an older Python.
+VARS_MAGIC = b'OTV'
+VARS_FORMAT_VERSION = 1
+VARS_PICKLE_PROTOCOL = 4
+
+
+def encode_vars(value: dict) -> bytes:
+    return (
+        VARS_MAGIC
+        + bytes([VARS_FORMAT_VERSION])
+        + pickle.dumps(dict(value), protocol=VARS_PICKLE_PROTOCOL)
+    )
+
+
+def decode_vars(value) -> dict:
+    if isinstance(value, str):
+        # a TEXT column (see VARS_AS_TEXT), or a row from before the binary format.
+        # either way it's base64.
+        value = binascii.a2b_base64(value.encode('utf-8'))
+    else:
+        # postgres returns a memoryview
+        value = bytes(value)
+        if value[:3] != VARS_MAGIC:
+            # base64 text that ended up in a BLOB column,
+            # e.g. copied by load_in_memory_db
+            value = binascii.a2b_base64(value)
+    if value[:3] == VARS_MAGIC:
+        version = value[3]
+        if version != VARS_FORMAT_VERSION:
+            raise ValueError(f'Unsupported vars format version: {version}')
+        return pickle.loads(value[4:])
+    # from before the binary format: just the pickle
+    return pickle.loads(value)
+
+
+def raw_vars_bytes(value) -> bytes:
+    """the column value as encode_vars() would have returned it"""
+    if isinstance(value, str):
+        return binascii.a2b_base64(value.encode('utf-8'))
+    return bytes(value)
+
+
+# set at startup if the DB's _vars columns are TEXT (see check_vars_column_type)
+VARS_AS_TEXT = False
+
+
+def check_vars_column_type():
+    """
+    A DB created before the binary format has TEXT _vars columns.
+    SQLite will store bytes in those anyway, but e.g. Postgres won't,
+    so in that case we keep storing vars as base64 text.
+    This needs to run before the first query that uses the columns,
+    because SQLAlchemy caches the column type per dialect.
+    """
+    global VARS_AS_TEXT
+    if engine.url.get_backend_name() == 'sqlite':
+        return
+    from otree.models import Participant, Session
+
+    inspector = sqlalchemy.inspect(engine)
+    table_names = inspector.get_table_names()
+    is_text = [
+        isinstance(column['type'], st.String)
+        for Model in [Participant, Session]
+        if Model.__tablename__ in table_names
+        for column in inspector.get_columns(Model.__tablename__)
+        if column['name'] == '_vars'
+    ]
+    if not any(is_text):
+        return
+    if not all(is_text):
+        sys.exit(
+            'The _vars columns in your database have different types. '
+            'Please run "otree resetdb".'
+        )
+    VARS_AS_TEXT = True
+    logger.warning(
+        'Your database was created by an older version of oTree, '
+        'so participant and session vars will be stored as text. '
+        'To use the more compact binary format, run "otree resetdb" '
+        '(this deletes all data).'
+    )
+
+
+class _VarsField(types.TypeDecorator):
+    """
+    Result values are passed through undecoded;
+    MixinVars.vars unpickles them the first time they are accessed,
+    so loading a participant for a page that never uses vars is cheap.
+    """
+
+    impl = types.LargeBinary
+
+    def load_dialect_impl(self, dialect):
+        if VARS_AS_TEXT:
+            return dialect.type_descriptor(types.Text())
+        return dialect.type_descriptor(types.LargeBinary())
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, dict):
+            # still undecoded, e.g. a legacy base64 row.
+            value = decode_vars(value)
+        encoded = encode_vars(value)
+        if isinstance(value, VarsDict):
+            # what's in the DB now, for the next comparison in _before_commit
+            value._raw = encoded
+        if VARS_AS_TEXT:
+            return binascii.b2a_base64(encoded).decode('utf-8')
+        return encoded
+
+    def process_result_value(self, value, dialect):
+        return value
+
+
 class MixinVars:
-    _vars = Column(VarsDict.as_mutable(_PickleField), default=VarsDict)
+    _vars = Column(_VarsField, default=VarsDict)
 
     @property
     def vars(self):
-        self._vars.changed()
-        return self._vars
+        value = self._vars
+        if not isinstance(value, VarsDict):
+            if value is None:
+                # not flushed yet, so the column default hasn't been applied
+                value = VarsDict()
+                self._vars = value
+                value._set_owner(self)
+            else:
+                raw = value
+                value = VarsDict(decode_vars(raw))
+                # replace the raw value without marking the attribute as changed
+                set_committed_value(self, '_vars', value)
+                value._set_owner(self, raw=raw_vars_bytes(raw))
+        elif value._owner is None:
+            # created by the column default during flush
+            value._set_owner(self, raw=value._raw)
+        elif value._needs_watch:
+            value._watch()
+        return value
 
 
 AUTO_SUBMIT_DEFAULTS = {
@@ -0,0 +1,292 @@
+import asyncio
+import functools
+import logging
+import os
+import re
+import signal
+import socket
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+from otree.channels.broker import ChannelBroker
+
+logger = logging.getLogger(__name__)
+
+# session & participant codes, from random_chars_8()
+CODE_RE = re.compile(r'^[a-z0-9]{8}$')
+# so that random URLs (e.g. from bots scanning the server) can't fill up memory
+MAX_CACHED_CODES = 100_000
+# how long we remember which session a code or session_pk belongs to.
+# sessions can be deleted, and then a session_pk can be reused,
+# so entries can't be kept forever. this runs in a separate process
+# from the workers, so it can't be told when a session is deleted.
+DISPATCH_CACHE_SECONDS = int(os.getenv('OTREE_DISPATCH_CACHE_SECONDS') or 300)
+MAX_HEAD_SIZE = 2 ** 16
+PIPE_CHUNK_SIZE = 2 ** 16
+# /room/{room_name}, etc.
+ROOM_PATHS = ('room', 'room_without_session', 'room_with_session', 'CloseRoom')
+# hop-by-hop headers we replace, so that each request is routed separately
+CONNECTION_HEADERS = (b'connection:', b'keep-alive:')
+
+
+def route_key(target: str):
+    """
+    Finds what a request is about, from its path & query string.
+    Returns ('session_code', code), ('session_pk', pk), ('code', code)
+    (a session or participant code), ('anonymous_code', code),
+    ('room', room_name), or None.
+    """
+    url = urlsplit(target)
+    query = parse_qs(url.query)
+    for name in ['session_code', 'session_pk', 'participant_code']:
+        if name in query:
+            value = query[name][0]
+            if name == 'session_pk':
+                return (name, int(value)) if value.isdigit() else None
+            return ('session_code' if name == 'session_code' else 'code', value)
+    # the room participant's websocket
+    if 'room_name' in query:
+        return ('room', query['room_name'][0])
+    segments = url.path.strip('/').split('/')
+    if len(segments) == 2:
+        if segments[0] in ROOM_PATHS:
+            return ('room', segments[1])
+        if segments[0] == 'join':
+            return ('anonymous_code', segments[1])
+    # e.g. /p/{code}/..., /SessionMonitor/{code}, /api/sessions/{code}
+    index = 2 if segments[0] == 'api' else 1
+    if len(segments) > index and CODE_RE.match(segments[index]):
+        return ('code', segments[index])
+    return None
+
+
+def worker_for_session(session_code: Optional[str], num_workers: int) -> int:
+    """session_code can also be the name of a room that has no session"""
+    if not session_code:
+        return 0
+    return zlib.crc32(session_code.encode()) % num_workers
+
+
+def _lookup_session_code(kind, value) -> Optional[str]:
+    from otree.database import session_scope
+    from otree.models import Participant, Session
+    from otree.models_concrete import RoomToSession
+
+    with session_scope():
+        if kind == 'session_pk':
+            session = Session.objects_filter(id=value).first()
+            return session.code if session else None
+        if kind == 'anonymous_code':
+            session = Session.objects_filter(_anonymous_code=value).first()
+            return session.code if session else None
+        if kind == 'room':
+            room_to_session = RoomToSession.objects_filter(room_name=value).first()
+            return room_to_session.session.code if room_to_session else None
+        if Session.objects_exists(code=value):
+            return value
+        participant = Participant.objects_filter(code=value).first()
+        return participant._session_code if participant else None
+
+
+class SessionDispatcher:
+    """
+    Front server for running several worker processes.
+    All requests for a session go to the same worker (chosen by hashing the
+    session code), so that each worker's in-process locks and caches
+    see everything that happens in its sessions.
+    Room links and /join/ links go to the worker of the room's or link's session.
+    A room without a session goes to a worker chosen by the room name,
+    which keeps track of who is waiting in the room.
+    Other requests that aren't for a particular session (admin pages, REST)
+    go to the first worker. When they change state that other workers
+    keep in memory (e.g. deleting sessions), they tell the other workers
+    through the channel broker.
+
+    To measure it, run 'otree benchmark_server' against
+    'otree prodserver --workers N' for several values of N.
+
+    It's a plain TCP proxy that only looks at the request line,
+    and sets 'Connection: close' so that the next request on the connection
+    is routed again. Websocket connections are passed through unchanged.
+    """
+
+    def __init__(self, worker_paths):
+        self.worker_paths = worker_paths
+        self._session_codes = {}
+        # asyncio only keeps weak references to tasks
+        self._connections = set()
+        # the DB connection isn't meant to be shared across threads
+        self._db_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def resolve(self, key) -> Optional[str]:
+        if key is None:
+            return None
+        if key[0] == 'session_code':
+            return key[1]
+        if key[0] == 'room':
+            # not cached, because a room's session changes when the admin
+            # creates a session in it or closes it.
+            session_code = await asyncio.get_event_loop().run_in_executor(
+                self._db_executor, _lookup_session_code, *key
+            )
+            # the room's presence counts are kept in the worker that gets
+            # the room's requests, so a room without a session still needs
+            # a fixed worker.
+            return session_code or key[1]
+        now = time.monotonic()
+        cached = self._session_codes.get(key)
+        if cached and cached[1] > now:
+            return cached[0]
+        session_code = await asyncio.get_event_loop().run_in_executor(
+            self._db_executor, _lookup_session_code, *key
+        )
+        # unknown codes aren't cached, because the session might be created
+        # right after (e.g. a session_pk that doesn't exist yet).
+        if session_code:
+            if len(self._session_codes) > MAX_CACHED_CODES:
+                self._session_codes.clear()
+            self._session_codes[key] = (session_code, now + DISPATCH_CACHE_SECONDS)
+        return session_code
+
+    async def handle(self, client_reader, client_writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        upstream_writer = None
+        try:
+            try:
+                head = await client_reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            request_line, _, header_block = head.partition(b'\r\n')
+            try:
+                target = request_line.split(b' ')[1].decode('latin-1')
+                key = route_key(target)
+            except (IndexError, ValueError):
+                key = None
+            session_code = await self.resolve(key)
+            path = self.worker_paths[
+                worker_for_session(session_code, len(self.worker_paths))
+            ]
+
+            headers = header_block[:-4].split(b'\r\n') if header_block[:-4] else []
+            is_upgrade = any(h.lower().startswith(b'upgrade:') for h in headers)
+            if not is_upgrade:
+                headers = [
+                    h for h in headers if not h.lower().startswith(CONNECTION_HEADERS)
+                ]
+                headers.append(b'Connection: close')
+
+            upstream_reader, upstream_writer = await asyncio.open_unix_connection(path)
+            upstream_writer.write(b'\r\n'.join([request_line, *headers, b'', b'']))
+            to_upstream = asyncio.ensure_future(
+                _pipe(client_reader, upstream_writer, write_eof=True)
+            )
+            await _pipe(upstream_reader, client_writer)
+            to_upstream.cancel()
+        except Exception as exc:
+            logger.warning(f'dispatcher: {exc!r}')
+        finally:
+            for writer in [upstream_writer, client_writer]:
+                if writer is not None:
+                    writer.close()
+            self._connections.discard(task)
+
+
+async def _pipe(reader, writer, write_eof=False):
+    try:
+        while True:
+            data = await reader.read(PIPE_CHUNK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        if write_eof and writer.can_write_eof():
+            writer.write_eof()
+    except ConnectionError:
+        pass
+
+
+def _run_worker(config, sockets):
+    # runs in a new process, so it needs to load the project again
+    from uvicorn.main import Server
+    from otree.main import setup
+
+    setup()
+    Server(config=config).run(sockets=sockets)
+
+
+def run_workers(addr, port, num_workers, make_config):
+    """
+    make_config() returns the uvicorn Config for the workers.
+    Each worker listens on its own Unix socket, and this process
+    runs the dispatcher and the channel broker.
+    """
+    from uvicorn.subprocess import get_subprocess
+
+    tmpdir = tempfile.mkdtemp()
+    broker_path = os.path.join(tmpdir, 'channels.sock')
+    # inherited by the worker processes
+    os.environ['OTREE_CHANNEL_BROKER'] = broker_path
+    os.environ['OTREE_NUM_WORKERS'] = str(num_workers)
+
+    config = make_config()
+    worker_paths = []
+    sockets = []
+    for i in range(num_workers):
+        path = os.path.join(tmpdir, f'worker{i}.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.set_inheritable(True)
+        worker_paths.append(path)
+        sockets.append(sock)
+
+    def start_worker(i):
+        os.environ['OTREE_WORKER_INDEX'] = str(i)
+        process = get_subprocess(
+            config=config,
+            target=functools.partial(_run_worker, config),
+            sockets=[sockets[i]],
+        )
+        process.start()
+        return process
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        stop = asyncio.Event()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(sig, stop.set)
+
+        broker = ChannelBroker(broker_path)
+        broker_task = loop.create_task(broker.serve())
+
+        dispatcher = SessionDispatcher(worker_paths)
+        server = await asyncio.start_server(
+            dispatcher.handle, host=addr, port=int(port), limit=MAX_HEAD_SIZE
+        )
+        processes = [start_worker(i) for i in range(num_workers)]
+        logger.info(f'Dispatching to {num_workers} workers on http://{addr}:{port}')
+
+        while not stop.is_set():
+            for i, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.error(f'Worker {i} exited; restarting it')
+                    processes[i] = start_worker(i)
+            try:
+                await asyncio.wait_for(stop.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+
+        server.close()
+        for process in processes:
+            process.terminate()
+        # in a thread, so that the connections to the workers can close cleanly
+        # in the meantime.
+        for process in processes:
+            await loop.run_in_executor(None, process.join)
+        broker_task.cancel()
+
+    asyncio.run(main())
@@ -5,7 +5,7 @@ import numbers
 from collections import OrderedDict
 from collections import defaultdict
 from html import escape
-from typing import List
+from io import StringIO
 
 from sqlalchemy.sql.functions import func
 
@@ -20,12 +20,24 @@ from otree.models.participant import Participant
 from otree.models.player import BasePlayer
 from otree.models.session import Session
 from otree.models.subsession import BaseSubsession
-from otree.models_concrete import PageTimeBatch
+from otree.models_concrete import ChatMessage, PageTimeBatch
 from otree.session import SessionConfig
 from otree import settings
 
 logger = logging.getLogger(__name__)
 
+# the iter_export_* functions yield the CSV in pieces of about this many characters
+CSV_CHUNK_SIZE = 64 * 1024
+# number of participants the wide CSV loads at a time
+WIDE_CSV_CHUNK_SIZE = 100
+# the page times and chat exports load their rows in batches of this many.
+# each batch is a separate query rather than 1 query with yield_per(),
+# so that an export that is being streamed doesn't keep a cursor open
+# while other requests use the DB.
+# (a PageTimeBatch holds many rows of text)
+PAGE_TIMES_BATCH_SIZE = 100
+CHAT_BATCH_SIZE = 1000
+
 
 def inspect_field_names(Model):
     return [f.name for f in Model.__table__.columns]
@@ -135,6 +147,9 @@ def sanitize_for_csv(value):
     return value.replace('\n', ' ').replace('\r', ' ')
 
 
+PLAYER_PROPERTY_COLUMNS = {'payoff': '_payoff', 'role': '_role'}
+
+
 def tweak_player_values_dict(player: dict, group_id_in_subsession=None):
     '''because these are actually properties, the DB field starts with _.'''
     player['payoff'] = player['_payoff']
@@ -184,6 +199,13 @@ def _get_best_app_order(sessions):
 
 
 def get_rows_for_wide_csv(session_code):
+    """
+    Yields the rows of the wide CSV.
+    Participants are processed in chunks of WIDE_CSV_CHUNK_SIZE,
+    and each app's players, groups, and subsessions for a chunk
+    are loaded with 1 query each, so memory doesn't grow with
+    the total number of participants.
+    """
     if session_code:
         sessions = [Session.objects_get(code=session_code)]
     else:
@@ -192,11 +214,6 @@ def get_rows_for_wide_csv(session_code):
     participant_fields = get_fields_for_csv(Participant)
 
     session_ids = [session.id for session in sessions]
-    pps = (
-        Participant.objects_filter(Participant.session_id.in_(session_ids))
-        .order_by(Participant.id)
-        .all()
-    )
     session_cache = {row.id: row for row in sessions}
 
     session_config_fields = {'name'}
@@ -205,25 +222,17 @@ def get_rows_for_wide_csv(session_code):
             session_config_fields.add(field_name)
     session_config_fields = list(session_config_fields)
 
-    if not pps:
+    pp_query = Participant.objects_filter(Participant.session_id.in_(session_ids))
+    if not pp_query.first():
         # 1 empty row
-        return [[]]
+        yield []
+        return
 
     header_row = [f'participant.{fname}' for fname in participant_fields]
     header_row += [f'participant.{fname}' for fname in settings.PARTICIPANT_FIELDS]
     header_row += [f'session.{fname}' for fname in session_fields]
     header_row += [f'session.config.{fname}' for fname in session_config_fields]
     header_row += [f'session.{fname}' for fname in settings.SESSION_FIELDS]
-    rows = [header_row]
-
-    for pp in pps:
-        session = session_cache[pp.session_id]
-        row = [getattr(pp, fname) for fname in participant_fields]
-        row += [pp.vars.get(fname, None) for fname in settings.PARTICIPANT_FIELDS]
-        row += [getattr(session, fname) for fname in session_fields]
-        row += [session.config.get(fname) for fname in session_config_fields]
-        row += [session.vars.get(fname, None) for fname in settings.SESSION_FIELDS]
-        rows.append(row)
 
     order_of_apps = _get_best_app_order(sessions)
 
@@ -246,73 +255,135 @@ def get_rows_for_wide_csv(session_code):
 
         if highest_round_number is not None:
             rounds_per_app[app_name] = highest_round_number
-    for app_name in rounds_per_app:
-        for round_number in range(1, rounds_per_app[app_name] + 1):
-            new_rows = get_rows_for_wide_csv_round(app_name, round_number, sessions)
-            for i in range(len(rows)):
-                rows[i].extend(new_rows[i])
 
-    return [[sanitize_for_csv(v) for v in row] for row in rows]
-
-
-def get_rows_for_wide_csv_round(app_name, round_number, sessions: List[Session]):
-
-    models_module = otree.common.get_main_module(app_name)
-    Player: BasePlayer = models_module.Player
-    Group: BaseGroup = models_module.Group
-    Subsession: BaseSubsession = models_module.Subsession
-    pfields = get_fields_for_csv(Player)
-    gfields = get_fields_for_csv(Group)
-    sfields = get_fields_for_csv(Subsession)
-
-    rows = []
-    group_cache = {
-        row['id']: row for row in Group.values_dicts(round_number=round_number)
-    }
-
-    header_row = []
-    for model_name, fields in [
-        ('player', pfields),
-        ('group', gfields),
-        ('subsession', sfields),
-    ]:
-        for fname in fields:
-            header_row.append(f'{app_name}.{round_number}.{model_name}.{fname}')
-    rows.append(header_row)
-    empty_row = ['' for _ in range(len(header_row))]
-
-    for session in sessions:
-        subsessions = Subsession.values_dicts(
-            session_id=session.id, round_number=round_number
+    app_columns = [
+        _WideCsvAppColumns(app_name, num_rounds, session_ids)
+        for app_name, num_rounds in rounds_per_app.items()
+    ]
+    for columns in app_columns:
+        header_row += columns.header_row()
+    yield header_row
+
+    last_id = 0
+    while True:
+        pps = (
+            pp_query.filter(Participant.id > last_id)
+            .order_by(Participant.id)
+            .limit(WIDE_CSV_CHUNK_SIZE)
+            .all()
         )
-        if not subsessions:
-            subsession_rows = [empty_row for _ in range(session.num_participants)]
-        else:
-            [subsession] = subsessions
-            players = Player.values_dicts(subsession_id=subsession['id'], order_by='id')
-
-            if len(players) != session.num_participants:
-                raise AssertionError((
-                    f"Session {session.code} has {session.num_participants} participants, "
-                    f"but round {round_number} of app '{app_name}' "
-                    f"has {len(players)} players. The number of players in the subsession "
-                    "should always match the number of players in the session. "
-                    "Please report this issue and then reset the database."
-                ))
-
-            subsession_rows = []
-
-            for player in players:
-                group = group_cache[player['group_id']]
-                tweak_player_values_dict(player)
-
-                row = [player[fname] for fname in pfields]
-                row += [group[fname] for fname in gfields]
-                row += [subsession[fname] for fname in sfields]
-
-                subsession_rows.append(row)
-        rows.extend(subsession_rows)
-    return rows
+        if not pps:
+            return
+        last_id = pps[-1].id
+        rows = []
+        for pp in pps:
+            session = session_cache[pp.session_id]
+            row = [getattr(pp, fname) for fname in participant_fields]
+            row += [pp.vars.get(fname, None) for fname in settings.PARTICIPANT_FIELDS]
+            row += [getattr(session, fname) for fname in session_fields]
+            row += [session.config.get(fname) for fname in session_config_fields]
+            row += [session.vars.get(fname, None) for fname in settings.SESSION_FIELDS]
+            rows.append([sanitize_for_csv(v) for v in row])
+        for columns in app_columns:
+            columns.extend_rows(rows, pps)
+        yield from rows
+
+
+class _WideCsvAppColumns:
+    """an app's columns in the wide CSV: for each round, player/group/subsession"""
+
+    def __init__(self, app_name, num_rounds, session_ids):
+        models_module = otree.common.get_main_module(app_name)
+        self.app_name = app_name
+        self.num_rounds = num_rounds
+        self.Player: BasePlayer = models_module.Player
+        self.Group: BaseGroup = models_module.Group
+        Subsession: BaseSubsession = models_module.Subsession
+        self.pfields = get_fields_for_csv(self.Player)
+        self.gfields = get_fields_for_csv(self.Group)
+        self.sfields = get_fields_for_csv(Subsession)
+        self.session_ids = session_ids
+        # there are only num_rounds per session, so we can load them all,
+        # already sanitized.
+        self.subsession_values = {
+            (row['session_id'], row['round_number']): [
+                sanitize_for_csv(row[fname]) for fname in self.sfields
+            ]
+            for row in Subsession.values_dicts(Subsession.session_id.in_(session_ids))
+        }
+        self.empty_round = [''] * (
+            len(self.pfields) + len(self.gfields) + len(self.sfields)
+        )
+
+    def header_row(self):
+        header_row = []
+        for round_number in range(1, self.num_rounds + 1):
+            for model_name, fields in [
+                ('player', self.pfields),
+                ('group', self.gfields),
+                ('subsession', self.sfields),
+            ]:
+                for fname in fields:
+                    header_row.append(
+                        f'{self.app_name}.{round_number}.{model_name}.{fname}'
+                    )
+        return header_row
+
+    def extend_rows(self, rows, participants):
+        """
+        adds this app's columns to the rows of a chunk of participants.
+        the players are selected by a range of participant IDs
+        rather than a list of IDs, because a long "in" clause
+        can exceed the DB's limit on query variables.
+        """
+        Player = self.Player
+        Group = self.Group
+        in_chunk = [
+            Player.session_id.in_(self.session_ids),
+            Player.participant_id.between(participants[0].id, participants[-1].id),
+        ]
+        # payoff and role are properties; the DB columns start with _.
+        # see tweak_player_values_dict
+        player_columns = [
+            getattr(Player, PLAYER_PROPERTY_COLUMNS.get(fname, fname))
+            for fname in self.pfields
+        ]
+        players = {}
+        for participant_id, round_number, group_id, *values in dbq(Player).filter(
+            *in_chunk
+        ).with_entities(
+            Player.participant_id, Player.round_number, Player.group_id, *player_columns
+        ):
+            players[participant_id, round_number] = (group_id, values)
+        group_values = {
+            group_id: [sanitize_for_csv(v) for v in values]
+            for group_id, *values in dbq(Group)
+            .filter(Group.id.in_(dbq(Player.group_id).filter(*in_chunk)))
+            .with_entities(Group.id, *[getattr(Group, f) for f in self.gfields])
+        }
+
+        for row, participant in zip(rows, participants):
+            for round_number in range(1, self.num_rounds + 1):
+                subsession_values = self.subsession_values.get(
+                    (participant.session_id, round_number)
+                )
+                if subsession_values is None:
+                    # e.g. the session's app_sequence doesn't include this app
+                    row.extend(self.empty_round)
+                    continue
+                try:
+                    group_id, values = players[participant.id, round_number]
+                except KeyError:
+                    raise AssertionError((
+                        f"Participant {participant.code} has no player in "
+                        f"round {round_number} of app '{self.app_name}'. "
+                        "The number of players in the subsession "
+                        "should always match the number of players in the session. "
+                        "Please report this issue and then reset the database."
+                    )) from None
+                row.extend(sanitize_for_csv(v) for v in values)
+                row.extend(group_values[group_id])
+                row.extend(subsession_values)
 
 
 def get_rows_for_csv(app_name):
@@ -349,7 +420,7 @@ def get_rows_for_csv(app_name):
     model_order = ['participant', 'player', 'group', 'subsession', 'session']
 
     # header row
-    rows = [[f'{m}.{col}' for m in model_order for col in columns_for_models[m]]]
+    yield [f'{m}.{col}' for m in model_order for col in columns_for_models[m]]
 
     for player in players:
         tweak_player_values_dict(player)
@@ -362,9 +433,7 @@ def get_rows_for_csv(app_name):
                 obj = value_dicts[model_name][player[f'{model_name}_id']]
             for colname in columns_for_models[model_name]:
                 row.append(sanitize_for_csv(obj[colname]))
-        rows.append(row)
-
-    return rows
+        yield row
 
 
 def get_rows_for_monitor(participants) -> list:
@@ -420,20 +489,32 @@ def get_rows_for_data_tab_app(session, app_name):
         yield table
 
 
-def export_wide(fp, session_code=None):
-    rows = get_rows_for_wide_csv(session_code=session_code)
-    _export_csv(fp, rows)
+def iter_csv(rows):
+    """yields the CSV text in chunks, so the whole file is never in memory at once"""
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell() >= CSV_CHUNK_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
 
 
-def export_app(app_name, fp):
-    rows = get_rows_for_csv(app_name)
-    _export_csv(fp, rows)
+def iter_export_wide(session_code=None):
+    return iter_csv(get_rows_for_wide_csv(session_code=session_code))
+
+
+def iter_export_app(app_name):
+    return iter_csv(get_rows_for_csv(app_name))
 
 
 from sqlalchemy.orm import joinedload
 
 
-def custom_export_app(app_name, fp):
+def iter_custom_export_app(app_name):
     models_module = get_main_module(app_name)
     Player = models_module.Player
     qs = list(
@@ -450,23 +531,87 @@ def custom_export_app(app_name, fp):
         # need this to query null values
         player._is_frozen = False
     rows = models_module.custom_export(qs)
-    str_rows = []
-    for row in rows:
-        str_rows.append([sanitize_for_csv(ele) for ele in row])
-    _export_csv(fp, str_rows)
+    return iter_csv([sanitize_for_csv(ele) for ele in row] for row in rows)
+
+
+def iter_export_page_times():
+    """call write_page_completion_buffer() first, to include the latest pages"""
+    yield ','.join(TimeSpentRow.__annotations__.keys()) + '\n'
+    last_id = 0
+    while True:
+        batches = (
+            dbq(PageTimeBatch.id, PageTimeBatch.text)
+            .filter(PageTimeBatch.id > last_id)
+            .order_by(PageTimeBatch.id)
+            .limit(PAGE_TIMES_BATCH_SIZE)
+            .all()
+        )
+        if not batches:
+            return
+        last_id = batches[-1][0]
+        for _, batch in batches:
+            yield batch
+
+
+def iter_export_chat():
+    column_names = [
+        'session_code',
+        'id_in_session',
+        'participant_code',
+        'channel',
+        'nickname',
+        'body',
+        'timestamp',
+    ]
+
+    yield from iter_csv([column_names])
+    yield from iter_csv(_get_rows_for_chat())
 
 
-def _export_csv(fp, rows):
-    writer = csv.writer(fp)
-    writer.writerows(rows)
+def _get_rows_for_chat():
+    message_ids = values_flat(
+        dbq(ChatMessage).order_by(ChatMessage.timestamp, ChatMessage.id),
+        ChatMessage.id,
+    )
+    for i in range(0, len(message_ids), CHAT_BATCH_SIZE):
+        batch_ids = message_ids[i : i + CHAT_BATCH_SIZE]
+        rows = (
+            dbq(ChatMessage)
+            .join(Participant)
+            .filter(ChatMessage.id.in_(batch_ids))
+            .with_entities(
+                ChatMessage.id,
+                Participant._session_code,
+                Participant.id_in_session,
+                Participant.code,
+                ChatMessage.channel,
+                ChatMessage.nickname,
+                ChatMessage.body,
+                ChatMessage.timestamp,
+            )
+        )
+        rows_by_id = {row[0]: row[1:] for row in rows}
+        for message_id in batch_ids:
+            # the message could have been deleted in the meantime
+            if message_id in rows_by_id:
+                yield rows_by_id[message_id]
+
+
+def export_wide(fp, session_code=None):
+    fp.writelines(iter_export_wide(session_code=session_code))
+
+
+def export_app(app_name, fp):
+    fp.writelines(iter_export_app(app_name))
+
+
+def custom_export_app(app_name, fp):
+    fp.writelines(iter_custom_export_app(app_name))
 
 
 def export_page_times(fp):
     write_page_completion_buffer()
-    batches = values_flat(dbq(PageTimeBatch).order_by('id'), PageTimeBatch.text)
-    fp.write(','.join(TimeSpentRow.__annotations__.keys()) + '\n')
-    for batch in batches:
-        fp.write(batch)
+    fp.writelines(iter_export_page_times())
 
 
 BOM = '\ufeff'
@@ -1,21 +1,302 @@
+import asyncio
+import os
+import time
 import otree.common
+from starlette.concurrency import run_in_threadpool
 from otree.channels import utils as channel_utils
+from otree.currency import json_dumps
+from otree.middleware import session_locks
 from otree.models import Participant, BasePlayer, BaseGroup
-from otree.lookup import get_page_lookup
+from otree.lookup import get_current_player, get_page_lookup
 import logging
-from otree.database import NoResultFound
+from collections import defaultdict, deque, OrderedDict
+from otree.database import NoResultFound, dbq, session_scope
 
 logger = logging.getLogger(__name__)
 
+# once a group has this many liveSend messages waiting,
+# a connection that sends another one waits until it has been handled,
+# so a flood of messages slows down its senders rather than filling up memory.
+LIVE_QUEUE_SIZE = int(os.getenv('OTREE_LIVE_QUEUE_SIZE') or 100)
+# number of groups (most recently used) that we keep queue stats for
+LIVE_QUEUE_STATS_SIZE = 100
+# optional per-connection rate limit on liveSend, off by default.
+# set OTREE_LIVE_MAX_RATE to the number of messages per second a connection
+# may send on average, and optionally OTREE_LIVE_MAX_BURST to how many it may send
+# at once (default: 2 seconds' worth). it's a token bucket.
+# messages over the limit are dropped, with a warning in the server log
+# (or, on a page with live_coalesce_ms, held until there is room).
+LIVE_MAX_RATE = float(os.getenv('OTREE_LIVE_MAX_RATE') or 0)
+LIVE_MAX_BURST = float(os.getenv('OTREE_LIVE_MAX_BURST') or 2 * LIVE_MAX_RATE)
 
-async def live_payload_function(participant_code, page_name, payload):
 
+class LiveSendStats:
+    '''
+    What live_method replies cost, per page.
+    A reply is what 1 liveSend's live_method returns;
+    it's encoded once per distinct payload,
+    so a {0: ...} broadcast to the whole group is 1 encoding.
+    '''
+
+    def __init__(self):
+        # 'app_name.PageName' -> [replies, encodings, messages, bytes]
+        self._pages = defaultdict(lambda: [0, 0, 0, 0])
+
+    def record(self, page_key, num_encodings, num_messages, num_bytes):
+        counts = self._pages[page_key]
+        counts[0] += 1
+        counts[1] += num_encodings
+        counts[2] += num_messages
+        counts[3] += num_bytes
+
+    def stats(self):
+        return {
+            page_key: dict(
+                replies=replies, encodings=encodings, messages=messages, bytes=num_bytes
+            )
+            for page_key, [replies, encodings, messages, num_bytes] in list(
+                self._pages.items()
+            )
+        }
+
+
+live_send_stats = LiveSendStats()
+
+
+class LiveContext:
+    '''
+    What handling a liveSend message needs to look up,
+    kept for the lifetime of the websocket connection,
+    so that it's not queried again for every message.
+    It's reset when the participant goes to another page (e.g. after regrouping
+    on a wait page), and the group membership is reloaded
+    if the player is in a different group.
+    '''
+
+    def __init__(self):
+        self.participant_id = None
+        self.session_code = None
+        self.is_browser_bot = None
+        self.index_in_pages = None
+        self.player_id = None
+        self.group_id = None
+        # id_in_group -> participant code
+        self.pcodes = None
+
+
+class TokenBucket:
+    def __init__(self, rate=LIVE_MAX_RATE, burst=LIVE_MAX_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def seconds_until_available(self):
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+def live_queue_key(participant_code, context: LiveContext):
+    '''
+    The queue a connection's messages go in: 1 per group on a page,
+    so that a group's messages are handled in the order they arrived.
+    It's found when the socket connects and kept for the connection,
+    so that a connection's own messages can never overtake each other.
+    It also warms up the context for the first message.
+    '''
     try:
         participant = Participant.objects_get(code=participant_code)
-    except NoResultFound:
-        logger.warning(f'Participant not found: {participant_code}')
-        return
-    lookup = get_page_lookup(participant._session_code, participant._index_in_pages)
+        lookup = get_page_lookup(
+            participant._session_code, participant._index_in_pages
+        )
+        Player = otree.common.get_main_module(lookup.app_name).Player
+        player = get_current_player(Player, participant)
+    except (NoResultFound, KeyError):
+        # e.g. the participant finished. the message will be ignored anyway.
+        return participant_code
+    context.participant_id = participant.id
+    context.session_code = participant._session_code
+    context.index_in_pages = participant._index_in_pages
+    context.player_id = player.id
+    context.group_id = player.group_id
+    return (context.session_code, context.index_in_pages, player.group_id)
+
+
+class LiveQueues:
+    '''
+    Runs live methods in a worker thread, so that a slow live_method
+    (e.g. a matching engine) doesn't freeze every other websocket and request.
+    Each group has its own queue, drained by 1 task, so a group's messages
+    are still handled one at a time, in order, each in its own transaction,
+    while other groups' queues are drained alongside it.
+    Handling a message still takes the session's lock (see SessionLocks),
+    since the live_method can modify anything in the session.
+    '''
+
+    def __init__(self):
+        self._queues = {}
+        self.num_queued = 0
+        self.num_started = 0
+        self.num_done = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # messages that never got here. counted by LiveConsumer.
+        self.num_coalesced = 0
+        self.num_rate_limited = 0
+        # key -> [messages, max depth, max wait]
+        self._group_stats = OrderedDict()
+
+    def depth(self, key):
+        return len(self._queues.get(key, ()))
+
+    def submit(
+        self, key, session_code_for_lock, participant_code, page_name, payload, context
+    ):
+        '''
+        returns a future that is done when the message has been handled.
+        '''
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            loop.create_task(self._drain(key, session_code_for_lock, queue))
+        queue.append(
+            ((participant_code, page_name, payload, context), future, time.monotonic())
+        )
+        self.num_queued += 1
+        self.max_depth = max(self.max_depth, len(queue))
+        stats = self._group_stats.pop(key, None) or [0, 0, 0.0]
+        stats[0] += 1
+        stats[1] = max(stats[1], len(queue))
+        self._group_stats[key] = stats
+        if len(self._group_stats) > LIVE_QUEUE_STATS_SIZE:
+            self._group_stats.popitem(last=False)
+        return future
+
+    async def _drain(self, key, session_code_for_lock, queue):
+        try:
+            while queue:
+                args, future, queued_at = queue[0]
+                try:
+                    async with session_locks.acquire(session_code_for_lock):
+                        self._record_wait(key, time.monotonic() - queued_at)
+                        reply = await run_in_threadpool(
+                            _run_live_method_and_commit, *args
+                        )
+                    # the sends don't need the lock, and they go out before
+                    # this group's next message is handled, so they stay in order.
+                    if reply:
+                        await _live_send_back(*reply)
+                except Exception as exc:
+                    # like an error in a page, it shouldn't stop
+                    # the rest of the group's messages.
+                    logger.exception(repr(exc))
+                queue.popleft()
+                self.num_done += 1
+                # the sender may have disconnected while waiting for it,
+                # which cancels the future.
+                if not future.done():
+                    future.set_result(None)
+        finally:
+            del self._queues[key]
+
+    def _record_wait(self, key, wait):
+        self.num_started += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        stats = self._group_stats.get(key)
+        if stats:
+            stats[2] = max(stats[2], wait)
+
+    def stats(self):
+        return dict(
+            queued=self.num_queued,
+            pending=self.num_queued - self.num_done,
+            max_pending=self.max_depth,
+            mean_wait_ms=round(
+                1000 * self.total_wait / self.num_started if self.num_started else 0, 1
+            ),
+            max_wait_ms=round(1000 * self.max_wait, 1),
+            coalesced=self.num_coalesced,
+            rate_limited=self.num_rate_limited,
+        )
+
+    def group_stats(self, limit=10):
+        '''the groups whose messages waited longest'''
+        rows = [
+            dict(
+                group=key,
+                pending=self.depth(key),
+                messages=num,
+                max_pending=max_depth,
+                max_wait_ms=round(1000 * max_wait, 1),
+            )
+            for key, [num, max_depth, max_wait] in list(self._group_stats.items())
+        ]
+        rows.sort(key=lambda row: row['max_wait_ms'], reverse=True)
+        return rows[:limit]
+
+
+live_queues = LiveQueues()
+
+
+def _run_live_method_and_commit(participant_code, page_name, payload, context):
+    with session_scope():
+        return run_live_method(participant_code, page_name, payload, context)
+
+
+async def live_payload_function(participant_code, page_name, payload, context=None):
+    reply = run_live_method(participant_code, page_name, payload, context)
+    if reply:
+        await _live_send_back(*reply)
+
+
+def run_live_method(participant_code, page_name, payload, context=None):
+    '''
+    Calls the live_method and returns the arguments for _live_send_back
+    (or None if there is nothing to send).
+    It doesn't touch the event loop, so it can run in a worker thread.
+    '''
+    if context is None:
+        context = LiveContext()
+
+    participant = None
+    if context.participant_id is None:
+        try:
+            participant = Participant.objects_get(code=participant_code)
+        except NoResultFound:
+            logger.warning(f'Participant not found: {participant_code}')
+            return
+        context.participant_id = participant.id
+        context.session_code = participant._session_code
+        index_in_pages = participant._index_in_pages
+    else:
+        # much cheaper than loading the whole participant
+        index_in_pages = (
+            dbq(Participant._index_in_pages)
+            .filter(Participant.id == context.participant_id)
+            .scalar()
+        )
+        if index_in_pages is None:
+            logger.warning(f'Participant not found: {participant_code}')
+            return
+    if index_in_pages != context.index_in_pages:
+        context.index_in_pages = index_in_pages
+        context.player_id = context.group_id = context.pcodes = None
+
+    lookup = get_page_lookup(context.session_code, index_in_pages)
     app_name = lookup.app_name
     models_module = otree.common.get_main_module(app_name)
     PageClass = lookup.page_class
@@ -29,9 +310,15 @@ async def live_payload_function(participant_code, page_name, payload):
         )
         return
 
-    player = models_module.Player.objects_get(
-        round_number=lookup.round_number, participant=participant
-    )
+    Player: BasePlayer = models_module.Player
+    player = None
+    if context.player_id is not None:
+        player = dbq(Player).get(context.player_id)
+    if player is None:
+        if participant is None:
+            participant = dbq(Participant).get(context.participant_id)
+        player = get_current_player(Player, participant)
+        context.player_id = player.id
 
     # it makes sense to check the group first because
     # if the player forgot to define it on the Player,
@@ -49,16 +336,19 @@ async def live_payload_function(participant_code, page_name, payload):
     if not isinstance(retval, dict):
         raise LiveMethodBadReturnValue(f'live method must return a dict')
 
-    Player: BasePlayer = models_module.Player
-    pcodes_dict = {
-        d[0]: d[1]
-        for d in Player.objects_filter(group=group)
-        .join(Participant)
-        .with_entities(
-            Player.id_in_group,
-            Participant.code,
-        )
-    }
+    # the live method could have changed the group
+    if context.pcodes is None or context.group_id != player.group_id:
+        context.group_id = player.group_id
+        context.pcodes = {
+            d[0]: d[1]
+            for d in Player.objects_filter(group=group)
+            .join(Participant)
+            .with_entities(
+                Player.id_in_group,
+                Participant.code,
+            )
+        }
+    pcodes_dict = context.pcodes
 
     pcode_retval = {}
     for pid, pcode in pcodes_dict.items():
@@ -66,8 +356,11 @@ async def live_payload_function(participant_code, page_name, payload):
         if payload is not None:
             pcode_retval[pcode] = payload
 
-    await _live_send_back(
-        participant._session_code, participant._index_in_pages, pcode_retval
+    return (
+        context.session_code,
+        index_in_pages,
+        pcode_retval,
+        f'{app_name}.{page_name}',
     )
 
 
@@ -75,14 +368,27 @@ class LiveMethodBadReturnValue(Exception):
     pass
 
 
-async def _live_send_back(session_code, page_index, pcode_retval):
+async def _live_send_back(session_code, page_index, pcode_retval, page_key=None):
     '''separate function for easier patching'''
 
+    # players who get the same payload object (usually retval[0])
+    # share 1 encoding and 1 concurrent send.
+    recipients = {}
     for pcode, retval in pcode_retval.items():
-        group_name = channel_utils.live_group(session_code, page_index, pcode)
-        await channel_utils.group_send(
-            group=group_name,
-            data=retval,
+        recipients.setdefault(id(retval), (retval, []))[1].append(
+            channel_utils.live_group(session_code, page_index, pcode)
+        )
+    num_bytes = 0
+    for retval, group_names in recipients.values():
+        text = json_dumps(retval)
+        num_bytes += len(text.encode('utf-8')) * len(group_names)
+        await channel_utils.groups_send_text(groups=group_names, text=text)
+    if page_key:
+        live_send_stats.record(
+            page_key,
+            num_encodings=len(recipients),
+            num_messages=len(pcode_retval),
+            num_bytes=num_bytes,
         )
 
 
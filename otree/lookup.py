@@ -1,6 +1,9 @@
+import os
+import threading
+import time
+from array import array
 from collections import namedtuple
-from functools import lru_cache
-from typing import Dict
+from typing import Dict, Optional
 
 from otree.common import get_pages_module, get_main_module, get_constants
 from otree.database import dbq
@@ -18,57 +21,207 @@ PageLookup = namedtuple(
     ],
 )
 
+# a session's table is dropped after it hasn't been used for this long.
+# that's better than a max number of sessions, because with many sessions
+# running at the same time (e.g. several rooms), they would keep evicting each other.
+LOOKUP_IDLE_SECONDS = int(os.getenv('OTREE_LOOKUP_IDLE_SECONDS') or 60 * 60)
+# how often we check for idle sessions
+LOOKUP_SWEEP_SECONDS = 60
 
-@lru_cache(maxsize=32)
-def _get_session_lookups(session_code) -> Dict[int, PageLookup]:
-    session = dbq(Session).filter_by(code=session_code).one()
-    pages = {}
-    idx = 1
-    for app_name in session.config['app_sequence']:
-        models = get_main_module(app_name)
-        Subsession = models.Subsession
-        page_sequence = get_pages_module(app_name).page_sequence
-        subsessions = {
-            s[0]: s[1]
-            for s in Subsession.objects_filter(session=session).with_entities(
-                Subsession.round_number, Subsession.id
+
+class SessionPages:
+    """
+    The page sequence of a session, 1 entry per page index.
+    Instead of a PageLookup per page, it stores parallel arrays,
+    since a session can have thousands of pages (many rounds).
+    Index 0 is unused, because page indexes start at 1.
+
+    It also has the player IDs, since a participant's player in each round
+    is fixed when the session is created (even GBAT only changes the group).
+    For each app, an array of num_participants * num_rounds IDs
+    (0 if missing), indexed by participant.id_in_session and round_number.
+    """
+
+    def __init__(self, session_code):
+        session = dbq(Session).filter_by(code=session_code).one()
+        self.session_pk = session.id
+        self.app_names = []
+        self.names_in_url = []
+        self.page_classes = []
+        self.app_indexes = array('h', [-1])
+        self.class_indexes = array('h', [-1])
+        self.round_numbers = array('h', [0])
+        self.subsession_ids = array('i', [0])
+        # the part of the URL after the participant code
+        self.url_suffixes = ['']
+        self.num_participants = session.num_participants
+        self.player_ids = []
+        self.num_rounds = array('h')
+
+        for app_index, app_name in enumerate(session.config['app_sequence']):
+            Subsession = get_main_module(app_name).Subsession
+            page_sequence = get_pages_module(app_name).page_sequence
+            subsessions = dict(
+                Subsession.objects_filter(session=session).with_entities(
+                    Subsession.round_number, Subsession.id
+                )
             )
-        }
 
-        Constants = get_constants(app_name)
-        num_rounds = Constants.get_normalized('num_rounds')
-        name_in_url = Constants.get_normalized('name_in_url')
-        for rd in range(1, num_rounds + 1):
+            Constants = get_constants(app_name)
+            num_rounds = Constants.get_normalized('num_rounds')
+            name_in_url = Constants.get_normalized('name_in_url')
+            self.app_names.append(app_name)
+            self.names_in_url.append(name_in_url)
+            self.num_rounds.append(num_rounds)
+            self.player_ids.append(self._load_player_ids(app_name, session, num_rounds))
+            class_indexes = []
             for PageClass in page_sequence:
-                pages[idx] = PageLookup(
-                    app_name=app_name,
-                    page_class=PageClass,
-                    round_number=rd,
-                    subsession_id=subsessions[rd],
-                    session_pk=session.id,
-                    name_in_url=name_in_url,
-                )
-                idx += 1
-    return pages
+                class_indexes.append(len(self.page_classes))
+                self.page_classes.append(PageClass)
+
+            for rd in range(1, num_rounds + 1):
+                for class_index, PageClass in zip(class_indexes, page_sequence):
+                    idx = len(self.url_suffixes)
+                    self.app_indexes.append(app_index)
+                    self.class_indexes.append(class_index)
+                    self.round_numbers.append(rd)
+                    self.subsession_ids.append(subsessions[rd])
+                    # see Page.get_url
+                    self.url_suffixes.append(
+                        f'/{name_in_url}/{PageClass.__name__}/{idx}'
+                    )
+        self.last_used = time.monotonic()
+
+    def _load_player_ids(self, app_name, session, num_rounds):
+        # otree.models.participant imports this module
+        from otree.models import Participant
+
+        Player = get_main_module(app_name).Player
+        player_ids = array('i', bytes(4 * self.num_participants * num_rounds))
+        rows = (
+            Player.objects_filter(session=session)
+            .join(Participant)
+            .with_entities(Participant.id_in_session, Player.round_number, Player.id)
+        )
+        for id_in_session, round_number, player_id in rows:
+            player_ids[(id_in_session - 1) * num_rounds + round_number - 1] = player_id
+        return player_ids
+
+    def player_id(self, idx, id_in_session) -> Optional[int]:
+        if not id_in_session or not 1 <= idx <= len(self):
+            return None
+        app_index = self.app_indexes[idx]
+        num_rounds = self.num_rounds[app_index]
+        i = (id_in_session - 1) * num_rounds + self.round_numbers[idx] - 1
+        player_ids = self.player_ids[app_index]
+        if 0 <= i < len(player_ids):
+            return player_ids[i] or None
+        return None
+
+    def __len__(self):
+        return len(self.url_suffixes) - 1
+
+    def get(self, idx) -> PageLookup:
+        if not 1 <= idx <= len(self):
+            raise KeyError(idx)
+        app_index = self.app_indexes[idx]
+        return PageLookup(
+            app_name=self.app_names[app_index],
+            page_class=self.page_classes[self.class_indexes[idx]],
+            round_number=self.round_numbers[idx],
+            subsession_id=self.subsession_ids[idx],
+            name_in_url=self.names_in_url[app_index],
+            session_pk=self.session_pk,
+        )
+
+    def min_idx_for_app(self, app_name):
+        try:
+            return self.app_indexes.index(self.app_names.index(app_name))
+        except ValueError:
+            return None
+
+
+class SessionPagesCache:
+    def __init__(self):
+        self._sessions: Dict[str, SessionPages] = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, session_code) -> SessionPages:
+        now = time.monotonic()
+        pages = self._sessions.get(session_code)
+        if pages is None:
+            self.misses += 1
+            # build it outside the lock, because it queries the DB.
+            # if 2 threads build it at the same time, one of them is discarded.
+            pages = SessionPages(session_code)
+            with self._lock:
+                pages = self._sessions.setdefault(session_code, pages)
+        pages.last_used = now
+        if now - self._last_sweep > LOOKUP_SWEEP_SECONDS:
+            self._sweep(now)
+        return pages
+
+    def discard(self, session_code):
+        with self._lock:
+            self._sessions.pop(session_code, None)
+
+    def _sweep(self, now):
+        with self._lock:
+            self._last_sweep = now
+            idle = [
+                code
+                for code, pages in self._sessions.items()
+                if now - pages.last_used > LOOKUP_IDLE_SECONDS
+            ]
+            for code in idle:
+                del self._sessions[code]
+            self.evictions += len(idle)
+
+    def stats(self):
+        return dict(
+            sessions=len(self._sessions),
+            misses=self.misses,
+            evictions=self.evictions,
+        )
+
+
+session_pages = SessionPagesCache()
+
+
+def warm_session_lookups(session_code):
+    '''call this when the session is created, so the first page load doesn't need to'''
+    # in case it was already loaded before all the players existed
+    session_pages.discard(session_code)
+    session_pages.get(session_code)
 
 
 def get_page_lookup(session_code, idx) -> PageLookup:
-    cache = _get_session_lookups(session_code)
-    return cache[idx]
+    return session_pages.get(session_code).get(idx)
+
+
+def get_current_player(Player, participant):
+    '''the participant's player for the page they are on'''
+    pages = session_pages.get(participant._session_code)
+    idx = participant._index_in_pages
+    player_id = pages.player_id(idx, participant.id_in_session)
+    if player_id:
+        # uses the identity map if it's already loaded
+        player = dbq(Player).get(player_id)
+        if player is not None and player.participant_id == participant.id:
+            return player
+    return Player.objects_get(
+        participant=participant, round_number=pages.round_numbers[idx]
+    )
 
 
 def get_min_idx_for_app(session_code, app_name):
     '''for aatp'''
-    for idx, info in _get_session_lookups(session_code).items():
-        if info.app_name == app_name:
-            return idx
+    return session_pages.get(session_code).min_idx_for_app(app_name)
 
 
 def url_i_should_be_on(participant_code, session_code, index_in_pages) -> str:
-    idx = index_in_pages
-    lookup = get_page_lookup(session_code, idx)
-    return lookup.page_class.get_url(
-        participant_code=participant_code,
-        name_in_url=lookup.name_in_url,
-        page_index=idx,
-    )
+    suffix = session_pages.get(session_code).url_suffixes[index_in_pages]
+    return '/p/' + participant_code + suffix
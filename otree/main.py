@@ -102,11 +102,20 @@ def execute_from_command_line(*args, **kwargs):
         'update_my_code',
         'remove_self',
         'remove_self_finalize',
+        # it only talks to a running server
+        'benchmark_server',
     ]:
         # skip full setup.
         pass
     else:
-        if cmd in ['devserver_inner', 'bots']:
+        if cmd in [
+            'devserver_inner',
+            'bots',
+            'benchmark_create_session',
+            'benchmark_export',
+            'benchmark_live',
+            'benchmark_locks',
+        ]:
             os.environ['OTREE_IN_MEMORY'] = '1'
         setup()
 
@@ -205,6 +214,11 @@ def check_for_sentry():
 MAIN_HELP_TEXT = '''
 Available subcommands:
 
+benchmark_create_session
+benchmark_export
+benchmark_live
+benchmark_locks
+benchmark_server
 browser_bots
 create_session
 devserver
@@ -1,21 +1,202 @@
 import asyncio
+import concurrent.futures
 import logging
+import re
+import threading
 import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Set
+
 from starlette.middleware.sessions import SessionMiddleware  # noqa
 from starlette.middleware.base import BaseHTTPMiddleware
 from otree.common import _SECRET, lock
 
-from otree.database import db, NEW_IDMAP_EACH_REQUEST
+from otree.database import db, NEW_IDMAP_EACH_REQUEST, supports_concurrent_sessions
 
 logger = logging.getLogger('otree.perf')
 
+# how often a thread waiting for the lock checks if it should stop waiting
+THREAD_LOCK_POLL_SECONDS = 0.1
+
+
+class SessionLocks:
+    '''
+    Requests that only touch one session just need to be serialized
+    with other requests for that same session.
+    Anything we can't attribute to a session (admin pages, REST, rooms, etc.)
+    takes the global lock, which waits until no session lock is held.
+    Pending global requests block new session requests, so they can't be starved.
+
+    This only has an effect if the DB layer can run transactions side by side
+    (OTREE_DB_POOL_SIZE, see otree.database).
+    The default configuration (the in-memory DB, or a single shared connection)
+    is unchanged: every key collapses to the global lock, like before.
+    'otree benchmark_locks' compares the throughput of the 2 modes.
+    '''
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._refcounts: Dict[str, int] = {}
+        self._num_session_holders = 0
+        self._num_global_waiting = 0
+        self._global_queue = deque()
+        self._global_held = False
+        self._cond = None
+        # session codes are resolved lazily, from the first request we handle
+        # for a participant (which goes through the global lock)
+        self._participant_to_session: Dict[str, str] = {}
+        self._session_pk_to_code: Dict[int, str] = {}
+        # the reverse, so forget_session() doesn't have to scan everything
+        self._session_to_participants: Dict[str, Set[str]] = {}
+        self._session_code_to_pk: Dict[str, int] = {}
+        # remember() runs in the threadpool
+        self._remember_lock = threading.Lock()
+
+    def _condition(self):
+        # create it lazily so it's bound to the server's event loop
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def remember(self, *, participant_code, session_pk, session_code):
+        if self._participant_to_session.get(participant_code) == session_code:
+            return
+        with self._remember_lock:
+            self._participant_to_session[participant_code] = session_code
+            self._session_pk_to_code[session_pk] = session_code
+            self._session_code_to_pk[session_code] = session_pk
+            self._session_to_participants.setdefault(session_code, set()).add(
+                participant_code
+            )
+
+    def forget_session(self, session_code):
+        """when the session is deleted, since its ID can be reused"""
+        with self._remember_lock:
+            for participant_code in self._session_to_participants.pop(session_code, ()):
+                self._participant_to_session.pop(participant_code, None)
+            session_pk = self._session_code_to_pk.pop(session_code, None)
+            if self._session_pk_to_code.get(session_pk) == session_code:
+                del self._session_pk_to_code[session_pk]
+
+    def session_code_for_participant(self, participant_code) -> Optional[str]:
+        return self._participant_to_session.get(participant_code)
+
+    def session_code_for_pk(self, session_pk) -> Optional[str]:
+        return self._session_pk_to_code.get(session_pk)
+
+    @asynccontextmanager
+    async def acquire(self, session_code: Optional[str] = None):
+        if session_code and supports_concurrent_sessions():
+            async with self._acquire_session(session_code):
+                yield
+        else:
+            async with self._acquire_global():
+                yield
+
+    def acquire_global_from_thread(self, loop, stop_event):
+        '''
+        For a thread other than the event loop's (e.g. the DB snapshot thread).
+        Blocks until the global lock is held, and returns a function that releases it.
+        Returns None if stop_event is set first.
+        '''
+        context_manager = self._acquire_global()
+
+        def release():
+            # not waiting for it (see below).
+            # it runs before any acquire that's requested after it.
+            asyncio.run_coroutine_threadsafe(
+                context_manager.__aexit__(None, None, None), loop
+            )
+
+        future = asyncio.run_coroutine_threadsafe(context_manager.__aenter__(), loop)
+        while True:
+            try:
+                future.result(timeout=THREAD_LOCK_POLL_SECONDS)
+                return release
+            except concurrent.futures.TimeoutError:
+                # e.g. the server is shutting down, and the loop is waiting for
+                # this thread to finish, so it can't give us the lock.
+                if stop_event.is_set():
+                    if not future.cancel():
+                        # we got it in the meantime
+                        release()
+                    return None
+
+    @asynccontextmanager
+    async def _acquire_global(self):
+        cond = self._condition()
+        # first come, first served, like a plain asyncio.Lock.
+        # otherwise the task that just released it can take it again
+        # before the waiters it notified get to run.
+        ticket = object()
+        async with cond:
+            self._global_queue.append(ticket)
+            self._num_global_waiting += 1
+            try:
+                await cond.wait_for(
+                    lambda: self._global_queue[0] is ticket
+                    and not self._global_held
+                    and not self._num_session_holders
+                )
+            finally:
+                self._num_global_waiting -= 1
+                self._global_queue.remove(ticket)
+                # e.g. if we were cancelled, the next one may be able to go
+                cond.notify_all()
+            self._global_held = True
+        try:
+            yield
+        finally:
+            async with cond:
+                self._global_held = False
+                cond.notify_all()
+
+    @asynccontextmanager
+    async def _acquire_session(self, session_code):
+        cond = self._condition()
+        async with cond:
+            await cond.wait_for(
+                lambda: not self._global_held and not self._num_global_waiting
+            )
+            self._num_session_holders += 1
+        lock = self._locks.get(session_code)
+        if lock is None:
+            lock = self._locks[session_code] = asyncio.Lock()
+            self._refcounts[session_code] = 0
+        self._refcounts[session_code] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._refcounts[session_code] -= 1
+            # prune it so this doesn't grow indefinitely
+            if not self._refcounts[session_code]:
+                del self._refcounts[session_code]
+                del self._locks[session_code]
+            async with cond:
+                self._num_session_holders -= 1
+                cond.notify_all()
+
+
+session_locks = SessionLocks()
+
+
+PARTICIPANT_PATH_RE = re.compile(
+    r'^/(?:p|InitializeParticipant|OutOfRangeNotification)/([a-z0-9]+)(?:/|$)'
+)
+
 
-lock2 = asyncio.Lock()
+def session_code_from_path(path) -> Optional[str]:
+    match = PARTICIPANT_PATH_RE.match(path)
+    if match:
+        return session_locks.session_code_for_participant(match.group(1))
 
 
 class CommitTransactionMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request, call_next):
-        async with lock2:
+        session_code = session_code_from_path(request.url.path)
+        async with session_locks.acquire(session_code):
             if NEW_IDMAP_EACH_REQUEST:
                 db.new_session()
             response = await call_next(request)
@@ -25,6 +206,9 @@ class CommitTransactionMiddleware(BaseHTTPMiddleware):
                 # it's necessary to roll back. if i don't, the values get saved to DB
                 # (even though i don't commit, not sure...)
                 db.rollback()
+            if supports_concurrent_sessions():
+                # give the connection back to the pool
+                db.close()
             return response
 
 
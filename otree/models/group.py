@@ -1,4 +1,4 @@
-from sqlalchemy import Column as C, ForeignKey
+from sqlalchemy import Column as C, ForeignKey, Index
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import sqltypes as st
@@ -16,6 +16,19 @@ from otree.database import db, NoResultFound, MixinSessionFK, SPGModel
 class BaseGroup(SPGModel, MixinSessionFK):
     __abstract__ = True
 
+    @declared_attr
+    def __table_args__(cls):
+        tablename = cls.__tablename__
+        # group.in_round()
+        return (
+            Index(
+                f'{tablename}_session_round',
+                'session_id',
+                'round_number',
+                'id_in_subsession',
+            ),
+        )
+
     id_in_subsession = C(st.Integer, index=True)
 
     round_number = C(st.Integer, index=True)
@@ -12,7 +12,7 @@ import otree.constants
 import otree.database
 from otree.common import random_chars_8, ADMIN_SECRET_CODE
 from otree.database import MixinVars, CurrencyType
-from otree.lookup import url_i_should_be_on, get_page_lookup
+from otree.lookup import url_i_should_be_on, get_page_lookup, get_current_player
 
 
 class Participant(MixinVars, otree.database.SSPPGModel):
@@ -155,9 +155,7 @@ class Participant(MixinVars, otree.database.SSPPGModel):
         lookup = get_page_lookup(self._session_code, self._index_in_pages)
         models_module = otree.common.get_main_module(lookup.app_name)
         PlayerClass = getattr(models_module, 'Player')
-        return PlayerClass.objects_get(
-            participant=self, round_number=lookup.round_number
-        )
+        return get_current_player(PlayerClass, self)
 
     def initialize(self, participant_label):
         """in a separate function so that we can call it individually,
@@ -166,6 +164,7 @@ class Participant(MixinVars, otree.database.SSPPGModel):
         if pp._index_in_pages == 0:
             pp._index_in_pages = 1
             pp.visited = True
+            pp._register_wait_page_arrival()
 
             # participant.label might already have been set
             if not pp.label:
@@ -209,6 +208,20 @@ class Participant(MixinVars, otree.database.SSPPGModel):
         page.set_attributes(self)
         return page
 
+    def _register_wait_page_arrival(self):
+        """
+        for when _index_in_pages is moved onto a wait page and the participant
+        might never load it (e.g. they close the tab), so the arrival tally
+        still counts them, like the DB does.
+        """
+        from otree.api import WaitPage
+
+        if self._index_in_pages > self._max_page_index:
+            return
+        page_class = get_page_lookup(self._session_code, self._index_in_pages).page_class
+        if issubclass(page_class, WaitPage) and not page_class.group_by_arrival_time:
+            self._get_page_instance()._register_arrival()
+
     def _submit_current_page(self):
         from otree.api import Page
 
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import Column, ForeignKey, Index
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import sqltypes as st
@@ -10,6 +10,17 @@ from otree.database import db, MixinSessionFK, SPGModel, CurrencyType
 class BasePlayer(SPGModel, MixinSessionFK):
     __abstract__ = True
 
+    @declared_attr
+    def __table_args__(cls):
+        # index names must be unique across the whole DB (in SQLite)
+        tablename = cls.__tablename__
+        return (
+            # loading the player for the participant's current page
+            Index(f'{tablename}_participant_round', 'participant_id', 'round_number'),
+            # group.get_players()
+            Index(f'{tablename}_group_id_in_group', 'group_id', 'id_in_group'),
+        )
+
     id_in_group = Column(
         st.Integer,
         nullable=True,
@@ -1,7 +1,7 @@
 import time
 from collections import defaultdict
 
-from sqlalchemy import Column as C
+from sqlalchemy import Column as C, Index
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import sqltypes as st
@@ -9,6 +9,7 @@ from sqlalchemy.sql.functions import func
 
 import otree.common
 import otree.database
+from otree.arrivals import arrival_counters
 from otree.common import (
     get_main_module,
     in_round,
@@ -18,6 +19,7 @@ from otree.common import (
 )
 from otree.constants import BaseConstants
 from otree.database import db, dbq, SPGModel, MixinSessionFK
+from otree.row_cache import row_cache
 
 
 class GroupMatrixError(ValueError):
@@ -31,6 +33,12 @@ class RoundMismatchError(GroupMatrixError):
 class BaseSubsession(SPGModel, MixinSessionFK):
     __abstract__ = True
 
+    @declared_attr
+    def __table_args__(cls):
+        tablename = cls.__tablename__
+        # subsession.in_round()
+        return (Index(f'{tablename}_session_round', 'session_id', 'round_number'),)
+
     round_number = C(
         st.Integer,
         index=True,
@@ -97,6 +105,9 @@ class BaseSubsession(SPGModel, MixinSessionFK):
 
         self.player_set.update({self._PlayerClass().group_id: None})
         self.group_set.delete()
+        # the bulk delete above doesn't go through the ORM
+        row_cache.invalidate_session(self.session_id)
+        arrival_counters.reset_session(self.session_id)
 
         GroupClass = self._GroupClass()
         for i, row in enumerate(matrix, start=1):
@@ -219,6 +230,8 @@ class BaseSubsession(SPGModel, MixinSessionFK):
             participant._gbat_grouped = True
             participant._gbat_is_connected = False
 
+        row_cache.invalidate_session(self.session_id)
+        arrival_counters.reset_session(self.session_id)
         return this_round_new_group
 
     def _gbat_next_group_id_in_subsession(self):
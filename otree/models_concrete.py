@@ -3,7 +3,7 @@ from collections import defaultdict
 from typing import Iterable
 from otree.database import AnyModel, db, MixinSessionFK
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import Column, ForeignKey, Index
 from sqlalchemy.sql import sqltypes as st
 
 import json
@@ -14,22 +14,62 @@ class PageTimeBatch(AnyModel):
 
 
 class CompletedGroupWaitPage(AnyModel, MixinSessionFK):
+    __table_args__ = (
+        Index(
+            'otree_completedgroupwaitpage_lookup', 'page_index', 'group_id', 'session_id'
+        ),
+    )
 
     page_index = Column(st.Integer)
     group_id = Column(st.Integer)
 
 
 class CompletedGBATWaitPage(AnyModel, MixinSessionFK):
+    __table_args__ = (
+        Index(
+            'otree_completedgbatwaitpage_lookup',
+            'page_index',
+            'id_in_subsession',
+            'session_id',
+        ),
+    )
 
     page_index = Column(st.Integer)
     id_in_subsession = Column(st.Integer, default=0)
 
 
 class CompletedSubsessionWaitPage(AnyModel, MixinSessionFK):
+    __table_args__ = (
+        Index('otree_completedsubsessionwaitpage_lookup', 'page_index', 'session_id'),
+    )
 
     page_index = Column(st.Integer)
 
 
+class WaitPageArrivals(AnyModel, MixinSessionFK):
+    """
+    How many participants have reached a group or subsession wait page.
+    For a group wait page, group_id is set; otherwise subsession_id.
+    See otree.arrivals.
+    """
+
+    __table_args__ = (
+        Index(
+            'otree_waitpagearrivals_lookup',
+            'page_index',
+            'group_id',
+            'subsession_id',
+            'session_id',
+        ),
+    )
+
+    page_index = Column(st.Integer)
+    group_id = Column(st.Integer)
+    subsession_id = Column(st.Integer)
+    num_participants = Column(st.Integer)
+    num_arrived = Column(st.Integer)
+
+
 class ParticipantVarsFromREST(AnyModel):
 
     participant_label = Column(st.String(255))
@@ -0,0 +1,198 @@
+import copy
+import os
+import threading
+from collections import defaultdict
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from otree.database import db, dbq, DBSession, NoResultFound
+
+# opt-in, because it's only correct if this process is the only one writing
+# Session/Subsession/Group rows (e.g. not with a separate timeout worker process
+# that modifies them).
+ROW_CACHE_ENABLED = bool(os.getenv('OTREE_ROW_CACHE'))
+
+# loaded lazily, so that pages that don't use vars don't need it.
+# also, vars changes all the time.
+UNCACHED_COLUMNS = {'_vars'}
+
+
+class RowCache:
+    """
+    Process-level cache of rows that rarely change while a session is running:
+    the Session (and its config), Subsessions and Groups.
+    Since each request gets a new identity map, without this,
+    every page load queries these rows and unpickles session.config again.
+
+    We store column values, not ORM objects, and on a hit we put a new
+    instance in the current identity map without querying the DB.
+    Any flush that modifies one of these rows invalidates it.
+    Changes that bypass the ORM (bulk query.update()/delete()) need to call
+    invalidate_session() explicitly.
+    """
+
+    def __init__(self):
+        self._rows = {}
+        self._keys_for_session = defaultdict(set)
+        # bumped on every invalidation. a transaction that started before an
+        # invalidation may have read the old row, so it must not store it.
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, Model, pk):
+        if not ROW_CACHE_ENABLED:
+            obj = dbq(Model).get(pk)
+            if obj is None:
+                raise NoResultFound
+            return obj
+
+        existing = db.identity_map_get(Model, pk)
+        if existing is not None:
+            return existing
+
+        key = (Model, pk)
+        values = self._rows.get(key)
+        if values is None:
+            self.misses += 1
+            obj = dbq(Model).get(pk)
+            if obj is None:
+                raise NoResultFound
+            self._store(key, obj)
+            return obj
+
+        self.hits += 1
+        return self._add_to_identity_map(Model, values)
+
+    def preload(self, Model, pk):
+        """
+        If the row is cached, put it in the identity map,
+        so that relationships like player.group don't need a query.
+        Unlike get(), it doesn't query on a miss.
+        """
+        if db.identity_map_get(Model, pk) is not None:
+            return
+        values = self._rows.get((Model, pk))
+        if values is not None:
+            self.hits += 1
+            self._add_to_identity_map(Model, values)
+
+    def _add_to_identity_map(self, Model, values):
+        obj = Model.__mapper__.class_manager.new_instance()
+        for attr, value in values.items():
+            if isinstance(value, (dict, list)):
+                # so that in-place changes during a request don't leak into the cache.
+                # deep, because e.g. session.config can contain lists and dicts.
+                value = copy.deepcopy(value)
+            set_committed_value(obj, attr, value)
+        # the uncached columns are expired, so they get loaded on first access
+        make_transient_to_detached(obj)
+        db.add(obj)
+        return obj
+
+    def _store(self, key, obj):
+        state = sqlalchemy.inspect(obj)
+        if state.modified:
+            return
+        values = {}
+        for prop in state.mapper.column_attrs:
+            attr = prop.key
+            if attr in UNCACHED_COLUMNS:
+                continue
+            if attr not in state.dict:
+                # expired or deferred; we'll get it next time.
+                return
+            values[attr] = copy.deepcopy(state.dict[attr])
+        # Session itself has no session_id column
+        session_id = values.get('session_id', obj.id)
+        with self._lock:
+            if db.info.get('row_cache_generation') != self._generation:
+                return
+            self._rows[key] = values
+            self._keys_for_session[session_id].add(key)
+
+    def _invalidate_keys(self, keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                if self._rows.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def invalidate_session(self, session_id):
+        """
+        drops the session and all its subsessions & groups.
+        if the cache is disabled, there's nothing to drop,
+        so callers don't need to check ROW_CACHE_ENABLED.
+        """
+        with self._lock:
+            keys = self._keys_for_session.pop(session_id, set())
+        self._invalidate_keys(keys)
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            invalidations=self.invalidations,
+            size=len(self._rows),
+        )
+
+
+row_cache = RowCache()
+
+
+def _needs_invalidation(obj, deleted):
+    from otree.models import Session
+    from otree.models.group import BaseGroup
+    from otree.models.subsession import BaseSubsession
+
+    if not isinstance(obj, (Session, BaseSubsession, BaseGroup)):
+        return False
+    if deleted:
+        return True
+    # e.g. changing session.vars doesn't affect the cached values.
+    # committed_state has the attributes that were modified.
+    state = sqlalchemy.inspect(obj)
+    return any(
+        state.attrs[attr].history.has_changes()
+        for attr in state.committed_state
+        if attr not in UNCACHED_COLUMNS
+    )
+
+
+@event.listens_for(DBSession, 'after_begin')
+def _after_begin(session, transaction, connection):
+    session.info['row_cache_generation'] = row_cache._generation
+
+
+@event.listens_for(DBSession, 'after_flush')
+def _after_flush(session, flush_context):
+    if not ROW_CACHE_ENABLED:
+        return
+    keys = [
+        (type(obj), obj.id)
+        for objs, deleted in [(session.dirty, False), (session.deleted, True)]
+        for obj in objs
+        if _needs_invalidation(obj, deleted)
+    ]
+    if keys:
+        row_cache._invalidate_keys(keys)
+        # another transaction could re-read the old row before we commit,
+        # so invalidate again after commit.
+        session.info.setdefault('row_cache_flushed_keys', []).extend(keys)
+
+
+@event.listens_for(DBSession, 'after_commit')
+def _after_commit(session):
+    keys = session.info.pop('row_cache_flushed_keys', None)
+    if keys:
+        row_cache._invalidate_keys(keys)
+
+
+@event.listens_for(DBSession, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+    session.info.pop('row_cache_flushed_keys', None)
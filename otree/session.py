@@ -14,6 +14,7 @@ from otree.common import (
     get_constants,
 )
 from otree.currency import RealWorldCurrency
+from otree.lookup import warm_session_lookups
 from otree.models import Participant, Session
 from otree.constants import BaseConstants, get_roles, get_role
 
@@ -277,65 +278,62 @@ def create_session(
 
     try:
         session_code = session.code
-        participants = [
-            Participant(
-                id_in_session=id_in_session,
-                session=session,
-                _session_code=session_code,
-            )
-            for id_in_session in list(range(1, num_participants + 1))
-        ]
-
-        db.add_all(participants)
-        db.commit()
-
-        # participant_values = (
-        #     db.query(Participant)
-        #     .filter(Session.id == session.id)
-        #     .order_by('id')
-        #     .with_entities(Participant.id, Participant.code)
-        # ).all()
-
-        participant_values = (
-            db.query(Participant)
-            .join(Session)
-            .filter(Session.id == session.id)
-            .order_by(Participant.id)
-            .with_entities(Participant.id, Participant.code)
-        ).all()
+        session_id = session.id
 
+        # rows are inserted with SQLAlchemy Core rather than as ORM objects,
+        # which matters for big sessions (e.g. 2000 participants x 40 rounds).
+        # ORM objects are only loaded afterwards, for creating_session.
+        apps = []
         num_pages = 0
-
         for app_name in session_config['app_sequence']:
-
             views_module = common.get_pages_module(app_name)
-            models_module = get_main_module(app_name)
             num_rounds = get_builtin_constant(app_name, 'num_rounds')
             num_subsessions += num_rounds
-
-            round_numbers = list(range(1, num_rounds + 1))
-
             num_pages += num_rounds * len(views_module.page_sequence)
+            apps.append((app_name, num_rounds))
+
+        db.bulk_insert(
+            Participant,
+            (
+                dict(
+                    id_in_session=id_in_session,
+                    session_id=session_id,
+                    _session_code=session_code,
+                    _max_page_index=num_pages,
+                )
+                for id_in_session in range(1, num_participants + 1)
+            ),
+        )
 
+        participant_ids = [
+            id
+            for [id] in dbq(Participant)
+            .filter(Participant.session_id == session_id)
+            .order_by(Participant.id)
+            .with_entities(Participant.id)
+        ]
+
+        for app_name, num_rounds in apps:
+            models_module = get_main_module(app_name)
             Subsession = models_module.Subsession
             Group = models_module.Group
             Player = models_module.Player
             Constants = get_constants(app_name)
 
-            subsessions = [
-                Subsession(round_number=round_number, session=session)
-                for round_number in round_numbers
-            ]
-
-            db.add_all(subsessions)
-            db.commit()
+            db.bulk_insert(
+                Subsession,
+                (
+                    dict(round_number=round_number, session_id=session_id)
+                    for round_number in range(1, num_rounds + 1)
+                ),
+            )
 
             subsessions = (
                 dbq(Subsession)
-                .filter_by(session=session)
-                .order_by('round_number')
-                .with_entities('id', 'round_number')
-            )
+                .filter(Subsession.session_id == session_id)
+                .order_by(Subsession.round_number)
+                .with_entities(Subsession.id, Subsession.round_number)
+            ).all()
 
             ppg = Constants.get_normalized('players_per_group')
             if ppg is None or Subsession._has_group_by_arrival_time():
@@ -343,57 +341,51 @@ def create_session(
 
             num_groups_per_round = int(num_participants / ppg)
 
-            groups_to_create = []
-            for ss_id, ss_rd in subsessions:
-                for id_in_subsession in range(1, num_groups_per_round + 1):
-                    groups_to_create.append(
-                        Group(
-                            session=session,
-                            subsession_id=ss_id,
-                            round_number=ss_rd,
-                            id_in_subsession=id_in_subsession,
-                        )
+            db.bulk_insert(
+                Group,
+                (
+                    dict(
+                        session_id=session_id,
+                        subsession_id=ss_id,
+                        round_number=ss_rd,
+                        id_in_subsession=id_in_subsession,
                     )
-
-            db.add_all(groups_to_create)
-
-            groups = (
-                dbq(Group).filter_by(session=session).order_by('id_in_subsession')
-            ).all()
+                    for ss_id, ss_rd in subsessions
+                    for id_in_subsession in range(1, num_groups_per_round + 1)
+                ),
+            )
 
             groups_lookup = defaultdict(list)
+            for group_id, ss_id in (
+                dbq(Group)
+                .filter(Group.session_id == session_id)
+                .order_by(Group.subsession_id, Group.id_in_subsession)
+                .with_entities(Group.id, Group.subsession_id)
+            ):
+                groups_lookup[ss_id].append(group_id)
+
+            roles = get_roles(Constants)
+            role_for_id_in_group = [
+                get_role(roles, id_in_group) for id_in_group in range(1, ppg + 1)
+            ]
 
-            for group in groups:
-
-                groups_lookup[group.subsession_id].append(group.id)
-
-            players_to_create = []
-
-            for ss_id, ss_rd in subsessions:
-                roles = get_roles(Constants)
-                participant_index = 0
-                for group_id in groups_lookup[ss_id]:
-                    for id_in_group in range(1, ppg + 1):
-                        participant = participant_values[participant_index]
-                        players_to_create.append(
-                            Player(
-                                session=session,
+            def player_rows():
+                for ss_id, ss_rd in subsessions:
+                    participant_index = 0
+                    for group_id in groups_lookup[ss_id]:
+                        for id_in_group in range(1, ppg + 1):
+                            yield dict(
+                                session_id=session_id,
                                 subsession_id=ss_id,
                                 round_number=ss_rd,
-                                participant_id=participant[0],
+                                participant_id=participant_ids[participant_index],
                                 group_id=group_id,
                                 id_in_group=id_in_group,
-                                _role=get_role(roles, id_in_group),
+                                _role=role_for_id_in_group[id_in_group - 1],
                             )
-                        )
-                        participant_index += 1
-
-            # Create players
-            db.add_all(players_to_create)
+                            participant_index += 1
 
-        dbq(Participant).filter_by(session=session).update(
-            {Participant._max_page_index: num_pages}
-        )
+            db.bulk_insert(Player, player_rows())
 
         for subsession in session.get_subsessions():
             target = subsession.get_user_defined_target()
@@ -410,6 +402,7 @@ def create_session(
             room.set_session(session)
 
         db.commit()
+        warm_session_lookups(session.code)
         return session
     except Exception:
         # another way would be to look into nested transactions,
@@ -1,104 +1,232 @@
+import asyncio
+import heapq
+import itertools
 import json
-from logging import getLogger
+import math
+import os
 import time
-from time import sleep
-from urllib import request, parse
-from urllib.error import URLError
-from urllib.parse import urljoin
-from otree.database import db, session_scope
-import otree.constants
-from otree.models_concrete import TaskQueueMessage
+from collections import defaultdict
+from logging import getLogger
 
-print_function = print
+from starlette.concurrency import run_in_threadpool
 
+import otree.common
+from otree.database import session_scope
+from otree.models_concrete import TaskQueueMessage
 
 logger = getLogger(__name__)
 
+# set by otree.dispatcher when running several worker processes
+WORKER_INDEX = int(os.getenv('OTREE_WORKER_INDEX') or 0)
+NUM_WORKERS = int(os.getenv('OTREE_NUM_WORKERS') or 1)
+
+
+class TaskScheduler:
+    """
+    Runs page timeouts inside the server process.
+    Pending tasks are kept in a heap ordered by due time, so each one runs
+    as soon as it's due, rather than on the next poll of the DB.
+    They are also saved as TaskQueueMessage rows, so that tasks
+    that were pending when the server stopped are run after it restarts.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # tie-breaker so that heapq never compares the kwargs
+        self._counter = itertools.count()
+        self._loop = None
+        self._wakeup = None
+        self.num_run = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def start(self):
+        self._loop = asyncio.get_event_loop()
+        self._wakeup = asyncio.Event()
+        with session_scope():
+            # delete all old stuff
+            TaskQueueMessage.objects_filter(
+                TaskQueueMessage.epoch_time < time.time() - 60
+            ).delete()
+            for task in TaskQueueMessage.objects_filter():
+                if self._is_for_this_worker(task.kwargs_json):
+                    self._push(task.epoch_time, task.method, task.kwargs_json)
+        self._loop.create_task(self._run())
+
+    def _is_for_this_worker(self, kwargs_json):
+        """
+        With several workers, a task must run in the worker that handles
+        its session, because that worker keeps in-process state about the session
+        (locks, wait page arrivals).
+        """
+        if NUM_WORKERS == 1:
+            return True
+        from otree.dispatcher import worker_for_session
+        from otree.models import Participant
+
+        kwargs = json.loads(kwargs_json)
+        session_code = kwargs.get('session_code')
+        if session_code is None and 'participant_code' in kwargs:
+            # tasks saved by an older version
+            participant = Participant.objects_filter(
+                code=kwargs['participant_code']
+            ).first()
+            session_code = participant and participant._session_code
+        return worker_for_session(session_code, NUM_WORKERS) == WORKER_INDEX
+
+    def schedule(self, run_at, method, kwargs_json):
+        # usually called from a worker thread, while handling a request
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._push, run_at, method, kwargs_json)
+
+    def _push(self, run_at, method, kwargs_json):
+        heapq.heappush(self._heap, (run_at, next(self._counter), method, kwargs_json))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if self._heap:
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+            else:
+                await self._wakeup.wait()
+                continue
+
+            now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap))
+            try:
+                await self._run_due(due)
+            except Exception as exc:
+                # don't raise, because then this would crash.
+                logger.exception(repr(exc))
+
+    async def _run_due(self, due):
+        from otree.middleware import session_locks
+
+        by_session = defaultdict(list)
+        for task in due:
+            _, _, method, kwargs_json = task
+            kwargs = json.loads(kwargs_json)
+            session_code = kwargs.get('session_code')
+            if session_code is None and 'participant_code' in kwargs:
+                session_code = session_locks.session_code_for_participant(
+                    kwargs['participant_code']
+                )
+            by_session[session_code].append(task)
+
+        async def run_for_session(session_code, tasks):
+            async with session_locks.acquire(session_code):
+                await run_in_threadpool(self._run_tasks, tasks)
+
+        await asyncio.gather(
+            *[run_for_session(code, tasks) for code, tasks in by_session.items()]
+        )
 
-def post(url, data: dict):
-    '''
-    make the request over the network rather than in-process,
-    to avoid race conditions. everything must be handled by the main
-    server instance.
-    '''
-    data = parse.urlencode(data).encode()
-    req = request.Request(url, data=data)  # this will make the method "POST"
-    resp = request.urlopen(req)
+    def _run_tasks(self, tasks):
+        """
+        all due tasks for 1 session.
+        each task gets its own transaction, like the request it replaces,
+        so a task that fails doesn't roll back (or half-commit) the others.
+        """
+        for run_at, _, method, kwargs_json in tasks:
+            # with several server processes, each one loads the pending tasks
+            # at startup, so claim the task by deleting its row.
+            # this is committed even if the task fails, so it isn't retried.
+            with session_scope():
+                num_claimed = TaskQueueMessage.objects_filter(
+                    method=method, kwargs_json=kwargs_json, epoch_time=math.ceil(run_at)
+                ).delete()
+            if not num_claimed:
+                continue
+            lateness = time.time() - run_at
+            self.num_run += 1
+            self.total_lateness += lateness
+            self.max_lateness = max(self.max_lateness, lateness)
+            kwargs = json.loads(kwargs_json)
+            kwargs.pop('session_code', None)
+            try:
+                with session_scope():
+                    TASK_METHODS[method](**kwargs)
+            except Exception as exc:
+                # session_scope() already rolled it back.
+                # logger.exception() will record the full traceback
+                logger.exception(repr(exc))
+
+    def stats(self):
+        return dict(
+            pending=len(self._heap),
+            run=self.num_run,
+            mean_lateness_ms=round(
+                1000 * self.total_lateness / self.num_run if self.num_run else 0
+            ),
+            max_lateness_ms=round(1000 * self.max_lateness),
+        )
 
 
-def get(url):
-    try:
-        request.urlopen(url)
-    # some users were reporting URLError but not clear what URL it was
-    except URLError as exc:
-        raise Exception(f'Error occurred when opening {url}: {repr(exc)}') from None
+scheduler = TaskScheduler()
 
 
-class Worker:
-    def __init__(self, port):
-        self.base_url = f'http://127.0.0.1:{port}'
-        # delete all old stuff
+def start_task_scheduler():
+    if otree.common.USE_TIMEOUT_WORKER:
+        scheduler.start()
 
-        TaskQueueMessage.objects_filter(
-            TaskQueueMessage.epoch_time < time.time() - 60
-        ).delete()
 
-    def listen(self):
-        print_function('timeoutworker is listening for messages through DB')
+def _submit_expired_url(participant_code, page_index):
+    from otree.channels.utils import auto_advance_group, sync_group_send
+    from otree.models.participant import Participant
 
-        while True:
-            with session_scope():
-                for task in TaskQueueMessage.objects_filter(
-                    TaskQueueMessage.epoch_time <= time.time()
-                ).order_by('epoch_time'):
-                    try:
-                        getattr(self, task.method)(**task.kwargs())
-                    except Exception as exc:
-                        # don't raise, because then this would crash.
-                        # logger.exception() will record the full traceback
-                        logger.exception(repr(exc))
-                    db.delete(task)
-            sleep(3)
-
-    def submit_expired_url(self, participant_code, page_index):
-        from otree.models.participant import Participant
-
-        # if the participant exists in the DB,
-        # and they did not advance past the page yet
-
-        pp = Participant.objects_filter(
-            code=participant_code, _index_in_pages=page_index
-        ).first()
-        if pp:
-            path = pp._url_i_should_be_on()
-            logger.info(f'Auto-submitting timed out page: {path}')
-            post(
-                urljoin(self.base_url, path),
-                data={otree.constants.timeout_happened: True},
-            )
-
-    def ensure_pages_visited(self, participant_pks, page_index):
-
-        from otree.models.participant import Participant
-
-        unvisited_participants = Participant.objects_filter(
-            Participant.id.in_(participant_pks),
-            Participant._index_in_pages <= page_index + 1,
+    # if the participant exists in the DB,
+    # and they did not advance past the page yet
+    pp = Participant.objects_filter(
+        code=participant_code, _index_in_pages=page_index
+    ).first()
+    if pp:
+        logger.info(f'Auto-submitting timed out page: {pp._url_i_should_be_on()}')
+        pp._submit_current_page()
+        pp._visit_current_page()
+        sync_group_send(
+            group=auto_advance_group(pp.code), data={'auto_advanced': True}
         )
-        for pp in unvisited_participants:
 
-            path = pp._url_i_should_be_on()
-            logger.info(f'Auto-submitting timed out page: {path}')
 
-            get(urljoin(self.base_url, path))
+def _ensure_pages_visited(participant_pks, page_index):
+    from otree.models.participant import Participant
+
+    unvisited_participants = Participant.objects_filter(
+        Participant.id.in_(participant_pks),
+        Participant._index_in_pages <= page_index + 1,
+    )
+    for pp in unvisited_participants:
+        logger.info(f'Visiting page: {pp._url_i_should_be_on()}')
+        if pp._index_in_pages == 0:
+            pp.initialize(None)
+        pp._visit_current_page()
+
+
+TASK_METHODS = dict(
+    submit_expired_url=_submit_expired_url,
+    ensure_pages_visited=_ensure_pages_visited,
+)
 
 
 def _db_enqueue(method, delay, kwargs):
+    run_at = time.time() + delay
+    kwargs_json = json.dumps(kwargs)
     TaskQueueMessage.objects_create(
+        # round up, so that after a restart it doesn't run early
         method=method,
-        epoch_time=delay + round(time.time()),
-        kwargs_json=json.dumps(kwargs),
+        epoch_time=math.ceil(run_at),
+        kwargs_json=kwargs_json,
     )
+    scheduler.schedule(run_at, method, kwargs_json)
 
 
 def ensure_pages_visited(delay, **kwargs):
@@ -24,6 +24,7 @@ import otree.models
 import otree.tasks
 import otree.views.cbv
 from otree import settings
+from otree.arrivals import arrival_counters, MAX_UNVISITED_FOR_SCAN
 from otree.bots.bot import bot_prettify_post_data
 from otree.common import (
     get_app_label_from_import_path,
@@ -34,12 +35,15 @@ from otree.common import (
     NON_FIELD_ERROR_KEY,
     get_constants,
 )
+from otree.completions import completions
 from otree.currency import json_dumps
-from otree.database import db, dbq
+from otree.database import db, dbq, supports_concurrent_sessions
 from otree.forms.forms import get_form
 from otree.i18n import core_gettext
-from otree.lookup import get_min_idx_for_app, get_page_lookup
+from otree.lookup import get_current_player, get_min_idx_for_app, get_page_lookup
+from otree.middleware import session_locks
 from otree.models import Participant, Session, BaseGroup, BaseSubsession
+from otree.row_cache import row_cache, ROW_CACHE_ENABLED
 from otree.models_concrete import (
     CompletedSubsessionWaitPage,
     CompletedGroupWaitPage,
@@ -94,6 +98,12 @@ class FormPageOrInGameWaitPage:
         participant = db.get_or_404(Participant, code=participant_code, msg=(
             "This user does not exist in the database. " "Maybe the database was reset."
         ))
+        # so that later requests for this participant only need the session's lock
+        session_locks.remember(
+            participant_code=participant.code,
+            session_pk=participant.session_id,
+            session_code=participant._session_code,
+        )
 
         # if the player tried to skip past a part of the subsession
         # (e.g. by typing in a future URL)
@@ -112,9 +122,17 @@ class FormPageOrInGameWaitPage:
                 # "RuntimeError: No response returned"
                 response = starlette.responses.Response()
             else:
-                response = await run_in_threadpool(self.inner_dispatch, request)
+                response = await run_in_threadpool(self._inner_dispatch_and_commit, request)
         await response(self.scope, self.receive, self.send)
 
+    def _inner_dispatch_and_commit(self, request):
+        response = self.inner_dispatch(request)
+        if supports_concurrent_sessions():
+            # commit while still in the worker thread, so that the transaction
+            # (and any DB write lock) doesn't stay open while we wait for the event loop.
+            db.commit()
+        return response
+
     template_name = None
 
     is_debug = settings.DEBUG
@@ -237,13 +255,14 @@ class FormPageOrInGameWaitPage:
     def subsession(self) -> BaseSubsession:
         '''so that it doesn't rely on player'''
         # this goes through idmap cache, so no perf hit
-        return self.SubsessionClass.objects_get(id=self._subsession_pk)
+        return row_cache.get(self.SubsessionClass, self._subsession_pk)
 
     @property
     def session(self) -> Session:
-        return Session.objects_get(id=self._session_pk)
+        return row_cache.get(Session, self._session_pk)
 
-    def set_attributes(self, participant):
+    def set_attributes(self, participant, player=None):
+        '''player can be passed if it was already loaded'''
 
         lookup = get_page_lookup(participant._session_code, participant._index_in_pages)
         self._lookup = lookup
@@ -256,9 +275,9 @@ class FormPageOrInGameWaitPage:
         self.PlayerClass = getattr(models_module, 'Player')
         self.GroupClass = getattr(models_module, 'Group')
         self.SubsessionClass = getattr(models_module, 'Subsession')
-        self.player = self.PlayerClass.objects_get(
-            participant=participant, round_number=lookup.round_number
-        )
+        if player is None:
+            player = get_current_player(self.PlayerClass, participant)
+        self.player = player
         self._subsession_pk = lookup.subsession_id
         self.round_number = lookup.round_number
         self._session_pk = lookup.session_pk
@@ -270,6 +289,13 @@ class FormPageOrInGameWaitPage:
         # it's already validated that participant is on right page
         self._index_in_pages = participant._index_in_pages
 
+        if ROW_CACHE_ENABLED:
+            # so that player.session, player.group etc. don't need a query
+            row_cache.preload(Session, self._session_pk)
+            row_cache.preload(self.SubsessionClass, self._subsession_pk)
+            if self.player.group_id is not None:
+                row_cache.preload(self.GroupClass, self.player.group_id)
+
         # for the participant changelist
         participant._current_app_name = app_name
         participant._current_page_name = self.__class__.__name__
@@ -304,6 +330,11 @@ class FormPageOrInGameWaitPage:
 
         page_index_to_skip_to = self._get_next_page_index_if_skipping_apps()
         is_skipping_apps = bool(page_index_to_skip_to)
+        stop_index = page_index_to_skip_to or participant._max_page_index + 1
+
+        # usually the next page is displayed, so we only start preloading
+        # once a page is skipped. {app_name: {round_number: player}}
+        preloaded_players = None
 
         for page_index in range(
             self._index_in_pages + 1,
@@ -314,16 +345,31 @@ class FormPageOrInGameWaitPage:
                 # break and go to OutOfRangeNotification
                 break
             if is_skipping_apps and page_index == page_index_to_skip_to:
+                participant._register_wait_page_arrival()
                 break
 
+            lookup = get_page_lookup(participant._session_code, page_index)
             # scope, receive, send
-            page = get_page_lookup(
-                participant._session_code, page_index
-            ).page_class.instantiate_without_request()
+            page = lookup.page_class.instantiate_without_request()
 
-            page.set_attributes(self.participant)
+            if preloaded_players is None:
+                page.set_attributes(participant)
+            else:
+                if lookup.app_name not in preloaded_players:
+                    preloaded_players[lookup.app_name] = self._preload_players(
+                        lookup.app_name, page_index, stop_index
+                    )
+                page.set_attributes(
+                    participant,
+                    player=preloaded_players[lookup.app_name].get(lookup.round_number),
+                )
             if not is_skipping_apps and page._is_displayed():
+                if isinstance(page, WaitPage) and not page.group_by_arrival_time:
+                    # they count as arrived from now on, even before they load it.
+                    page._register_arrival()
                 break
+            if preloaded_players is None:
+                preloaded_players = {}
 
             # if it's a wait page, record that they visited
             if isinstance(page, WaitPage):
@@ -331,6 +377,10 @@ class FormPageOrInGameWaitPage:
                 if page.group_by_arrival_time:
                     continue
 
+                page._register_arrival()
+                if page._arrival_is_not_last():
+                    continue
+
                 # save the participant, because tally_unvisited
                 # queries index_in_pages directly from the DB
                 db.commit()
@@ -339,6 +389,23 @@ class FormPageOrInGameWaitPage:
                 if is_last and someone_waiting:
                     page._run_aapa_and_notify(page._group_or_subsession)
 
+    def _preload_players(self, app_name, start_index, stop_index):
+        '''
+        load this participant's players for the rest of the app in 1 query,
+        rather than 1 query per page.
+        '''
+        session_code = self.participant._session_code
+        round_numbers = {
+            get_page_lookup(session_code, idx).round_number
+            for idx in range(start_index, stop_index)
+            if get_page_lookup(session_code, idx).app_name == app_name
+        }
+        Player = getattr(otree.common.get_main_module(app_name), 'Player')
+        players = Player.objects_filter(
+            Player.round_number.in_(round_numbers), participant=self.participant
+        )
+        return {player.round_number: player for player in players}
+
     def is_displayed(self):
         return True
 
@@ -389,6 +456,14 @@ class FormPageOrInGameWaitPage:
         )
 
     live_method = ''
+    # if set, liveSend messages from a participant that arrive within this many
+    # milliseconds of the last one they sent are merged: only the latest one
+    # for each key is passed to live_method, at the end of the window.
+    # useful for sliders and other inputs that send on every change.
+    live_coalesce_ms = None
+    # the key is this field of the message, e.g. liveSend({'type': 'slider', ...}).
+    # messages that aren't dicts, or don't have the field, share 1 key.
+    live_coalesce_key = 'type'
 
 
 class Page(FormPageOrInGameWaitPage):
@@ -730,6 +805,7 @@ class Page(FormPageOrInGameWaitPage):
                 otree.tasks.submit_expired_url(
                     participant_code=self.participant.code,
                     page_index=self.participant._index_in_pages,
+                    session_code=self.participant._session_code,
                     # add some seconds to account for latency of request + response
                     # this will (almost) ensure
                     # (1) that the page will be submitted by JS before the
@@ -862,10 +938,11 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
 
     def inner_dispatch_group(self):
         ## EARLY EXITS
-        if CompletedGroupWaitPage.objects_exists(
+        if completions.exists(
+            CompletedGroupWaitPage,
+            self._session_pk,
             page_index=self._index_in_pages,
             group_id=self.player.group_id,
-            session_id=self._session_pk,
         ):
             return self._response_when_ready()
         is_displayed = self._is_displayed()
@@ -878,8 +955,10 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
 
     def inner_dispatch_subsession(self):
 
-        if CompletedSubsessionWaitPage.objects_exists(
-            page_index=self._index_in_pages, session=self.session
+        if completions.exists(
+            CompletedSubsessionWaitPage,
+            self._session_pk,
+            page_index=self._index_in_pages,
         ):
             return self._response_when_ready()
 
@@ -892,10 +971,11 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
         return self._response_when_ready()
 
     def inner_dispatch_gbat(self):
-        if CompletedGBATWaitPage.objects_exists(
+        if completions.exists(
+            CompletedGBATWaitPage,
+            self._session_pk,
             page_index=self._index_in_pages,
             id_in_subsession=self.group.id_in_subsession,
-            session=self.session,
         ):
             return self._response_when_ready()
 
@@ -989,14 +1069,33 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
 
         if self.wait_for_all_groups:
             CompletedSubsessionWaitPage.objects_create(**base_kwargs)
+            completions.add(
+                CompletedSubsessionWaitPage,
+                self._session_pk,
+                page_index=self._index_in_pages,
+            )
         elif self.group_by_arrival_time:
             db.add(
                 CompletedGBATWaitPage(
                     **base_kwargs, id_in_subsession=group.id_in_subsession
                 )
             )
+            completions.add(
+                CompletedGBATWaitPage,
+                self._session_pk,
+                page_index=self._index_in_pages,
+                id_in_subsession=group.id_in_subsession,
+            )
         else:
             db.add(CompletedGroupWaitPage(**base_kwargs, group_id=group.id))
+            completions.add(
+                CompletedGroupWaitPage,
+                self._session_pk,
+                page_index=self._index_in_pages,
+                group_id=group.id,
+            )
+        if not self.group_by_arrival_time:
+            arrival_counters.discard(self._session_pk, self._arrivals_key())
 
         participants = self._get_participants_for_this_waitpage(
             group or self.subsession
@@ -1015,6 +1114,7 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
                 participant_pks=[pp.id for pp in participants],
                 delay=10,
                 page_index=self._index_in_pages,
+                session_code=self.participant._session_code,
             )
 
         if self.group_by_arrival_time:
@@ -1062,11 +1162,39 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
                 group_id=self.player.group_id,
             )
 
+    def _arrivals_key(self):
+        if self.wait_for_all_groups:
+            return (self._index_in_pages, 's', self.player.subsession_id)
+        return (self._index_in_pages, 'g', self.player.group_id)
+
+    def _register_arrival(self):
+        '''call this once, when _index_in_pages moves onto this page'''
+        arrival_counters.arrive(self._session_pk, self._arrivals_key())
+
+    def _arrival_is_not_last(self):
+        '''
+        returns True if the arrival count shows that others are definitely
+        still missing.
+        '''
+        tally = arrival_counters.get(self._session_pk, self._arrivals_key())
+        if tally is None:
+            return False
+        if tally.num_unvisited > MAX_UNVISITED_FOR_SCAN:
+            arrival_counters.hits += 1
+            return True
+        return False
+
     def _tally_unvisited(self):
+        if self._arrival_is_not_last():
+            # someone_waiting only matters if is_last
+            return (False, False)
+        key = self._arrivals_key()
 
-        participants = self._get_participants_for_this_waitpage(
-            self._group_or_subsession
+        participants = list(
+            self._get_participants_for_this_waitpage(self._group_or_subsession)
         )
+        # also corrects the tally in case it drifted from the DB
+        arrival_counters.seed(self._session_pk, key, participants, self._index_in_pages)
         session_code = self.participant._session_code
 
         visited = []
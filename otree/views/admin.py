@@ -13,18 +13,24 @@ import otree.channels.utils as channel_utils
 import otree.common
 import otree.database
 import otree.models
+import otree.tasks
 import otree.views.cbv
 from otree import export, settings
+from otree.arrivals import arrival_counters
 from otree.common import (
     get_main_module,
     DebugTable,
     AUTH_COOKIE_NAME,
     AUTH_COOKIE_VALUE,
 )
+from otree.completions import completions
 from otree.constants import ADVANCE_SLOWEST_BATCH_SIZE
 from otree.currency import RealWorldCurrency
 from otree.database import values_flat, save_sqlite_db, db
+from otree.live import live_queues, live_send_stats
+from otree.lookup import session_pages
 from otree.models import Session
+from otree.row_cache import row_cache, ROW_CACHE_ENABLED
 from otree.session import SESSION_CONFIGS_DICT, SessionConfig
 from otree.templating import get_template_name_if_exists
 from otree.views.cbv import AdminSessionPage, AdminView
@@ -222,6 +228,7 @@ class SessionEditProperties(AdminSessionPage):
             config['real_world_currency_per_point'] = rwc_per_point
         # need to do this to get SQLAlchemy to detect a change
         session.config = config
+        row_cache.invalidate_session(session.id)
         enqueue_admin_message('success', 'Properties have been updated')
         return self.redirect('SessionEditProperties', code=session.code)
 
@@ -446,6 +453,69 @@ def get_installed_and_pypi_version() -> dict:
     return dict(newest=newest_dotted, installed=installed_dotted)
 
 
+def get_perf_stats():
+    rows = []
+    for k, v in channel_utils.channel_layer.stats().items():
+        rows.append((f'Websocket sends {k}', v))
+    for row in channel_utils.channel_layer.fanout_stats():
+        rows.append(
+            (
+                f"Fan-out {row['group']}",
+                f"{row['broadcasts']} broadcasts to {row['sockets']} sockets, "
+                f"mean {row['mean_ms']}ms, max {row['max_ms']}ms",
+            )
+        )
+    for k, v in live_queues.stats().items():
+        rows.append((f'Live method queue {k}', v))
+    for row in live_queues.group_stats():
+        rows.append(
+            (
+                f"Live method queue {row['group']}",
+                f"{row['pending']} pending, {row['messages']} messages, "
+                f"max {row['max_pending']} pending, max wait {row['max_wait_ms']}ms",
+            )
+        )
+    for page_key, d in live_send_stats.stats().items():
+        rows.append(
+            (
+                f'Live replies {page_key}',
+                f"{d['replies']} replies, {d['encodings']} encodings, "
+                f"{d['messages']} messages, {d['bytes']} bytes",
+            )
+        )
+    if otree.database.snapshotter:
+        for k, v in otree.database.snapshotter.stats().items():
+            rows.append((f'DB snapshots {k}', v))
+    if otree.common.USE_TIMEOUT_WORKER:
+        for k, v in otree.tasks.scheduler.stats().items():
+            rows.append((f'Timeouts {k}', v))
+    if ROW_CACHE_ENABLED:
+        for k, v in row_cache.stats().items():
+            rows.append((f'Row cache {k}', v))
+    for k, v in session_pages.stats().items():
+        rows.append((f'Page lookups {k}', v))
+    for k, v in arrival_counters.stats().items():
+        rows.append((f'Wait page arrivals {k}', v))
+    for k, v in completions.stats().items():
+        rows.append((f'Wait page completions {k}', v))
+    session_stats = completions.session_stats()
+    if session_stats:
+        codes = dict(
+            Session.objects_filter(Session.id.in_(list(session_stats))).with_entities(
+                Session.id, Session.code
+            )
+        )
+        for session_id, d in session_stats.items():
+            if session_id in codes:
+                rows.append(
+                    (
+                        f'Wait page completions, session {codes[session_id]}',
+                        f"{d['saved']} DB queries saved, {d['queried']} made",
+                    )
+                )
+    return rows
+
+
 class ServerCheck(AdminView):
     url_pattern = '/server_check'
 
@@ -459,6 +529,7 @@ class ServerCheck(AdminView):
             pypi_results=get_installed_and_pypi_version(),
             is_postgres=is_postgres,
             backend_name=backend_name,
+            perf_stats=get_perf_stats(),
             **kwargs,
         )
 
@@ -1,19 +1,29 @@
-import csv
 import datetime
-from io import StringIO
+import functools
+import secrets
+import threading
+import time
+from typing import Optional
 
+from starlette.concurrency import run_in_threadpool
 from starlette.endpoints import HTTPEndpoint
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
 
 import otree.common
 import otree.export
 import otree.models
-from otree.database import dbq
+from otree import settings
+from otree.common2 import write_page_completion_buffer
+from otree.database import create_session, db, dbq, supports_concurrent_sessions
 from otree.export import BOM, get_installed_apps_with_data
+from otree.middleware import session_locks
 from otree.models.participant import Participant
 from otree.models_concrete import ChatMessage
 from . import cbv
 
+# how long the link that WSExportData gives the browser stays valid
+DOWNLOAD_TOKEN_SECONDS = 60
+
 
 class Export(cbv.AdminView):
     url_pattern = '/export'
@@ -38,15 +48,77 @@ class Export(cbv.AdminView):
         )
 
 
-def get_csv_http_response(buffer: StringIO, filename_prefix) -> Response:
-    buffer.seek(0)
-    response = Response(buffer.read())
+def get_csv_http_response(
+    make_chunks, filename_prefix, for_excel=False, separator='-'
+) -> Response:
+    """
+    make_chunks is a function that returns an iterable of CSV text,
+    e.g. otree.export.iter_export_wide.
+    It's called while the response is being sent,
+    so the export doesn't have to fit in memory
+    (unless the DB has just 1 connection, see _stream_export).
+    """
     date = datetime.date.today().isoformat()
-    response.headers['Content-Type'] = 'text/csv'
-    response.headers[
-        'Content-Disposition'
-    ] = f'attachment; filename="{filename_prefix}-{date}.csv"'
-    return response
+    file_name = f'{filename_prefix}{separator}{date}.csv'
+    return StreamingResponse(
+        _stream_export(make_chunks, for_excel),
+        media_type='text/csv',
+        headers={'Content-Disposition': f'attachment; filename="{file_name}"'},
+    )
+
+
+class _ExportBody:
+    """
+    The body is sent after the view returns, when the request's DB session
+    has been committed and its lock released.
+    So it has its own DB session.
+    """
+
+    def __init__(self, make_chunks):
+        self._make_chunks = make_chunks
+        self._chunks = None
+        self._session = create_session()
+
+    def next_chunk(self) -> Optional[str]:
+        with db.use_session(self._session):
+            if self._chunks is None:
+                self._chunks = iter(self._make_chunks())
+            return next(self._chunks, None)
+
+    def read_all(self) -> list:
+        try:
+            with db.use_session(self._session):
+                return list(self._make_chunks())
+        finally:
+            self._session.close()
+
+    def close(self):
+        self._session.close()
+
+
+async def _stream_export(make_chunks, for_excel):
+    if for_excel:
+        # Excel requires BOM; otherwise non-english characters are garbled
+        yield BOM.encode('utf-8')
+    body = _ExportBody(make_chunks)
+    if not supports_concurrent_sessions():
+        # there is just 1 connection, so the export's session can't stay open
+        # while other requests use the connection between chunks.
+        # build it all in 1 go, under the lock, and close the session.
+        async with session_locks.acquire():
+            chunks = await run_in_threadpool(body.read_all)
+        for chunk in chunks:
+            yield chunk.encode('utf-8')
+        return
+    # it has its own connection, so it doesn't have to wait for anyone
+    try:
+        while True:
+            chunk = await run_in_threadpool(body.next_chunk)
+            if chunk is None:
+                return
+            yield chunk.encode('utf-8')
+    finally:
+        await run_in_threadpool(body.close)
 
 
 class ExportSessionWide(HTTPEndpoint):
@@ -61,12 +133,11 @@ class ExportSessionWide(HTTPEndpoint):
         # and it's also a good feature to demo oTree)
         if request.query_params.get('token') != otree.common.DATA_EXPORT_HASH:
             return Response(status_code=400, content="Missing or incorrect auth token")
-        buf = StringIO()
-        if bool(request.query_params.get('excel')):
-            # BOM
-            buf.write(BOM)
-        otree.export.export_wide(buf, session_code=code)
-        return get_csv_http_response(buf, 'all_apps_wide')
+        return get_csv_http_response(
+            lambda: otree.export.iter_export_wide(session_code=code),
+            'all_apps_wide',
+            for_excel=bool(request.query_params.get('excel')),
+        )
 
 
 class ExportPageTimes(HTTPEndpoint):
@@ -74,10 +145,9 @@ class ExportPageTimes(HTTPEndpoint):
     url_pattern = '/ExportPageTimes'
 
     def get(self, request):
-        buf = StringIO()
-        otree.export.export_page_times(buf)
-        response = get_csv_http_response(buf, 'PageTimes')
-        return response
+        # while we still hold the request's lock
+        write_page_completion_buffer()
+        return get_csv_http_response(otree.export.iter_export_page_times, 'PageTimes')
 
 
 class ExportChat(HTTPEndpoint):
@@ -85,34 +155,70 @@ class ExportChat(HTTPEndpoint):
     url_pattern = '/chat_export'
 
     def get(self, request):
-        buf = StringIO()
-        column_names = [
-            'session_code',
-            'id_in_session',
-            'participant_code',
-            'channel',
-            'nickname',
-            'body',
-            'timestamp',
-        ]
-
-        rows = (
-            dbq(ChatMessage)
-            .join(Participant)
-            .order_by(ChatMessage.timestamp)
-            .with_entities(
-                Participant._session_code,
-                Participant.id_in_session,
-                Participant.code,
-                ChatMessage.channel,
-                ChatMessage.nickname,
-                ChatMessage.body,
-                ChatMessage.timestamp,
+        return get_csv_http_response(otree.export.iter_export_chat, 'ChatMessages')
+
+
+class DownloadTokens:
+    """
+    WSExportData hands out a token for each requested export,
+    and the browser then downloads the file from ExportData.
+    A token can only be used once, and expires after DOWNLOAD_TOKEN_SECONDS.
+    """
+
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def create(self, **params) -> str:
+        token = secrets.token_urlsafe(16)
+        now = time.monotonic()
+        with self._lock:
+            for key, [expires, _] in list(self._tokens.items()):
+                if expires < now:
+                    del self._tokens[key]
+            self._tokens[token] = [now + DOWNLOAD_TOKEN_SECONDS, params]
+        return token
+
+    def pop(self, token):
+        """returns the export's params, or None if the token isn't valid"""
+        with self._lock:
+            entry = self._tokens.pop(token, None)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+
+download_tokens = DownloadTokens()
+
+
+class ExportData(HTTPEndpoint):
+    """the download link from WSExportData"""
+
+    url_pattern = '/ExportData'
+
+    def get(self, request):
+        params = download_tokens.pop(request.query_params.get('token'))
+        if params is None:
+            return Response(
+                status_code=400, content="Download link is invalid or has expired"
             )
+        app_name = params['app_name']
+        if not app_name:
+            make_chunks = otree.export.iter_export_wide
+            file_name_prefix = 'all_apps_wide'
+        elif app_name in settings.OTREE_APPS:
+            if params['is_custom']:
+                iter_export = otree.export.iter_custom_export_app
+            else:
+                iter_export = otree.export.iter_export_app
+            make_chunks = functools.partial(iter_export, app_name)
+            file_name_prefix = app_name
+        else:
+            return Response(status_code=404, content=f"No app named {app_name}")
+        return get_csv_http_response(
+            make_chunks,
+            file_name_prefix,
+            for_excel=params['for_excel'],
+            # same file names as when the export page got the data over websocket
+            separator='_',
         )
-
-        writer = csv.writer(buf)
-        writer.writerows([column_names])
-        writer.writerows(rows)
-        response = get_csv_http_response(buf, 'ChatMessages')
-        return response
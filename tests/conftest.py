@@ -0,0 +1,24 @@
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+# otree expects to run from a project dir: it imports settings.py, finds the apps
+# by relative path, and opens db.sqlite3 there.
+# so copy this test project to a temp dir, so the DB file doesn't end up in the repo.
+TESTS_DIR = Path(__file__).parent
+PROJECT_DIR = Path(tempfile.mkdtemp())
+shutil.copy(TESTS_DIR / 'settings.py', PROJECT_DIR)
+shutil.copytree(TESTS_DIR / 'simple_app', PROJECT_DIR / 'simple_app')
+(PROJECT_DIR / '_static').mkdir()
+os.chdir(PROJECT_DIR)
+sys.path.insert(0, str(PROJECT_DIR))
+os.environ['OTREE_IN_MEMORY'] = '1'
+
+from otree.main import setup  # noqa
+
+setup()
+
+# sets up the page classes and routes, like the bots do
+import otree.asgi  # noqa
@@ -0,0 +1,15 @@
+SESSION_CONFIGS = [
+    dict(name='simple', app_sequence=['simple_app'], num_demo_participants=4),
+]
+SESSION_CONFIG_DEFAULTS = dict(
+    real_world_currency_per_point=1.00, participation_fee=0.00, doc=""
+)
+PARTICIPANT_FIELDS = []
+SESSION_FIELDS = []
+LANGUAGE_CODE = 'en'
+REAL_WORLD_CURRENCY_CODE = 'USD'
+USE_POINTS = True
+ADMIN_USERNAME = 'admin'
+ADMIN_PASSWORD = 'admin'
+DEMO_PAGE_INTRO_HTML = ""
+SECRET_KEY = 'test'
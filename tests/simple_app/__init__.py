@@ -0,0 +1,31 @@
+from otree.api import *
+
+
+class C(BaseConstants):
+    NAME_IN_URL = 'simple_app'
+    PLAYERS_PER_GROUP = 2
+    NUM_ROUNDS = 2
+
+
+class Subsession(BaseSubsession):
+    pass
+
+
+class Group(BaseGroup):
+    pass
+
+
+class Player(BasePlayer):
+    number = models.IntegerField()
+
+
+class MyPage(Page):
+    form_model = 'player'
+    form_fields = ['number']
+
+
+class WaitForAll(WaitPage):
+    wait_for_all_groups = True
+
+
+page_sequence = [WaitForAll, MyPage]
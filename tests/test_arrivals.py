@@ -0,0 +1,61 @@
+from otree.arrivals import arrival_counters
+from otree.database import db, session_scope
+from otree.models import Participant
+from otree.models_concrete import CompletedSubsessionWaitPage, WaitPageArrivals
+from otree.session import create_session
+
+
+def test_wait_page_completes_when_some_never_load_it():
+    with session_scope():
+        session = create_session('simple', num_participants=8)
+        session_id = session.id
+        codes = [p.code for p in session.get_participants()]
+
+    def start(code, visit):
+        with session_scope():
+            participant = Participant.objects_get(code=code)
+            participant.initialize(None)
+            if visit:
+                participant._visit_current_page()
+
+    # the first one to load the wait page starts the tally
+    start(codes[0], visit=True)
+    # these close the tab right after starting, so they never load the wait page
+    for code in codes[1:6]:
+        start(code, visit=False)
+    for code in codes[6:]:
+        start(code, visit=True)
+
+    with session_scope():
+        assert CompletedSubsessionWaitPage.objects_exists(session_id=session_id)
+
+
+def test_tally_is_read_back_from_its_row_after_restart():
+    with session_scope():
+        session = create_session('simple', num_participants=8)
+        session_id = session.id
+        codes = [p.code for p in session.get_participants()]
+
+    with session_scope():
+        participant = Participant.objects_get(code=codes[0])
+        participant.initialize(None)
+        participant._visit_current_page()
+    scans = arrival_counters.scans
+
+    # as if the server restarted
+    arrival_counters.invalidate_session(session_id)
+    for code in codes[1:]:
+        with session_scope():
+            Participant.objects_get(code=code).initialize(None)
+    # rolled back, so it doesn't count
+    with session_scope():
+        row = WaitPageArrivals.objects_get(session_id=session_id)
+        arrival_counters.arrive(session_id, (1, 's', row.subsession_id))
+        db.rollback()
+
+    with session_scope():
+        row = WaitPageArrivals.objects_get(session_id=session_id)
+        assert (row.num_participants, row.num_arrived) == (8, 8)
+        key = (1, 's', row.subsession_id)
+        assert arrival_counters.get(session_id, key).num_unvisited == 0
+    assert arrival_counters.scans == scans
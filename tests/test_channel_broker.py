@@ -0,0 +1,110 @@
+import asyncio
+import json
+import tempfile
+from pathlib import Path
+
+import otree.channels.broker
+from otree.channels.broker import ChannelBroker, encode_group
+from otree.channels.utils import BrokerChannelLayer
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.received = []
+
+    async def send_text(self, text):
+        self.received.append(json.loads(text))
+
+
+async def wait_until(condition, timeout=5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, 'timed out'
+        await asyncio.sleep(0.01)
+
+
+def run_with_broker(test):
+    async def main():
+        path = str(Path(tempfile.mkdtemp()) / 'broker.sock')
+        broker = ChannelBroker(path)
+        server_task = asyncio.ensure_future(broker.serve())
+        await wait_until(lambda: Path(path).exists())
+        try:
+            await test(broker, path)
+        finally:
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+
+    asyncio.run(main())
+
+
+def start_layer(path):
+    layer = BrokerChannelLayer(path)
+    layer.start()
+    return layer
+
+
+def test_group_send_reaches_other_worker():
+    async def test(broker, path):
+        layer_a = start_layer(path)
+        layer_b = start_layer(path)
+        await wait_until(lambda: layer_a._writer and layer_b._writer)
+
+        socket = FakeWebSocket()
+        layer_b.add('group1', socket)
+        await wait_until(lambda: 'group1' in broker._subscribers)
+
+        await layer_a.send('group1', {'x': 1})
+        await wait_until(lambda: socket.received)
+        assert socket.received == [{'x': 1}]
+
+        layer_b.discard('group1', socket)
+        await wait_until(lambda: 'group1' not in broker._subscribers)
+        await layer_a.send('group1', {'x': 2})
+        # give it a chance to arrive, if it were going to
+        await asyncio.sleep(0.1)
+        assert socket.received == [{'x': 1}]
+
+    run_with_broker(test)
+
+
+def test_slow_worker_is_dropped(monkeypatch):
+    monkeypatch.setattr(otree.channels.broker, 'MAX_WORKER_BUFFER', 100_000)
+
+    async def test(broker, path):
+        layer = start_layer(path)
+        await wait_until(lambda: layer._writer)
+
+        # a worker that subscribes but never reads
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(b'S ' + encode_group('group1') + b'\n')
+        await wait_until(lambda: 'group1' in broker._subscribers)
+
+        # more than the OS socket buffer can absorb
+        for _ in range(100):
+            await layer.send('group1', {'text': 'x' * 100_000})
+            if broker.num_dropped:
+                break
+        await wait_until(lambda: broker.num_dropped == 1)
+        await wait_until(lambda: 'group1' not in broker._subscribers)
+        writer.close()
+
+    run_with_broker(test)
+
+
+def test_listener_gets_messages_from_other_worker():
+    async def test(broker, path):
+        layer_a = start_layer(path)
+        layer_b = start_layer(path)
+        await wait_until(lambda: layer_a._writer and layer_b._writer)
+
+        received = []
+        layer_b.listen('group1', received.append)
+        await wait_until(lambda: 'group1' in broker._subscribers)
+
+        await layer_a.send('group1', [[1, 'abc']])
+        await wait_until(lambda: received)
+        assert received == [[[1, 'abc']]]
+
+    run_with_broker(test)
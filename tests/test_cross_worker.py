@@ -0,0 +1,137 @@
+import asyncio
+import html
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import urllib.request
+from pathlib import Path
+
+import websockets
+
+from otree.channels.broker import ChannelBroker
+from test_channel_broker import wait_until
+
+TESTS_DIR = Path(__file__).parent
+# 2 server processes share an SQLite file, like prodserver --workers 2
+# (minus the dispatcher, so that we can choose which worker gets each request).
+RUN_WORKER = '''
+import sys
+sys.argv = ['otree', 'prodserver1of2', sys.argv[1]]
+from otree.main import execute_from_command_line
+execute_from_command_line()
+'''
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_project():
+    project_dir = Path(tempfile.mkdtemp())
+    shutil.copy(TESTS_DIR / 'settings.py', project_dir)
+    shutil.copytree(TESTS_DIR / 'simple_app', project_dir / 'simple_app')
+    (project_dir / '_static').mkdir()
+    return project_dir
+
+
+class Worker:
+    def __init__(self, project_dir, broker_path):
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        env = dict(os.environ, OTREE_CHANNEL_BROKER=broker_path)
+        # conftest sets this for the test process, but the workers need to
+        # share the DB file.
+        env.pop('OTREE_IN_MEMORY', None)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [str(TESTS_DIR.parent), env.get('PYTHONPATH', '')]
+        )
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', RUN_WORKER, str(self.port)],
+            cwd=project_dir,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def is_up(self):
+        try:
+            with urllib.request.urlopen(self.url + '/api/otree_version'):
+                return True
+        except OSError:
+            return False
+
+    def open(self, path, data=None):
+        with urllib.request.urlopen(self.url + path, data=data) as response:
+            return response.read().decode('utf-8')
+
+
+async def run_in_thread(func, *args):
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+async def wait_until_up(worker):
+    deadline = asyncio.get_event_loop().time() + 30
+    while not await run_in_thread(worker.is_up):
+        assert worker.process.poll() is None, 'worker exited'
+        assert asyncio.get_event_loop().time() < deadline, 'worker did not start'
+        await asyncio.sleep(0.2)
+
+
+def test_wait_page_released_by_other_worker():
+    project_dir = make_project()
+    broker_path = str(project_dir / 'broker.sock')
+    workers = []
+
+    async def main():
+        broker = ChannelBroker(broker_path)
+        asyncio.ensure_future(broker.serve())
+        await wait_until(lambda: Path(broker_path).exists())
+
+        # one after the other, so they don't both create the tables
+        for _ in range(2):
+            worker = Worker(project_dir, broker_path)
+            workers.append(worker)
+            await wait_until_up(worker)
+        worker_a, worker_b = workers
+
+        data = json.dumps(
+            dict(session_config_name='simple', num_participants=2)
+        ).encode()
+        session_code = json.loads(
+            await run_in_thread(worker_a.open, '/api/sessions', data)
+        )['code']
+        session = json.loads(
+            await run_in_thread(
+                worker_a.open, f'/api/get_session/{session_code}', b'{}'
+            )
+        )
+        [code_a, code_b] = [p['code'] for p in session['participants']]
+
+        # the first page is a wait page
+        page = await run_in_thread(worker_a.open, f'/InitializeParticipant/{code_a}')
+        socket_path = html.unescape(
+            re.search(r'makeReconnectingWebSocket\("([^"]+)"\)', page).group(1)
+        )
+        socket_url = f'ws://127.0.0.1:{worker_a.port}{socket_path}'
+        async with websockets.connect(socket_url) as ws:
+            await wait_until(
+                lambda: any('wait-page' in g for g in broker._subscribers)
+            )
+            # the last arrival, on the other worker
+            await run_in_thread(worker_b.open, f'/InitializeParticipant/{code_b}')
+            message = json.loads(await asyncio.wait_for(ws.recv(), 10))
+        assert message['status'] == 'ready'
+
+    try:
+        asyncio.run(main())
+    finally:
+        for worker in workers:
+            worker.process.terminate()
+            worker.process.wait()
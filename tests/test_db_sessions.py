@@ -0,0 +1,63 @@
+import asyncio
+import contextvars
+import threading
+
+import pytest
+
+import otree.database
+from otree.database import db, session_scope
+
+
+@pytest.fixture
+def pooled(monkeypatch):
+    # the tests use the in-memory DB, which has a single shared connection
+    monkeypatch.setattr(otree.database, 'supports_concurrent_sessions', lambda: True)
+
+
+def _run_in_new_context(func):
+    return contextvars.Context().run(func)
+
+
+def test_main_thread_gets_a_session(pooled):
+    def func():
+        session = db._db
+        assert db._db is session
+        session.close()
+
+    _run_in_new_context(func)
+
+
+def test_thread_without_session_raises(pooled):
+    errors = []
+
+    def func():
+        try:
+            db._db
+        except RuntimeError as exc:
+            errors.append(exc)
+
+    thread = threading.Thread(target=func)
+    thread.start()
+    thread.join()
+    assert errors
+
+
+def test_event_loop_without_session_raises(pooled):
+    async def main():
+        with pytest.raises(RuntimeError):
+            db._db
+        with session_scope():
+            assert db._db is not None
+
+    _run_in_new_context(lambda: asyncio.run(main()))
+
+
+def test_executor_job_with_session_scope(pooled):
+    def job():
+        with session_scope():
+            return db._db is not None
+
+    async def main():
+        return await asyncio.get_event_loop().run_in_executor(None, job)
+
+    assert _run_in_new_context(lambda: asyncio.run(main()))
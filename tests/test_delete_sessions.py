@@ -0,0 +1,52 @@
+import asyncio
+
+from otree.channels.consumers import WSDeleteSessions
+from otree.completions import completions
+from otree.database import session_scope
+from otree.models_concrete import CompletedGroupWaitPage
+from otree.session import create_session
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+
+def delete_sessions(codes):
+    consumer = WSDeleteSessions(dict(type='websocket', path_params={}), None, None)
+    consumer.websocket = FakeWebSocket()
+
+    async def main():
+        with session_scope():
+            await consumer.post_receive_json(codes)
+
+    asyncio.run(main())
+    assert consumer.websocket.sent == ['ok']
+
+
+def completed(session_id):
+    with session_scope():
+        return completions.exists(
+            CompletedGroupWaitPage, session_id, page_index=1, group_id=1
+        )
+
+
+def test_recreated_session_id_has_no_stale_completions():
+    with session_scope():
+        session = create_session('simple', num_participants=2)
+        session_id, session_code = session.id, session.code
+        CompletedGroupWaitPage.objects_create(
+            session=session, page_index=1, group_id=1
+        )
+    assert completed(session_id)
+
+    delete_sessions([session_code])
+
+    with session_scope():
+        session = create_session('simple', num_participants=2)
+        # SQLite reuses the highest ID after it's deleted
+        assert session.id == session_id
+    assert not completed(session_id)
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import time
+
+import otree.dispatcher
+import otree.tasks
+from otree.database import session_scope
+from otree.dispatcher import SessionDispatcher, route_key, worker_for_session
+from otree.models_concrete import RoomToSession
+from otree.session import create_session
+from otree.tasks import TaskScheduler
+
+
+def test_resolve_cache(monkeypatch):
+    sessions = {}
+    lookups = []
+
+    def lookup(kind, value):
+        lookups.append(value)
+        return sessions.get(value)
+
+    monkeypatch.setattr(otree.dispatcher, '_lookup_session_code', lookup)
+    dispatcher = SessionDispatcher([])
+    resolve = lambda key: asyncio.run(dispatcher.resolve(key))
+
+    # not created yet, so it must be looked up again next time
+    assert resolve(('session_pk', 1)) is None
+    sessions[1] = 'abcdefgh'
+    assert resolve(('session_pk', 1)) == 'abcdefgh'
+    assert resolve(('session_pk', 1)) == 'abcdefgh'
+    assert lookups == [1, 1]
+
+    # the session was deleted and its pk reused
+    sessions[1] = 'stuvwxyz'
+    later = time.monotonic() + otree.dispatcher.DISPATCH_CACHE_SECONDS + 1
+    monkeypatch.setattr(time, 'monotonic', lambda: later)
+    assert resolve(('session_pk', 1)) == 'stuvwxyz'
+
+
+def test_route_key():
+    assert route_key('/p/abcdefgh/simple/MyPage/1') == ('code', 'abcdefgh')
+    assert route_key('/join/bamobego') == ('anonymous_code', 'bamobego')
+    assert route_key('/room/econ101?participant_label=a') == ('room', 'econ101')
+    assert route_key('/room_without_session/econ101') == ('room', 'econ101')
+    assert route_key('/CloseRoom/econ101') == ('room', 'econ101')
+    assert route_key(
+        '/wait_for_session_in_room?room_name=econ101&participant_label=a'
+    ) == ('room', 'econ101')
+    assert route_key('/delete_sessions') is None
+
+
+def test_room_is_routed_to_its_session(monkeypatch):
+    rooms = {}
+    monkeypatch.setattr(
+        otree.dispatcher, '_lookup_session_code', lambda kind, value: rooms.get(value)
+    )
+    dispatcher = SessionDispatcher([])
+    resolve = lambda key: asyncio.run(dispatcher.resolve(key))
+
+    # a room without a session has a fixed worker of its own
+    assert resolve(('room', 'econ101')) == 'econ101'
+    rooms['econ101'] = 'abcdefgh'
+    assert resolve(('room', 'econ101')) == 'abcdefgh'
+    # the room was closed
+    del rooms['econ101']
+    assert resolve(('room', 'econ101')) == 'econ101'
+
+
+def test_lookup_join_link_and_room():
+    with session_scope():
+        session = create_session('simple', num_participants=2)
+        session_code, anonymous_code = session.code, session._anonymous_code
+        RoomToSession.objects_create(room_name='econ101', session=session)
+    lookup = otree.dispatcher._lookup_session_code
+    assert lookup('anonymous_code', anonymous_code) == session_code
+    assert lookup('room', 'econ101') == session_code
+    assert lookup('room', 'econ102') is None
+
+
+def test_pending_timeouts_reload_in_their_session_worker(monkeypatch):
+    monkeypatch.setattr(otree.tasks, 'NUM_WORKERS', 4)
+    kwargs_json = json.dumps(dict(participant_code='abcdefgh', session_code='stuvwxyz'))
+    owner = worker_for_session('stuvwxyz', 4)
+    for i in range(4):
+        monkeypatch.setattr(otree.tasks, 'WORKER_INDEX', i)
+        assert TaskScheduler()._is_for_this_worker(kwargs_json) == (i == owner)
@@ -0,0 +1,42 @@
+import asyncio
+
+import otree.export
+import otree.views.export
+from otree.database import create_session as create_db_session, session_scope
+from otree.session import create_session
+
+
+def test_single_connection_export_closes_its_session_before_sending(monkeypatch):
+    # the in-memory DB has a single shared connection
+    assert not otree.views.export.supports_concurrent_sessions()
+    with session_scope():
+        session_code = create_session('simple', num_participants=2).code
+
+    events = []
+
+    def create_tracked_session():
+        db_session = create_db_session()
+        close = db_session.close
+
+        def tracked_close():
+            events.append('closed')
+            close()
+
+        db_session.close = tracked_close
+        return db_session
+
+    monkeypatch.setattr(otree.views.export, 'create_session', create_tracked_session)
+
+    async def download():
+        async for chunk in otree.views.export._stream_export(
+            lambda: otree.export.iter_export_wide(session_code=session_code),
+            for_excel=False,
+        ):
+            events.append(chunk)
+
+    asyncio.run(download())
+    assert events[0] == 'closed'
+    text = b''.join(events[1:]).decode('utf-8')
+    assert text.startswith('participant.id_in_session')
+    # header + 2 participants
+    assert len(text.splitlines()) == 3
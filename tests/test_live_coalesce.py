@@ -0,0 +1,60 @@
+import asyncio
+
+from otree.channels.consumers import LiveConsumer
+from otree.live import LiveContext, TokenBucket
+
+
+def make_consumer(sent):
+    scope = dict(
+        type='websocket',
+        path_params={},
+        query_string=(
+            b'participant_code=abcdefgh&page_name=MyPage'
+            b'&session_code=stuvwxyz&page_index=1'
+        ),
+    )
+    consumer = LiveConsumer(scope, None, None)
+    consumer.live_context = LiveContext()
+    consumer.coalesce_seconds = 0.05
+    consumer.coalesce_key = 'type'
+    consumer.rate_limit = TokenBucket()
+    consumer.submit = sent.append
+    return consumer
+
+
+def test_latest_message_per_key_is_delivered():
+    sent = []
+    consumer = make_consumer(sent)
+
+    async def main():
+        for data in [
+            # goes out right away
+            dict(type='a', value=1),
+            dict(type='a', value=2),
+            dict(type='b', value=1),
+            dict(type='a', value=3),
+        ]:
+            await consumer.on_receive(None, data)
+        assert sent == [dict(type='a', value=1)]
+        await asyncio.sleep(0.1)
+
+    asyncio.run(main())
+    assert sent == [
+        dict(type='a', value=1),
+        dict(type='b', value=1),
+        dict(type='a', value=3),
+    ]
+
+
+def test_held_messages_are_delivered_on_disconnect():
+    sent = []
+    consumer = make_consumer(sent)
+
+    async def main():
+        for data in [1, 2, dict(type='b', value=1), 3]:
+            await consumer.on_receive(None, data)
+        await consumer.pre_disconnect()
+
+    asyncio.run(main())
+    # messages that aren't dicts share 1 key
+    assert sent == [1, dict(type='b', value=1), 3]
@@ -0,0 +1,70 @@
+import re
+
+import pytest
+
+from otree.database import db, dbq
+from otree.models_concrete import (
+    CompletedGBATWaitPage,
+    CompletedGroupWaitPage,
+    CompletedSubsessionWaitPage,
+)
+from simple_app import Group, Player, Subsession
+
+
+def query_plan(query) -> str:
+    sql = query.statement.compile(
+        db._db.bind, compile_kwargs={'literal_binds': True}
+    )
+    rows = db._db.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall()
+    return '\n'.join(row[-1] for row in rows)
+
+
+@pytest.mark.parametrize(
+    'make_query, index_name',
+    [
+        # loading the player for the participant's current page
+        (
+            lambda: Player.objects_filter(participant_id=1, round_number=2),
+            'simple_app_player_participant_round',
+        ),
+        # group.get_players()
+        (
+            lambda: dbq(Player).filter_by(group_id=1).order_by('id_in_group'),
+            'simple_app_player_group_id_in_group',
+        ),
+        # group.in_round()
+        (
+            lambda: Group.objects_filter(
+                round_number=2, session_id=1, id_in_subsession=1
+            ),
+            'simple_app_group_session_round',
+        ),
+        # subsession.in_round()
+        (
+            lambda: Subsession.objects_filter(round_number=2, session_id=1),
+            'simple_app_subsession_session_round',
+        ),
+        # wait page early exits
+        (
+            lambda: CompletedGroupWaitPage.objects_filter(
+                session_id=1, page_index=3, group_id=1
+            ),
+            'otree_completedgroupwaitpage_lookup',
+        ),
+        (
+            lambda: CompletedSubsessionWaitPage.objects_filter(
+                session_id=1, page_index=3
+            ),
+            'otree_completedsubsessionwaitpage_lookup',
+        ),
+        (
+            lambda: CompletedGBATWaitPage.objects_filter(
+                session_id=1, page_index=3, id_in_subsession=1
+            ),
+            'otree_completedgbatwaitpage_lookup',
+        ),
+    ],
+)
+def test_hot_query_uses_index(make_query, index_name):
+    plan = query_plan(make_query())
+    assert re.search(rf'USING (COVERING )?INDEX {index_name}\b', plan), plan
@@ -0,0 +1,29 @@
+import pytest
+
+import otree.row_cache
+from otree.database import db, session_scope
+from otree.models import Session
+from otree.row_cache import row_cache
+from otree.session import create_session
+
+
+@pytest.fixture
+def session_id(monkeypatch):
+    monkeypatch.setattr(otree.row_cache, 'ROW_CACHE_ENABLED', True)
+    with session_scope():
+        session = create_session('simple', num_participants=2)
+        session.config = dict(session.config, nested={'a': [1]})
+        db._db.flush()
+        return session.id
+
+
+def test_nested_config_changes_dont_leak_into_cache(session_id):
+    # the first one stores it, the others are cache hits
+    for _ in range(3):
+        with session_scope():
+            session = row_cache.get(Session, session_id)
+            assert session.config['nested'] == {'a': [1]}
+            # changed in place, so it's not saved
+            session.config['nested']['a'].append(2)
+            session.config['nested']['b'] = 1
+    assert row_cache.hits >= 2
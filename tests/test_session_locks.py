@@ -0,0 +1,63 @@
+import asyncio
+
+from otree.middleware import SessionLocks
+
+
+def test_forget_session():
+    locks = SessionLocks()
+    locks.remember(participant_code='p1', session_pk=1, session_code='s1')
+    locks.remember(participant_code='p2', session_pk=1, session_code='s1')
+    locks.remember(participant_code='p3', session_pk=2, session_code='s2')
+
+    locks.forget_session('s1')
+    assert locks.session_code_for_participant('p1') is None
+    assert locks.session_code_for_participant('p2') is None
+    assert locks.session_code_for_pk(1) is None
+    assert locks.session_code_for_participant('p3') == 's2'
+    assert locks.session_code_for_pk(2) == 's2'
+
+    # the deleted session's ID is reused
+    locks.remember(participant_code='p4', session_pk=1, session_code='s3')
+    assert locks.session_code_for_pk(1) == 's3'
+    locks.forget_session('s1')
+    assert locks.session_code_for_pk(1) == 's3'
+
+
+def test_global_lock_is_first_come_first_served():
+    locks = SessionLocks()
+    order = []
+
+    async def request(name):
+        async with locks._acquire_global():
+            order.append(name)
+            await asyncio.sleep(0)
+
+    async def client(name):
+        # as soon as it releases the lock, it asks for it again
+        for _ in range(3):
+            await request(name)
+
+    async def main():
+        await asyncio.gather(client('a'), client('b'))
+
+    asyncio.run(main())
+    assert order == ['a', 'b'] * 3
+
+
+def test_cancelled_global_waiter_does_not_block_others():
+    locks = SessionLocks()
+
+    async def main():
+        async with locks._acquire_global():
+            waiter = asyncio.ensure_future(_hold(locks))
+            other = asyncio.ensure_future(_hold(locks))
+            await asyncio.sleep(0)
+            waiter.cancel()
+        await asyncio.wait_for(other, 1)
+
+    asyncio.run(main())
+
+
+async def _hold(locks):
+    async with locks._acquire_global():
+        pass
@@ -0,0 +1,72 @@
+import asyncio
+import sqlite3
+import threading
+
+from otree.database import DB_FILE, SQLiteSnapshotter, _SnapshotStopped
+from otree.middleware import SessionLocks
+
+
+def _make_snapshotter(locks, loop):
+    return SQLiteSnapshotter(
+        60,
+        acquire_lock=lambda stop_event: locks.acquire_global_from_thread(
+            loop, stop_event
+        ),
+    )
+
+
+def test_snapshot_waits_for_the_request_lock():
+    locks = SessionLocks()
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        snapshotter = _make_snapshotter(locks, loop)
+        async with locks.acquire():
+            future = loop.run_in_executor(None, snapshotter.take_snapshot)
+            await asyncio.sleep(0.3)
+            # e.g. a request is in the middle of a transaction
+            assert not future.done()
+        await asyncio.wait_for(future, 5)
+        assert snapshotter.num_snapshots == 1
+        # requests can use the DB again
+        async with locks.acquire():
+            pass
+
+    asyncio.run(main())
+    conn = sqlite3.connect(DB_FILE)
+    assert conn.execute("PRAGMA user_version").fetchone()[0]
+    conn.close()
+
+
+def test_stopped_snapshot_does_not_wait_for_the_lock():
+    locks = SessionLocks()
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        snapshotter = _make_snapshotter(locks, loop)
+        errors = []
+
+        def take_snapshot():
+            try:
+                snapshotter.take_snapshot()
+            except _SnapshotStopped as exc:
+                errors.append(exc)
+
+        async with locks.acquire():
+            thread = threading.Thread(target=take_snapshot)
+            thread.start()
+            await asyncio.sleep(0.2)
+            snapshotter._stop_event.set()
+            # like save_sqlite_db() at shutdown, which blocks the loop
+            thread.join(5)
+            assert not thread.is_alive()
+        assert errors
+        # a cancelled waiter doesn't keep the lock from others
+        await asyncio.wait_for(_hold(locks), 1)
+
+    asyncio.run(main())
+
+
+async def _hold(locks):
+    async with locks.acquire():
+        pass
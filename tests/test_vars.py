@@ -0,0 +1,124 @@
+import binascii
+import pickle
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.types import Text
+
+import otree.database
+from otree.database import (
+    db,
+    engine,
+    session_scope,
+    decode_vars,
+    encode_vars,
+    raw_vars_bytes,
+    VarsDict,
+    _VarsField,
+)
+from otree.models import Participant
+from otree.session import create_session
+
+
+@pytest.fixture(scope='module')
+def participant_id():
+    with session_scope():
+        session = create_session('simple', num_participants=2)
+        participant = session.get_participants()[0]
+        participant.vars.update(score=1, history=[1], info={'a': 1})
+        db._db.flush()
+        return participant.id
+
+
+@pytest.fixture
+def count_updates():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if statement.startswith('UPDATE otree_participant'):
+            statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    yield statements
+    event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def run(participant_id, func):
+    with session_scope():
+        func(Participant.objects_get(id=participant_id).vars)
+    with session_scope():
+        return dict(Participant.objects_get(id=participant_id).vars)
+
+
+def test_reads_dont_write(participant_id, count_updates):
+    def read(vars):
+        vars['score']
+        vars.get('history')
+        list(vars.items())
+        vars.copy()
+        dict(vars)
+        vars.pop('missing', None)
+
+    run(participant_id, read)
+    assert count_updates == []
+
+
+@pytest.mark.parametrize(
+    'change',
+    [
+        lambda vars: vars['history'].append(2),
+        lambda vars: vars.get('history').append(2),
+        lambda vars: vars.copy()['history'].append(2),
+        lambda vars: dict(vars)['history'].append(2),
+        lambda vars: [value for value in vars.values() if isinstance(value, list)][
+            0
+        ].append(2),
+    ],
+)
+def test_in_place_change_is_saved(participant_id, count_updates, change):
+    before = run(participant_id, lambda vars: None)['history']
+    after = run(participant_id, change)['history']
+    assert after == before + [2]
+    assert len(count_updates) == 1
+
+
+def test_change_after_flush_is_saved(participant_id):
+    def change(vars):
+        vars['new_list'] = []
+        db._db.flush()
+        vars['new_list'].append(1)
+
+    assert run(participant_id, change)['new_list'] == [1]
+
+
+def test_pop(participant_id, count_updates):
+    run(participant_id, lambda vars: vars.update(to_remove=1))
+    assert len(count_updates) == 1
+    assert 'to_remove' not in run(participant_id, lambda vars: vars.pop('to_remove'))
+    assert len(count_updates) == 2
+
+
+def test_decode_all_formats():
+    value = {'a': [1, 2]}
+    legacy = binascii.b2a_base64(pickle.dumps(value))
+    encoded = encode_vars(value)
+    # BLOB column
+    assert decode_vars(encoded) == value
+    assert decode_vars(memoryview(encoded)) == value
+    # TEXT column, or a row from before the binary format
+    assert decode_vars(legacy.decode('utf-8')) == value
+    assert decode_vars(binascii.b2a_base64(encoded).decode('utf-8')) == value
+    # legacy text copied into a BLOB column
+    assert decode_vars(legacy) == value
+
+
+def test_text_column(monkeypatch):
+    monkeypatch.setattr(otree.database, 'VARS_AS_TEXT', True)
+    field = _VarsField()
+    assert isinstance(field.load_dialect_impl(engine.dialect), Text)
+    vars_dict = VarsDict(a=1)
+    bound = field.process_bind_param(vars_dict, engine.dialect)
+    assert isinstance(bound, str)
+    assert decode_vars(bound) == {'a': 1}
+    # so that reading it back doesn't look like a change
+    assert raw_vars_bytes(bound) == vars_dict._raw == encode_vars(vars_dict)